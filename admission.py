@@ -0,0 +1,204 @@
+import functools
+import shutil
+import tempfile
+import threading
+import time
+
+from flask import current_app, jsonify, request
+
+import metrics
+from storage import LocalStorage, get_storage
+
+# Admission control for the routes that receive upload bodies. Before a body
+# is read the request must get one of UPLOAD_MAX_CONCURRENT slots, and the
+# bytes of all admitted bodies (their Content-Length, compressed or not) must
+# stay within UPLOAD_MAX_INFLIGHT_BYTES. A body of unknown length (chunked
+# transfer encoding) is charged MAX_CONTENT_LENGTH if set, else
+# UPLOAD_UNKNOWN_LENGTH_BYTES; routes that write more than their body, such
+# as finalizing a resumable upload, charge what they write. A request that does not fit waits in
+# a queue of at most UPLOAD_MAX_QUEUE requests for up to
+# UPLOAD_QUEUE_TIMEOUT_SECONDS; after that it is answered 503 with a
+# Retry-After header, before any of its body was read.
+#
+# Free disk space is checked first, on the upload folder (local storage) and
+# on the temporary directory multipart parts are spooled to. Below
+# DISK_FREE_LOW_BYTES uploads are refused until free space is back above
+# DISK_FREE_HIGH_BYTES, so a nearly full disk does not flap between
+# accepting and refusing. A request is also refused if its body, together
+# with the bodies in flight, would take free space below the low watermark.
+
+DEFAULT_MAX_CONCURRENT = 8
+DEFAULT_MAX_INFLIGHT_BYTES = 2 * 1024 * 1024 * 1024
+DEFAULT_MAX_QUEUE = 32
+DEFAULT_QUEUE_TIMEOUT_SECONDS = 10
+DEFAULT_RETRY_AFTER_SECONDS = 2
+DEFAULT_DISK_FREE_LOW_BYTES = 1024 * 1024 * 1024
+DEFAULT_DISK_FREE_HIGH_BYTES = 2 * 1024 * 1024 * 1024
+DEFAULT_UNKNOWN_LENGTH_BYTES = 256 * 1024 * 1024
+DISK_RETRY_AFTER_SECONDS = 60
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, message, reason, retry_after):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Counts the uploads in flight and makes new ones wait for room.
+
+    Limits are passed on every call, so they follow the app config. An
+    upload larger than ``max_bytes`` is admitted when nothing else is in
+    flight rather than never.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.inflight = 0
+        self.inflight_bytes = 0
+        self.waiting = 0
+        self.disk_low = False
+
+    def fits(self, nbytes, max_concurrent, max_bytes):
+        if self.inflight == 0:
+            return True
+        if max_concurrent is not None and self.inflight >= max_concurrent:
+            return False
+        return max_bytes is None or self.inflight_bytes + nbytes <= max_bytes
+
+    def acquire(self, nbytes, max_concurrent=DEFAULT_MAX_CONCURRENT, max_bytes=DEFAULT_MAX_INFLIGHT_BYTES,
+                queue_timeout=DEFAULT_QUEUE_TIMEOUT_SECONDS, max_queue=DEFAULT_MAX_QUEUE,
+                retry_after=DEFAULT_RETRY_AFTER_SECONDS):
+        """Admit an upload of ``nbytes``, waiting up to ``queue_timeout`` seconds.
+
+        Raises AdmissionRejected if the queue is full or the wait times out.
+        """
+        with self.condition:
+            if not self.fits(nbytes, max_concurrent, max_bytes):
+                if self.waiting >= max_queue:
+                    raise AdmissionRejected('Too many uploads waiting, please retry', 'queue_full', retry_after)
+                deadline = time.monotonic() + queue_timeout
+                self.waiting += 1
+                self._publish()
+                try:
+                    while not self.fits(nbytes, max_concurrent, max_bytes):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            reason = 'concurrency' if max_concurrent is not None and self.inflight >= max_concurrent else 'bytes'
+                            raise AdmissionRejected('Too many uploads in progress, please retry', reason, retry_after)
+                        self.condition.wait(remaining)
+                finally:
+                    self.waiting -= 1
+                    self._publish()
+            self.inflight += 1
+            self.inflight_bytes += nbytes
+            self._publish()
+
+    def release(self, nbytes):
+        with self.condition:
+            self.inflight -= 1
+            self.inflight_bytes -= nbytes
+            self._publish()
+            self.condition.notify_all()
+
+    def check_disk(self, free, nbytes, low, high):
+        """Raise AdmissionRejected unless ``free`` bytes leave room for ``nbytes`` more."""
+        with self.condition:
+            if free < low:
+                self.disk_low = True
+            elif high is None or free >= high:
+                self.disk_low = False
+            if self.disk_low or free - self.inflight_bytes - nbytes < low:
+                raise AdmissionRejected('Not enough free disk space, please retry later', 'disk',
+                                        DISK_RETRY_AFTER_SECONDS)
+
+    def _publish(self):
+        metrics.set_gauge('upload_admission_queue_depth', self.waiting)
+        metrics.set_gauge('uploads_in_flight', self.inflight)
+        metrics.set_gauge('upload_bytes_in_flight', self.inflight_bytes)
+
+
+def init_admission(app):
+    controller = AdmissionController()
+    app.extensions['admission'] = controller
+    return controller
+
+
+def free_disk_bytes():
+    """Free bytes on the fullest filesystem an upload is written to."""
+    paths = [tempfile.gettempdir()]
+    storage = get_storage()
+    if isinstance(storage, LocalStorage):
+        paths.append(storage.root)
+    free = []
+    for path in paths:
+        try:
+            free.append(shutil.disk_usage(path).free)
+        except OSError:
+            pass
+    return min(free) if free else None
+
+
+def admit(nbytes):
+    """Admit an upload of ``nbytes`` under the app's limits; raises AdmissionRejected."""
+    controller = current_app.extensions['admission']
+    config = current_app.config
+    low = config.get('DISK_FREE_LOW_BYTES', DEFAULT_DISK_FREE_LOW_BYTES)
+    if low:
+        free = free_disk_bytes()
+        if free is not None:
+            metrics.set_gauge('disk_free_bytes', free)
+            controller.check_disk(free, nbytes, low, config.get('DISK_FREE_HIGH_BYTES', DEFAULT_DISK_FREE_HIGH_BYTES))
+    controller.acquire(
+        nbytes,
+        max_concurrent=config.get('UPLOAD_MAX_CONCURRENT', DEFAULT_MAX_CONCURRENT),
+        max_bytes=config.get('UPLOAD_MAX_INFLIGHT_BYTES', DEFAULT_MAX_INFLIGHT_BYTES),
+        queue_timeout=config.get('UPLOAD_QUEUE_TIMEOUT_SECONDS', DEFAULT_QUEUE_TIMEOUT_SECONDS),
+        max_queue=config.get('UPLOAD_MAX_QUEUE', DEFAULT_MAX_QUEUE),
+        retry_after=config.get('UPLOAD_RETRY_AFTER_SECONDS', DEFAULT_RETRY_AFTER_SECONDS),
+    )
+
+
+def body_bytes(unknown=None):
+    """Bytes charged for the request body: its Content-Length, compressed or not.
+
+    A chunked body, whose length is unknown, is charged ``unknown``, by
+    default MAX_CONTENT_LENGTH or else UPLOAD_UNKNOWN_LENGTH_BYTES.
+    """
+    if request.content_length is not None:
+        return request.content_length
+    compressed = request.environ.get('pdf_browser.compressed_length')
+    if compressed is not None:
+        return compressed
+    if 'chunked' not in request.headers.get('Transfer-Encoding', '').lower():
+        return 0  # no body
+    if unknown is not None:
+        return unknown
+    config = current_app.config
+    return config.get('MAX_CONTENT_LENGTH') or config.get('UPLOAD_UNKNOWN_LENGTH_BYTES', DEFAULT_UNKNOWN_LENGTH_BYTES)
+
+
+def admission_required(view=None, cost=None):
+    """Decorator for views that receive upload bodies: admit the request before the view runs.
+
+    ``cost(**view_args)`` returns the bytes to charge, body_bytes() by default.
+    """
+    if view is None:
+        return functools.partial(admission_required, cost=cost)
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        nbytes = cost(**kwargs) if cost is not None else body_bytes()
+        try:
+            admit(nbytes)
+        except AdmissionRejected as e:
+            metrics.increment('upload_admission_rejections_total', reason=e.reason)
+            response = jsonify({'error': str(e)})
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response, 503
+        try:
+            return view(*args, **kwargs)
+        finally:
+            current_app.extensions['admission'].release(nbytes)
+    return wrapper
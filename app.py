@@ -1,21 +1,61 @@
+import functools
+import hmac
 import os
-import uuid
+import re
+import time
 import json
-from flask import Flask, request, jsonify, render_template, send_from_directory
-from database import get_db_connection, init_app, delete_document_version, insert_vote, get_vote_counts, get_all_individual_votes
+import mimetypes
+from flask import Flask, Response, abort, request, jsonify, redirect, render_template, send_from_directory
+from werkzeug.datastructures import ContentRange
+from database import DATABASE_NAME, DatabaseBusyError, allocate_version, begin_immediate, get_changes, get_db_connection, init_app, latest_change_seq, record_change, delete_document, delete_document_version, insert_vote, get_vote_counts, get_all_individual_votes, get_metadata_keys, query_documents_json, update_metadata_keys, slow_query_log
+import metrics
+from instrumentation import init_instrumentation, record_fs_check, record_upload
+from json_provider import FastJSONProvider, RawJSON
+import integrity
+from ingest import StagedUpload, init_ingest
+from reaper import init_reaper, wake_reaper
+from profiling import DEFAULT_PROFILE_DIR, init_profiling, list_profiles
+from backup import DEFAULT_BACKUP_DIR, BackupInProgress, backup_app, init_backup, list_backups
+from storage import LocalStorage, get_storage, shard_key, storage_key, storage_path
+import tiering
+from serving import send_local_file
+from compression import MAX_DECOMPRESSED_BODY_SIZE, decode_file, init_compression
+from admission import admission_required, body_bytes, init_admission
+import similarity
+import suggest
+import resumable
 
 app = Flask(__name__)
+app.json = FastJSONProvider(app)
 app.config['UPLOAD_FOLDER'] = 'uploads'
+app.config['STORAGE_BACKEND'] = 'local'
+# Settings such as FLASK_PROFILING=true can be given as environment variables
+app.config.from_prefixed_env()
 ALLOWED_EXTENSIONS = {'pdf', 'html'}
+MAX_CHANGES_LIMIT = 1000
+FILTER_ARG_PATTERN = re.compile(r'^filter\[([^\]]+)\](?:\[([a-z]+)\])?$')
 
 init_app(app)
+init_instrumentation(app)
+init_profiling(app)
+init_compression(app)
+init_admission(app)
+init_ingest(app, get_db_connection)
+init_reaper(app)
+init_backup(app)
+tiering.init_tiering(app)
+similarity.init_similarity(app)
+suggest.init_suggest(app)
 
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 def check_file_consistency(file_path):
-    return os.path.exists(os.path.join(app.root_path, file_path))
+    start = time.perf_counter()
+    exists = get_storage().exists_cached(storage_key(file_path, app.config['UPLOAD_FOLDER']))
+    record_fs_check(time.perf_counter() - start)
+    return exists
 
 @app.route('/')
 def index():
@@ -55,172 +95,578 @@ def vote():
     else:
         return jsonify({'success': False, 'error': message}), 400
 
+def store_version(cursor, doc_id, metadata, change_description, file_info, html_infos):
+    """Write the rows of a new version of ``doc_id`` in the caller's transaction.
+
+    ``file_info`` and each of ``html_infos`` are ``(path, size, checksum)``
+    as returned by StagedUpload.stage(). Returns the new version number.
+    """
+    file_path, file_size, checksum = file_info
+    document_id, new_version, previous_metadata = allocate_version(cursor, doc_id, metadata)
+    if previous_metadata is not None:
+        # Update existing document
+        new_metadata = dict(previous_metadata)
+        new_metadata.update(metadata)
+        cursor.execute('UPDATE documents SET metadata = ? WHERE id = ?', (json.dumps(new_metadata), document_id))
+        update_metadata_keys(cursor, previous_metadata, new_metadata)
+        if new_metadata != previous_metadata:
+            record_change(cursor, doc_id, 'metadata_updated')
+    else:
+        update_metadata_keys(cursor, {}, metadata)
+        record_change(cursor, doc_id, 'document_created')
+    record_change(cursor, doc_id, 'version_added', new_version)
+    cursor.execute(
+        'INSERT INTO versions (document_id, version, change_description, file_path, file_size, checksum) VALUES (?, ?, ?, ?, ?, ?)',
+        (document_id, new_version, change_description, file_path, file_size, checksum)
+    )
+    version_id = cursor.lastrowid
+    cursor.executemany('INSERT INTO html_documents (version_id, file_path, file_size, checksum) VALUES (?, ?, ?, ?)',
+                       [(version_id,) + tuple(html) for html in html_infos])
+    return new_version
+
+def max_decompressed_size():
+    return app.config.get('MAX_DECOMPRESSED_BODY_SIZE', MAX_DECOMPRESSED_BODY_SIZE)
+
+def busy_response():
+    response = jsonify({'error': 'Database is busy, please retry'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
 @app.route('/upload', methods=['POST'])
+@admission_required
 def upload_file():
+    upload_started = time.perf_counter()
     if 'file' not in request.files:
         return jsonify({'error': 'No file part'}), 400
-    file = request.files['file']
+    file = decode_file(request.files['file'], max_decompressed_size())
     if file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
 
     if file and allowed_file(file.filename):
-        filename = str(uuid.uuid4()) + os.path.splitext(file.filename)[1]
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(file_path)
-
         doc_id = request.form.get('doc_id')
         metadata_str = request.form.get('metadata')
         change_description = request.form.get('change_description')
 
+        # Validate before anything is written to disk
         try:
             metadata = json.loads(metadata_str)
-        except json.JSONDecodeError:
+        except (TypeError, json.JSONDecodeError):
             return jsonify({'error': 'Invalid JSON format for metadata'}), 400
 
-        html_files = request.files.getlist('html_files')
-        html_paths = []
-        for html_file in html_files:
-            if html_file and allowed_file(html_file.filename):
-                html_filename = str(uuid.uuid4()) + os.path.splitext(html_file.filename)[1]
-                html_path = os.path.join(app.config['UPLOAD_FOLDER'], html_filename)
-                html_file.save(html_path)
-                html_paths.append(html_path)
+        html_files = [decode_file(f, max_decompressed_size()) for f in request.files.getlist('html_files')
+                      if f and allowed_file(f.filename)]
 
         conn = get_db_connection()
-        cursor = conn.cursor()
-
-        cursor.execute('SELECT * FROM documents WHERE doc_id = ?', (doc_id,))
-        document = cursor.fetchone()
-
-        if document:
-            # Update existing document
-            document_id = document['id']
-            new_version = document['latest_version'] + 1
-
-            existing_metadata = json.loads(document['metadata'])
-            existing_metadata.update(metadata)
-            new_metadata_str = json.dumps(existing_metadata)
-
-            cursor.execute('UPDATE documents SET latest_version = ?, metadata = ? WHERE id = ?', (new_version, new_metadata_str, document_id))
-            cursor.execute(
-                'INSERT INTO versions (document_id, version, change_description, file_path) VALUES (?, ?, ?, ?)',
-                (document_id, new_version, change_description, file_path)
-            )
-            version_id = cursor.lastrowid
-            for html_path in html_paths:
-                cursor.execute('INSERT INTO html_documents (version_id, file_path) VALUES (?, ?)', (version_id, html_path))
-        else:
-            # Create new document
-            cursor.execute('INSERT INTO documents (doc_id, metadata) VALUES (?, ?)', (doc_id, json.dumps(metadata)))
-            document_id = cursor.lastrowid
-            cursor.execute(
-                'INSERT INTO versions (document_id, version, change_description, file_path) VALUES (?, ?, ?, ?)',
-                (document_id, 1, change_description, file_path)
-            )
-            version_id = cursor.lastrowid
-            for html_path in html_paths:
-                cursor.execute('INSERT INTO html_documents (version_id, file_path) VALUES (?, ?)', (version_id, html_path))
-
-        conn.commit()
+        try:
+            with StagedUpload(conn, get_storage(), app.config['UPLOAD_FOLDER']) as upload:
+                file_path, file_size, checksum = upload.stage(file)
+                html_paths = [upload.stage(html_file) for html_file in html_files]
+
+                # Files are staged before taking the write lock, so concurrent
+                # uploads only serialize on the short row writes below.
+                begin_immediate(conn)
+                store_version(conn.cursor(), doc_id, metadata, change_description, (file_path, file_size, checksum), html_paths)
+
+                upload.commit()
+        except DatabaseBusyError:
+            return busy_response()
+        # Bytes on the wire, compressed or not
+        received = request.content_length or request.environ.get('pdf_browser.compressed_length') or 0
+        record_upload(received, time.perf_counter() - upload_started)
 
         return jsonify({'success': True}), 200
     else:
         return jsonify({'error': 'File type not allowed'}), 400
 
+def session_ttl():
+    return app.config.get('UPLOAD_SESSION_TTL_SECONDS', resumable.SESSION_TTL_SECONDS)
+
+def session_json(session):
+    return {
+        'id': session['id'],
+        'doc_id': session['doc_id'],
+        'filename': session['filename'],
+        'size': session['total_size'],
+        'chunk_size': session['chunk_size'],
+        'received': sorted(session['received']),
+        'offset': resumable.contiguous_offset(session),
+        'status': session['status'],
+        'expires_at': session['expires_at'],
+    }
+
+@app.route('/upload/sessions', methods=['POST'])
+def create_upload_session():
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return jsonify({'error': 'Request body must be a JSON object'}), 400
+    filename = body.get('filename')
+    if not isinstance(filename, str) or not allowed_file(filename):
+        return jsonify({'error': 'File type not allowed'}), 400
+    if not isinstance(body.get('doc_id'), str) or not body['doc_id']:
+        return jsonify({'error': 'doc_id is required'}), 400
+    if not isinstance(body.get('metadata', {}), dict):
+        return jsonify({'error': 'Invalid JSON format for metadata'}), 400
+
+    conn = get_db_connection()
+    try:
+        resumable.expire_sessions(conn, get_storage())
+        session = resumable.create_session(
+            conn, body['doc_id'], json.dumps(body.get('metadata', {})), body.get('change_description'),
+            filename, body.get('size'),
+            body.get('chunk_size', app.config.get('UPLOAD_CHUNK_SIZE', resumable.DEFAULT_CHUNK_SIZE)),
+            body.get('checksum'), session_ttl()
+        )
+    except resumable.SessionError as e:
+        return jsonify({'error': str(e)}), e.status
+    except DatabaseBusyError:
+        return busy_response()
+    session['received'] = {}
+    response = jsonify(session_json(session))
+    response.headers['Location'] = f"/upload/sessions/{session['id']}"
+    return response, 201
+
+def find_session(session_id):
+    session = resumable.get_session(get_db_connection(), session_id)
+    if session is None:
+        abort(404)
+    return session
+
+@app.route('/upload/sessions/<session_id>', methods=['GET', 'HEAD'])
+def get_upload_session(session_id):
+    session = find_session(session_id)
+    response = jsonify(session_json(session))
+    response.headers['Upload-Offset'] = str(resumable.contiguous_offset(session))
+    response.headers['Upload-Length'] = str(session['total_size'])
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+def chunk_admission_cost(session_id):
+    # A chunk sent without a length is charged a whole chunk
+    session = resumable.get_session(get_db_connection(), session_id)
+    return body_bytes(unknown=session['chunk_size'] if session else None)
+
+def finalize_admission_cost(session_id):
+    # Finalizing copies the whole file to staging, besides the HTML parts in the body
+    session = resumable.get_session(get_db_connection(), session_id)
+    return body_bytes() + (session['total_size'] if session else 0)
+
+@app.route('/upload/sessions/<session_id>', methods=['PATCH'])
+@admission_required(cost=chunk_admission_cost)
+def upload_chunk(session_id):
+    session = find_session(session_id)
+    offset = request.headers.get('Upload-Offset', type=int)
+    try:
+        checksum = resumable.parse_checksum(request.headers.get('Upload-Checksum'))
+        resumable.store_chunk(get_db_connection(), get_storage(), session, offset, request.content_length,
+                              request.stream, checksum, session_ttl())
+    except resumable.SessionError as e:
+        return jsonify({'error': str(e)}), e.status
+    except DatabaseBusyError:
+        return busy_response()
+    response = Response(status=204)
+    response.headers['Upload-Offset'] = str(resumable.contiguous_offset(session))
+    return response
+
+@app.route('/upload/sessions/<session_id>', methods=['DELETE'])
+def delete_upload_session(session_id):
+    find_session(session_id)
+    try:
+        resumable.delete_session(get_db_connection(), get_storage(), session_id)
+    except DatabaseBusyError:
+        return busy_response()
+    return Response(status=204)
+
+@app.route('/upload/sessions/<session_id>/finalize', methods=['POST'])
+@admission_required(cost=finalize_admission_cost)
+def finalize_upload_session(session_id):
+    upload_started = time.perf_counter()
+    session = find_session(session_id)
+    missing = resumable.missing_chunks(session)
+    if missing:
+        return jsonify({'error': 'Upload is incomplete', 'missing': missing}), 409
+    html_files = [decode_file(f, max_decompressed_size()) for f in request.files.getlist('html_files')
+                  if f and allowed_file(f.filename)]
+
+    conn = get_db_connection()
+    storage = get_storage()
+    try:
+        if not resumable.claim_session(conn, session_id):
+            return jsonify({'error': 'Upload session is already being finalized'}), 409
+    except DatabaseBusyError:
+        return busy_response()
+    upload = None
+    try:
+        with StagedUpload(conn, storage, app.config['UPLOAD_FOLDER']) as upload:
+            chunks = resumable.ChunkReader(storage, session)
+            try:
+                file_path, file_size, checksum = upload.stage_stream(session['filename'], chunks, guess_mimetype(session['filename']))
+            finally:
+                chunks.close()
+            if session['checksum'] and checksum != session['checksum'].lower():
+                raise resumable.SessionError('File checksum mismatch', 460)
+            html_paths = [upload.stage(html_file) for html_file in html_files]
+
+            begin_immediate(conn)
+            cursor = conn.cursor()
+            version = store_version(cursor, session['doc_id'], json.loads(session['metadata']), session['change_description'],
+                                    (file_path, file_size, checksum), html_paths)
+            resumable.delete_session_rows(cursor, session_id)
+            upload.commit()
+    except resumable.SessionError as e:
+        return jsonify({'error': str(e)}), e.status
+    except DatabaseBusyError:
+        return busy_response()
+    except OSError:
+        return jsonify({'error': 'Could not store the uploaded file'}), 500
+    finally:
+        if upload is not None and upload.committed:
+            # The session rows went with the commit, so nothing would expire the chunks
+            resumable.delete_session_files(storage, session_id)
+        else:
+            # Whatever went wrong, reopen the session so finalizing can be retried
+            try:
+                resumable.release_session(conn, session_id)
+            except DatabaseBusyError:
+                pass  # left 'finalizing' until the session expires
+    record_upload(file_size, time.perf_counter() - upload_started)
+    return jsonify({'success': True, 'version': version}), 200
+
 @app.route('/documents/<doc_id>/versions/<int:version_number>', methods=['DELETE'])
 def delete_version(doc_id, version_number):
     success, message = delete_document_version(doc_id, version_number)
     if success:
+        wake_reaper(app)
         return jsonify({'success': True, 'message': message}), 200
     else:
         return jsonify({'success': False, 'error': message}), 400
 
-@app.route('/uploads/<filename>')
+@app.route('/documents/<doc_id>', methods=['DELETE'])
+def delete_whole_document(doc_id):
+    success, message = delete_document(doc_id)
+    if success:
+        wake_reaper(app)
+        return jsonify({'success': True, 'message': message}), 200
+    else:
+        return jsonify({'success': False, 'error': message}), 400
+
+def resolve_upload_key(storage, filename):
+    """Storage key of a file requested as ``/uploads/<filename>``.
+
+    Bare file names are looked up in the sharded layout first and then in
+    the flat one, so links keep working while files are being migrated.
+    """
+    if '/' not in filename:
+        sharded = shard_key(filename)
+        if storage.exists(sharded):
+            return sharded
+    return filename
+
+def find_stored_file(filename):
+    """The database row storing ``/uploads/<filename>``, with the download counted in memory."""
+    upload_folder = app.config['UPLOAD_FOLDER']
+    keys = [shard_key(filename), filename] if '/' not in filename else [filename]
+    conn = get_db_connection()
+    entry = tiering.find_file(conn, [storage_path(upload_folder, key) for key in keys])
+    if entry is not None:
+        tiering.get_access_counter(app).record(entry)
+    return entry
+
+@app.route('/uploads/<path:filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    storage = get_storage()
+    entry = find_stored_file(filename)
+    if entry is not None and entry['tier'] == 'cold':
+        if entry['access_count'] < app.config.get('TIERING_PROMOTE_AFTER', tiering.PROMOTE_AFTER):
+            return cold_file_response(storage, entry)
+        try:
+            tiering.promote(get_db_connection(), storage, app.config['UPLOAD_FOLDER'], entry)
+        except DatabaseBusyError:
+            return cold_file_response(storage, entry)  # promoted on a later download
+        tiering.get_access_counter(app).discard(entry)
+    try:
+        key = resolve_upload_key(storage, filename)
+        if isinstance(storage, LocalStorage):
+            return send_local_file(storage, key)
+        url = storage.presigned_url(key, filename=key.rsplit('/', 1)[-1])
+        if url:
+            return redirect(url)
+        info = storage.stat(key)
+    except ValueError:
+        abort(404)
+    if info is None:
+        abort(404)
+    # Backends without presigned URLs are proxied, honouring single ranges
+    byte_range = request.range.range_for_length(info.size) if request.range else None
+    if byte_range:
+        start, stop = byte_range
+        response = Response(storage.get_range(key, start, stop - start), 206, mimetype=guess_mimetype(key))
+        response.content_range = ContentRange('bytes', start, stop, info.size)
+    else:
+        stream = storage.get_stream(key)
+        response = Response(iter(lambda: stream.read(1024 * 1024), b''), mimetype=guess_mimetype(key))
+        response.call_on_close(stream.close)
+        response.content_length = info.size
+    response.accept_ranges = 'bytes'
+    return response
+
+
+def cold_file_response(storage, entry):
+    """Stream a cold file, decompressing its archive on the fly. Ranges are not supported."""
+    try:
+        reader = tiering.open_cold_file(storage, app.config['UPLOAD_FOLDER'], entry)
+    except (FileNotFoundError, ValueError):
+        abort(404)
+    response = Response(iter(lambda: reader.read(1024 * 1024), b''), mimetype=guess_mimetype(entry['file_path']))
+    response.call_on_close(reader.close)
+    if entry['file_size'] is not None:
+        response.content_length = entry['file_size']
+    return response
+
+def guess_mimetype(filename):
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+
+def parse_metadata_filters(args):
+    """Turn ``filter[key]=v`` and ``filter[key][op]=v`` query args into filter tuples."""
+    filters = []
+    for arg, value in args.items(multi=True):
+        match = FILTER_ARG_PATTERN.match(arg)
+        if match:
+            key, operator = match.group(1), match.group(2) or 'eq'
+            if operator == 'in':
+                value = [v for v in value.split(',') if v != '']
+            filters.append((key, operator, value))
+    return filters
+
+
+def documents_response(document_jsons):
+    # Each document is already serialized by SQLite; splice it in as-is.
+    return jsonify([RawJSON(document_json) for document_json in document_jsons])
 
 
 @app.route('/documents')
 def get_documents():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM documents ORDER BY id DESC')
-    documents = cursor.fetchall()
-
-    results = []
-    for doc in documents:
-        doc_dict = dict(doc)
-        doc_dict['metadata'] = json.loads(doc_dict['metadata'])
-        cursor.execute('SELECT * FROM versions WHERE document_id = ? ORDER BY version DESC', (doc['id'],))
-        versions = cursor.fetchall()
-        versions_list = []
-        for v in versions:
-            v_dict = dict(v)
-            v_dict['file_consistent'] = check_file_consistency(v_dict['file_path'])
-            cursor.execute('SELECT file_path FROM html_documents WHERE version_id = ?', (v['id'],))
-            html_docs = cursor.fetchall()
-            v_dict['html_paths'] = []
-            for hp in html_docs:
-                html_path_str = hp['file_path']
-                v_dict['html_paths'].append({
-                    'path': html_path_str,
-                    'consistent': check_file_consistency(html_path_str)
-                })
-            versions_list.append(v_dict)
-        doc_dict['versions'] = versions_list
-        results.append(doc_dict)
-
-    return jsonify(results)
+    # Read before the listing, so a client following /changes from this
+    # sequence number cannot miss a change made while the listing runs.
+    seq = latest_change_seq()
+    try:
+        document_jsons = query_documents_json(
+            filters=parse_metadata_filters(request.args),
+            sort=request.args.get('sort'),
+            file_consistent=check_file_consistency
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    response = documents_response(document_jsons)
+    response.headers['X-Catalog-Seq'] = str(seq)
+    return response
+
+
+@app.route('/documents/<doc_id>')
+def get_document(doc_id):
+    document_jsons = query_documents_json(where='d.doc_id = ?', params=(doc_id,), file_consistent=check_file_consistency)
+    if not document_jsons:
+        return jsonify({'error': 'Document not found.'}), 404
+    return jsonify(RawJSON(document_jsons[0]))
+
+
+@app.route('/documents/<doc_id>/similar')
+def similar_documents(doc_id):
+    k = request.args.get('k', similarity.DEFAULT_K, type=int)
+    if not 1 <= k <= similarity.MAX_K:
+        return jsonify({'error': f"'k' must be between 1 and {similarity.MAX_K}"}), 400
+    if similarity.np is None:
+        return jsonify({'error': 'Similarity search needs numpy installed'}), 501
+    try:
+        results = similarity.find_similar(app, get_db_connection(), doc_id, k)
+    except similarity.IndexNotReady as e:
+        response = jsonify({'error': str(e)})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+    if results is None:
+        return jsonify({'error': 'Document not found.'}), 404
+    return jsonify({'doc_id': doc_id, 'similar': [{'doc_id': other, 'score': round(score, 4)} for other, score in results]})
+
+
+def parse_change_args(args):
+    since = args.get('since', 0, type=int)
+    limit = args.get('limit', 100, type=int)
+    if since < 0 or not 1 <= limit <= MAX_CHANGES_LIMIT:
+        raise ValueError(f"'since' must be >= 0 and 'limit' between 1 and {MAX_CHANGES_LIMIT}")
+    return since, limit
+
+
+@app.route('/changes')
+def changes():
+    try:
+        since, limit = parse_change_args(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    entries = get_changes(since, limit + 1)
+    return jsonify({
+        'changes': entries[:limit],
+        'next_since': entries[:limit][-1]['seq'] if entries else since,
+        'has_more': len(entries) > limit,
+    })
+
+
+@app.route('/changes/stream')
+def change_stream():
+    """Server-Sent Events feed of catalog changes.
+
+    Resumes after the ``Last-Event-ID`` header sent by reconnecting
+    EventSource clients, or after ``since``. The stream ends after
+    CHANGE_STREAM_MAX_SECONDS so proxies and workers are not held forever;
+    EventSource reconnects automatically.
+    """
+    try:
+        since = int(request.headers.get('Last-Event-ID') or request.args.get('since', 0))
+    except ValueError:
+        return jsonify({'error': "'since' must be an integer"}), 400
+    database = app.config.get('DATABASE') or DATABASE_NAME
+    poll_seconds = app.config.get('CHANGE_STREAM_POLL_SECONDS', 1.0)
+    max_seconds = app.config.get('CHANGE_STREAM_MAX_SECONDS', 300)
+    keepalive_seconds = app.config.get('CHANGE_STREAM_KEEPALIVE_SECONDS', 15)
+
+    def events():
+        conn = get_db_connection(database)
+        last_seq = since
+        started = last_sent = time.monotonic()
+        try:
+            yield 'retry: 2000\n\n'
+            while True:
+                batch = get_changes(last_seq, MAX_CHANGES_LIMIT, conn=conn)
+                for change in batch:
+                    last_seq = change['seq']
+                    last_sent = time.monotonic()
+                    yield f"id: {last_seq}\nevent: change\ndata: {json.dumps(change)}\n\n"
+                now = time.monotonic()
+                if now - started >= max_seconds:
+                    break
+                if now - last_sent >= keepalive_seconds:
+                    last_sent = now
+                    yield ': keepalive\n\n'
+                if len(batch) < MAX_CHANGES_LIMIT:
+                    time.sleep(poll_seconds)
+        finally:
+            conn.close()
+
+    return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/metadata_keys')
+def metadata_keys():
+    return jsonify(get_metadata_keys())
 
 
 @app.route('/search')
 def search():
+    metrics.increment('search_requests')
     query = request.args.get('q', '')
     if not query:
         return jsonify([])
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Search in documents table
-    cursor.execute("SELECT * FROM documents WHERE metadata LIKE ?", (f'%{query}%',))
-    documents = cursor.fetchall()
-
-    # Search in versions table
-    cursor.execute("SELECT document_id FROM versions WHERE change_description LIKE ?", (f'%{query}%',))
-    version_doc_ids = [row['document_id'] for row in cursor.fetchall()]
-
-    # Combine results
-    doc_ids = set([doc['id'] for doc in documents])
-    doc_ids.update(version_doc_ids)
-
-    results = []
-    for doc_id in doc_ids:
-        cursor.execute("SELECT * FROM documents WHERE id = ?", (doc_id,))
-        doc = cursor.fetchone()
-        if doc:
-            doc_dict = dict(doc)
-            doc_dict['metadata'] = json.loads(doc_dict['metadata'])
-            cursor.execute('SELECT * FROM versions WHERE document_id = ? ORDER BY version DESC', (doc['id'],))
-            versions = cursor.fetchall()
-            versions_list = []
-            for v in versions:
-                v_dict = dict(v)
-                v_dict['file_consistent'] = check_file_consistency(v_dict['file_path'])
-                cursor.execute('SELECT file_path FROM html_documents WHERE version_id = ?', (v['id'],))
-                html_docs = cursor.fetchall()
-                v_dict['html_paths'] = []
-                for hp in html_docs:
-                    html_path_str = hp['file_path']
-                    v_dict['html_paths'].append({
-                        'path': html_path_str,
-                        'consistent': check_file_consistency(html_path_str)
-                    })
-                versions_list.append(v_dict)
-            doc_dict['versions'] = versions_list
-            results.append(doc_dict)
+    pattern = f'%{query}%'
+    document_jsons = query_documents_json(
+        where='d.metadata LIKE ? OR d.id IN (SELECT document_id FROM versions WHERE change_description LIKE ?)',
+        params=(pattern, pattern),
+        file_consistent=check_file_consistency
+    )
+    return documents_response(document_jsons)
 
-    return jsonify(results)
+
+@app.route('/suggest')
+def suggestions():
+    limit = request.args.get('limit', suggest.DEFAULT_LIMIT, type=int)
+    if not 1 <= limit <= suggest.MAX_LIMIT:
+        return jsonify({'error': f"'limit' must be between 1 and {suggest.MAX_LIMIT}"}), 400
+    query = request.args.get('q', '')
+    try:
+        return jsonify({'query': query, 'suggestions': suggest.suggest_app(app, query, limit)})
+    except suggest.IndexNotReady as e:
+        response = jsonify({'error': str(e)})
+        response.headers['Retry-After'] = '1'
+        return response, 503
+
+
+@app.route('/stats')
+def stats():
+    return jsonify({'counters': metrics.get_counters(), 'gauges': metrics.get_gauges(), 'timings': metrics.get_timings()})
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return app.response_class(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+def admin_required(view):
+    """Decorator for /admin/ views: they exist only when ADMIN_TOKEN is set, and require it.
+
+    The token is sent as ``Authorization: Bearer <token>`` or ``X-Admin-Token``.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        token = app.config.get('ADMIN_TOKEN')
+        if not token:
+            abort(404)
+        authorization = request.headers.get('Authorization', '')
+        supplied = authorization[7:] if authorization.startswith('Bearer ') else request.headers.get('X-Admin-Token', '')
+        if not hmac.compare_digest(supplied.encode(), str(token).encode()):
+            return jsonify({'error': 'A valid admin token is required.'}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.route('/admin/slow_queries')
+@admin_required
+def slow_queries():
+    limit = request.args.get('limit', 10, type=int)
+    return jsonify(slow_query_log.top(limit))
+
+@app.route('/admin/integrity')
+@admin_required
+def integrity_report():
+    if not isinstance(get_storage(), LocalStorage):
+        return jsonify({'error': 'Integrity scans need the local storage backend'}), 400
+    verify_hashes = request.args.get('hashes', '1') not in ('0', 'false')
+    max_seconds = request.args.get('max_seconds', app.config.get('INTEGRITY_MAX_SECONDS', 30), type=float)
+    report = integrity.scan(
+        get_db_connection(),
+        os.path.join(app.root_path, app.config['UPLOAD_FOLDER']),
+        base_dir=app.root_path,
+        workers=app.config.get('INTEGRITY_WORKERS'),
+        verify_hashes=verify_hashes,
+        checkpoint_path=app.config.get('INTEGRITY_CHECKPOINT'),
+        max_seconds=max_seconds,
+    )
+    return jsonify(report)
+
+@app.route('/admin/backups', methods=['GET'])
+@admin_required
+def backups():
+    return jsonify(list_backups(app.config.get('BACKUP_DIR', DEFAULT_BACKUP_DIR)))
+
+@app.route('/admin/backups', methods=['POST'])
+@admin_required
+def create_backup_now():
+    try:
+        manifest = backup_app(app)
+    except BackupInProgress as e:
+        return jsonify({'error': str(e)}), 409
+    return jsonify(manifest), 201
+
+@app.route('/admin/backups/<name>')
+@admin_required
+def backup_file(name):
+    return send_from_directory(app.config.get('BACKUP_DIR', DEFAULT_BACKUP_DIR), name, as_attachment=True)
+
+@app.route('/admin/profiles')
+@admin_required
+def profiles():
+    return jsonify(list_profiles(app.config.get('PROFILE_DIR', DEFAULT_PROFILE_DIR)))
+
+@app.route('/admin/profiles/<name>')
+@admin_required
+def profile_file(name):
+    return send_from_directory(app.config.get('PROFILE_DIR', DEFAULT_PROFILE_DIR), name, as_attachment=True)
 
 if __name__ == '__main__':
     app.run(debug=True)
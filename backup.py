@@ -0,0 +1,291 @@
+"""Online snapshots of the SQLite database.
+
+Snapshots are taken with the ``sqlite3`` online backup API, ``pages`` pages
+per step with a short pause between steps. The source is only read-locked
+while a step runs, so uploads and votes keep committing during a backup.
+SQLite restarts the copy when another connection writes between steps;
+after ``max_restarts`` restarts the rest is copied in a single step, which
+bounds the backup time on a busy database at the cost of one longer read
+lock.
+
+Every snapshot ``<prefix>-<UTC timestamp>.db`` is written next to a
+manifest ``<same name>.json``. The manifest records the snapshot's
+SHA-256 and, optionally, the upload files the snapshot references, with
+their recorded size and checksum and whether they existed when the
+snapshot was taken. Only the newest ``keep`` snapshots are kept.
+
+Usage::
+
+    python backup.py --database pdf_browser.db --backup-dir backups --keep 7
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from database import DATABASE_NAME
+from storage import get_storage, storage_key
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BACKUP_DIR = 'backups'
+BACKUP_PAGES = 256
+BACKUP_STEP_SLEEP_SECONDS = 0.01
+BACKUP_KEEP = 7
+BACKUP_MAX_RESTARTS = 3
+HASH_CHUNK_SIZE = 1024 * 1024
+
+_backup_lock = threading.Lock()
+
+
+class BackupInProgress(Exception):
+    """Another backup is already running in this process."""
+
+
+class _TooManyRestarts(Exception):
+    pass
+
+
+def _copy_database(source, target, pages, step_sleep, max_restarts):
+    restarts = 0
+    previous_remaining = None
+
+    def progress(status, remaining, total):
+        nonlocal restarts, previous_remaining
+        if previous_remaining is not None and remaining > previous_remaining:
+            restarts += 1
+            if restarts > max_restarts:
+                raise _TooManyRestarts()
+        previous_remaining = remaining
+        # Pausing here releases the source between steps
+        time.sleep(step_sleep)
+
+    try:
+        source.backup(target, pages=pages, progress=progress)
+    except _TooManyRestarts:
+        logger.info("Database kept changing during the incremental backup; copying it in one step")
+        source.backup(target, pages=-1)
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _write_json(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def referenced_files(conn, file_exists=None):
+    """Upload files referenced by the database, with what was recorded at upload.
+
+    Cold files are listed at their archive path; size and checksum are
+    those of the original.
+    """
+    files = []
+    for table in ('versions', 'html_documents'):
+        for path, size, checksum in conn.execute(f'SELECT COALESCE(archive_path, file_path), file_size, checksum FROM {table} ORDER BY id'):
+            entry = {'path': path, 'size': size, 'checksum': checksum}
+            if file_exists is not None:
+                entry['exists'] = bool(file_exists(path))
+            files.append(entry)
+    return files
+
+
+def create_backup(database, backup_dir=DEFAULT_BACKUP_DIR, pages=BACKUP_PAGES, step_sleep=BACKUP_STEP_SLEEP_SECONDS,
+                  keep=BACKUP_KEEP, manifest_files=True, file_exists=os.path.exists, max_restarts=BACKUP_MAX_RESTARTS):
+    """Snapshot ``database`` into ``backup_dir`` and rotate old snapshots.
+
+    ``file_exists`` is called with each referenced file path when
+    ``manifest_files`` is true. Returns the manifest without its file list.
+    Raises BackupInProgress if a backup is already running.
+    """
+    if not _backup_lock.acquire(blocking=False):
+        raise BackupInProgress("A backup is already running")
+    try:
+        os.makedirs(backup_dir, exist_ok=True)
+        started = time.perf_counter()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        prefix = os.path.splitext(os.path.basename(database))[0]
+        name = f"{prefix}-{now.strftime('%Y%m%dT%H%M%S%fZ')}.db"
+        path = os.path.join(backup_dir, name)
+        tmp_path = path + '.tmp'
+
+        source = sqlite3.connect(database)
+        target = sqlite3.connect(tmp_path)
+        try:
+            _copy_database(source, target, pages, step_sleep, max_restarts)
+            check = target.execute('PRAGMA quick_check').fetchone()[0]
+            if check != 'ok':
+                raise sqlite3.DatabaseError(f"Snapshot failed quick_check: {check}")
+            files = referenced_files(target, file_exists) if manifest_files else None
+        except BaseException:
+            target.close()
+            os.remove(tmp_path)
+            raise
+        finally:
+            source.close()
+        target.close()
+        os.replace(tmp_path, path)
+
+        manifest = {
+            'snapshot': name,
+            'source': os.path.abspath(database),
+            'created_at': now.isoformat(),
+            'size': os.path.getsize(path),
+            'sha256': _sha256(path),
+            'duration_seconds': time.perf_counter() - started,
+        }
+        if files is not None:
+            manifest['file_count'] = len(files)
+            manifest['missing_files'] = sum(1 for f in files if f.get('exists') is False)
+            manifest['files'] = files
+        _write_json(os.path.splitext(path)[0] + '.json', manifest)
+        rotate_backups(backup_dir, keep, prefix)
+        logger.info("Backed up %s to %s in %.2fs", database, path, manifest['duration_seconds'])
+        manifest.pop('files', None)
+        return manifest
+    finally:
+        _backup_lock.release()
+
+
+def _snapshot_names(backup_dir, prefix=None):
+    try:
+        names = os.listdir(backup_dir)
+    except FileNotFoundError:
+        return []
+    return sorted(name for name in names
+                  if name.endswith('.db') and (prefix is None or name.startswith(prefix + '-')))
+
+
+def rotate_backups(backup_dir, keep, prefix=None):
+    """Delete all but the newest ``keep`` snapshots and their manifests."""
+    names = _snapshot_names(backup_dir, prefix)
+    for name in names[:max(len(names) - keep, 0)]:
+        for path in (os.path.join(backup_dir, name), os.path.join(backup_dir, name[:-3] + '.json')):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def load_manifest(backup_dir, name):
+    with open(os.path.join(backup_dir, name[:-3] + '.json')) as f:
+        return json.load(f)
+
+
+def list_backups(backup_dir):
+    """Snapshots in ``backup_dir``, newest first, with their manifest summary."""
+    backups = []
+    for name in reversed(_snapshot_names(backup_dir)):
+        try:
+            manifest = load_manifest(backup_dir, name)
+        except (OSError, ValueError):
+            manifest = {'snapshot': name}
+        manifest.pop('files', None)
+        backups.append(manifest)
+    return backups
+
+
+def verify_backup(backup_dir, name):
+    """True if the snapshot still matches the checksum in its manifest."""
+    return _sha256(os.path.join(backup_dir, name)) == load_manifest(backup_dir, name)['sha256']
+
+
+class BackupScheduler:
+    """Background thread that calls ``backup()`` every ``interval`` seconds."""
+
+    def __init__(self, backup, interval):
+        self.backup = backup
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='backup-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.backup()
+            except BackupInProgress:
+                pass
+            except Exception:
+                logger.exception("Scheduled backup failed")
+
+
+def init_backup(app):
+    """Start scheduled backups on the first request when BACKUP_INTERVAL_SECONDS is set.
+
+    They are not started for testing apps, whose database changes between tests.
+    """
+    lock = threading.Lock()
+
+    def start_once():
+        if 'backup_scheduler' in app.extensions or app.testing or not app.config.get('BACKUP_INTERVAL_SECONDS'):
+            return
+        with lock:
+            if 'backup_scheduler' in app.extensions:
+                return
+            scheduler = BackupScheduler(lambda: backup_app(app), app.config['BACKUP_INTERVAL_SECONDS'])
+            scheduler.start()
+            app.extensions['backup_scheduler'] = scheduler
+
+    app.before_request(start_once)
+
+
+def backup_app(app):
+    """create_backup with the app's BACKUP_* settings and storage backend."""
+    return create_backup(
+        app.config.get('DATABASE') or DATABASE_NAME,
+        backup_dir=app.config.get('BACKUP_DIR', DEFAULT_BACKUP_DIR),
+        pages=app.config.get('BACKUP_PAGES', BACKUP_PAGES),
+        step_sleep=app.config.get('BACKUP_STEP_SLEEP_SECONDS', BACKUP_STEP_SLEEP_SECONDS),
+        keep=app.config.get('BACKUP_KEEP', BACKUP_KEEP),
+        manifest_files=app.config.get('BACKUP_MANIFEST_FILES', True),
+        file_exists=lambda path: get_storage(app).exists_cached(storage_key(path, app.config['UPLOAD_FOLDER'])),
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Take an online snapshot of the database.")
+    parser.add_argument("--database", default=DATABASE_NAME, help="SQLite database file.")
+    parser.add_argument("--backup-dir", default=DEFAULT_BACKUP_DIR, help="Directory for snapshots and manifests.")
+    parser.add_argument("--keep", type=int, default=BACKUP_KEEP, help="Number of snapshots to keep.")
+    parser.add_argument("--pages", type=int, default=BACKUP_PAGES, help="Pages copied per backup step.")
+    parser.add_argument("--no-files", action="store_true", help="Do not list referenced upload files in the manifest.")
+    parser.add_argument("--verify", metavar="SNAPSHOT", help="Check a snapshot against its manifest instead.")
+    args = parser.parse_args(argv)
+
+    if args.verify:
+        ok = verify_backup(args.backup_dir, args.verify)
+        print("OK" if ok else "CHECKSUM MISMATCH")
+        return 0 if ok else 1
+    manifest = create_backup(args.database, args.backup_dir, pages=args.pages, keep=args.keep,
+                             manifest_files=not args.no_files)
+    print(json.dumps(manifest, indent=2))
+    return 1 if manifest.get('missing_files') else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,87 @@
+"""Command line entry point for the benchmark suite.
+
+Usage::
+
+    python -m benchmarks run --documents 10000 --output results.json
+    python -m benchmarks compare baseline.json results.json --threshold 0.1
+"""
+import argparse
+import json
+import sys
+
+from benchmarks.suite import SCENARIOS, compare_results, run_suite
+
+
+def run_command(args):
+    results = run_suite(
+        scenarios=args.scenario,
+        rounds=args.rounds,
+        warmup=args.warmup,
+        seed=args.seed,
+        documents=args.documents,
+        versions_per_document=args.versions,
+        html_per_version=args.html,
+        metadata_keys=args.metadata_keys,
+        metadata_cardinality=args.metadata_cardinality,
+        votes=args.votes,
+        write_files=args.write_files,
+    )
+    body = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(body + '\n')
+    else:
+        print(body)
+    for bench in results['benchmarks']:
+        stats = bench['stats']
+        print(f"{bench['name']:<24}median {stats['median'] * 1000:>10.3f} ms"
+              f"  min {stats['min'] * 1000:>10.3f} ms  ops {stats['ops']:>10.1f}", file=sys.stderr)
+    return 0
+
+
+def compare_command(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    rows = compare_results(baseline, current, stat=args.stat, threshold=args.threshold)
+    print(f"{'scenario':<24}{'baseline (ms)':>15}{'current (ms)':>15}{'ratio':>9}")
+    for row in rows:
+        ratio = f"{row['ratio']:.2f}x" if row['ratio'] is not None else 'n/a'
+        flag = '  REGRESSION' if row['regression'] else ''
+        print(f"{row['name']:<24}{row['baseline'] * 1000:>15.3f}{row['current'] * 1000:>15.3f}{ratio:>9}{flag}")
+    return 1 if any(row['regression'] for row in rows) else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description="Benchmark the PDF browser against a synthetic catalog.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help="Run the scenarios and emit JSON results.")
+    run_parser.add_argument("--documents", type=int, default=10000, help="Number of synthetic documents.")
+    run_parser.add_argument("--versions", type=int, default=2, help="Versions per document.")
+    run_parser.add_argument("--html", type=int, default=1, help="HTML files per version.")
+    run_parser.add_argument("--metadata-keys", type=int, default=5, help="Extra metadata keys per document.")
+    run_parser.add_argument("--metadata-cardinality", type=int, default=500, help="Distinct values per metadata key.")
+    run_parser.add_argument("--votes", type=int, default=10000, help="Number of votes.")
+    run_parser.add_argument("--write-files", action="store_true", help="Write dummy files to the upload folder.")
+    run_parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="Scenario to run; repeat for several. Defaults to all.")
+    run_parser.add_argument("--rounds", type=int, default=20, help="Timed rounds per scenario.")
+    run_parser.add_argument("--warmup", type=int, default=2, help="Untimed rounds before each scenario.")
+    run_parser.add_argument("--seed", type=int, default=0, help="Random seed for the catalog and requests.")
+    run_parser.add_argument("--output", help="Write JSON results to this file instead of stdout.")
+    run_parser.set_defaults(func=run_command)
+
+    compare_parser = subparsers.add_parser('compare', help="Compare two JSON result files.")
+    compare_parser.add_argument("baseline", help="Results from the reference commit.")
+    compare_parser.add_argument("current", help="Results to check.")
+    compare_parser.add_argument("--stat", default='median', choices=['min', 'mean', 'median', 'max'], help="Statistic to compare.")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="Allowed slowdown as a fraction before failing.")
+    compare_parser.set_defaults(func=compare_command)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,108 @@
+"""Synthetic catalog generator for benchmarks.
+
+Fills a database with a configurable number of documents, versions per
+document, HTML files per version, metadata keys and votes using bulk
+``executemany`` inserts. The output is deterministic for a given seed so
+results can be compared across commits. Optionally writes small dummy
+files to the upload folder so file consistency checks hit real files.
+"""
+import json
+import os
+import random
+import sqlite3
+
+from database import create_tables, rebuild_metadata_keys
+
+STATUSES = ['draft', 'review', 'published', 'archived']
+WORDS = ['annual', 'report', 'contract', 'invoice', 'summary', 'draft', 'policy', 'manual',
+         'review', 'budget', 'proposal', 'minutes', 'release', 'notes', 'spec', 'audit']
+
+DUMMY_PDF = b'%PDF-1.4\n1 0 obj << /Type /Catalog >> endobj\ntrailer << /Root 1 0 R >>\n%%EOF\n'
+DUMMY_HTML = b'<html><body><p>Synthetic document</p></body></html>\n'
+
+
+def make_metadata(rng, index, metadata_keys, cardinality):
+    """Metadata for one document.
+
+    Always has ``name``, ``author``, ``year`` and ``status``; ``metadata_keys``
+    extra keys ``field_0``..``field_N`` each take one of ``cardinality`` values.
+    """
+    metadata = {
+        'name': f"{rng.choice(WORDS)} {rng.choice(WORDS)} {index}",
+        'author': f'author-{rng.randrange(cardinality)}',
+        'year': 1990 + rng.randrange(35),
+        'status': rng.choice(STATUSES),
+    }
+    for k in range(metadata_keys):
+        metadata[f'field_{k}'] = f'value-{rng.randrange(cardinality)}'
+    return metadata
+
+
+def generate_catalog(database_path, documents=1000, versions_per_document=1, html_per_version=1,
+                     metadata_keys=0, metadata_cardinality=500, votes=0, upload_folder='uploads',
+                     write_files=False, index_min_docs=None, seed=0):
+    """Create the schema in ``database_path`` and fill it with synthetic rows.
+
+    Returns a summary dict with the row counts and parameters used.
+    """
+    rng = random.Random(seed)
+    if write_files:
+        os.makedirs(upload_folder, exist_ok=True)
+
+    conn = sqlite3.connect(database_path)
+    conn.row_factory = sqlite3.Row
+    create_tables(conn)
+
+    conn.executemany(
+        'INSERT INTO documents (id, doc_id, metadata, latest_version) VALUES (?, ?, ?, ?)',
+        ((i, f'doc-{i}', json.dumps(make_metadata(rng, i, metadata_keys, metadata_cardinality)), versions_per_document)
+         for i in range(1, documents + 1))
+    )
+
+    version_rows = []
+    html_rows = []
+    files = []
+    version_id = 0
+    for doc in range(1, documents + 1):
+        for version in range(1, versions_per_document + 1):
+            version_id += 1
+            pdf_path = os.path.join(upload_folder, f'doc-{doc}-v{version}.pdf')
+            version_rows.append((version_id, doc, version, f'{rng.choice(WORDS)} changes', pdf_path))
+            files.append((pdf_path, DUMMY_PDF))
+            for h in range(html_per_version):
+                html_path = os.path.join(upload_folder, f'doc-{doc}-v{version}-{h}.html')
+                html_rows.append((version_id, html_path))
+                files.append((html_path, DUMMY_HTML))
+    conn.executemany(
+        'INSERT INTO versions (id, document_id, version, change_description, file_path) VALUES (?, ?, ?, ?, ?)',
+        version_rows
+    )
+    conn.executemany('INSERT INTO html_documents (version_id, file_path) VALUES (?, ?)', html_rows)
+
+    if votes and version_rows:
+        vote_rows = []
+        for _ in range(votes):
+            version_id, doc, _version, _desc, _path = rng.choice(version_rows)
+            vote_rows.append((doc, version_id, rng.choice(['good', 'bad']), f'10.0.{rng.randrange(256)}.{rng.randrange(256)}'))
+        conn.executemany('INSERT INTO votes (document_id, version_id, vote_type, voter_info) VALUES (?, ?, ?, ?)',
+                         vote_rows)
+
+    conn.commit()
+    rebuild_metadata_keys(conn, index_min_docs=index_min_docs)
+    conn.close()
+
+    if write_files:
+        for path, content in files:
+            with open(path, 'wb') as f:
+                f.write(content)
+
+    return {
+        'documents': documents,
+        'versions': len(version_rows),
+        'html_documents': len(html_rows),
+        'votes': votes if version_rows else 0,
+        'metadata_keys': metadata_keys,
+        'metadata_cardinality': metadata_cardinality,
+        'write_files': write_files,
+        'seed': seed,
+    }
@@ -0,0 +1,340 @@
+"""Concurrent load generator for the HTTP API.
+
+Worker threads replay a weighted traffic mix against a running server:
+by default 80% listing/search, 15% votes and 5% uploads/deletes. The
+run reports throughput, latency percentiles and error rates per route.
+Operations that had nothing to do (no version to vote on or delete) are
+reported apart, as ``<operation>:noop``. It fails if any configured SLO threshold is breached.
+
+Usage::
+
+    python -m benchmarks.loadgen --url http://127.0.0.1:5000 --duration 30 --concurrency 16
+    python -m benchmarks.loadgen --serve --documents 5000 --requests 2000 --slo-p95-ms 250
+"""
+import argparse
+import contextlib
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import requests
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from benchmarks.generator import generate_catalog
+
+DEFAULT_MIX = {
+    'list_documents': 40,
+    'search': 40,
+    'vote': 15,
+    'upload': 3,
+    'delete_version': 2,
+}
+
+SEARCH_TERMS = ['report', 'draft', 'annual', 'policy', 'invoice', 'notes']
+UPLOAD_PAYLOAD = b'%PDF-1.4\n' + b'0' * 32 * 1024 + b'\n%%EOF\n'
+
+
+class LoadState:
+    """Documents known to the workers, shared between threads."""
+
+    def __init__(self, versions):
+        self.lock = threading.Lock()
+        # (doc_id, version) pairs that can be voted on
+        self.versions = list(versions)
+        # Documents created by this run, which are the only ones deleted
+        self.uploaded = []
+
+    def random_version(self, rng):
+        with self.lock:
+            return rng.choice(self.versions) if self.versions else None
+
+    def add_upload(self, doc_id):
+        with self.lock:
+            self.uploaded.append(doc_id)
+            self.versions.append((doc_id, 1))
+
+    def pop_upload(self):
+        with self.lock:
+            if not self.uploaded:
+                return None
+            doc_id = self.uploaded.pop()
+            self.versions.remove((doc_id, 1))
+            return doc_id
+
+
+def _list_documents(session, base_url, state, rng):
+    return session.get(f'{base_url}/documents')
+
+def _search(session, base_url, state, rng):
+    return session.get(f'{base_url}/search', params={'q': rng.choice(SEARCH_TERMS)})
+
+def _vote(session, base_url, state, rng):
+    target = state.random_version(rng)
+    if target is None:
+        return None
+    doc_id, version = target
+    return session.post(f'{base_url}/vote', json={
+        'doc_id': doc_id, 'version': version, 'vote_type': rng.choice(['good', 'bad'])
+    })
+
+def _upload(session, base_url, state, rng):
+    doc_id = f'loadgen-{uuid.uuid4().hex}'
+    response = session.post(f'{base_url}/upload', data={
+        'doc_id': doc_id,
+        'metadata': json.dumps({'name': f'load test {doc_id}', 'status': 'draft'}),
+        'change_description': 'load test upload',
+    }, files={'file': ('load.pdf', UPLOAD_PAYLOAD, 'application/pdf')})
+    if response.ok:
+        state.add_upload(doc_id)
+    return response
+
+def _delete_version(session, base_url, state, rng):
+    doc_id = state.pop_upload()
+    if doc_id is None:
+        return None  # nothing of ours to delete yet
+    return session.delete(f'{base_url}/documents/{doc_id}/versions/1')
+
+OPERATIONS = {
+    'list_documents': _list_documents,
+    'search': _search,
+    'vote': _vote,
+    'upload': _upload,
+    'delete_version': _delete_version,
+}
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not ordered:
+        return None
+    rank = math.ceil(fraction * len(ordered))
+    return ordered[max(0, min(len(ordered), rank) - 1)]
+
+
+def parse_mix(text):
+    """Parse ``name=weight,name=weight`` into a traffic mix dict."""
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError(f"Unknown operation '{name}'. Choose from: {', '.join(OPERATIONS)}")
+        mix[name] = float(weight)
+    return mix
+
+
+def discover_versions(base_url, session=None):
+    session = session or requests.Session()
+    response = session.get(f'{base_url}/documents')
+    response.raise_for_status()
+    return [(doc['doc_id'], v['version']) for doc in response.json() for v in doc['versions']]
+
+
+def run_load(base_url, mix=None, concurrency=8, duration=None, total_requests=None, seed=0):
+    """Replay ``mix`` against ``base_url`` from ``concurrency`` threads.
+
+    Stops after ``duration`` seconds or ``total_requests`` requests,
+    whichever comes first (at least one must be given). Returns a
+    JSON-serializable summary.
+    """
+    if duration is None and total_requests is None:
+        raise ValueError("Either duration or total_requests is required")
+    mix = mix or DEFAULT_MIX
+    names = [name for name, weight in mix.items() if weight > 0]
+    weights = [mix[name] for name in names]
+
+    state = LoadState(discover_versions(base_url))
+    samples = []  # (operation, latency_seconds, ok)
+    samples_lock = threading.Lock()
+    counter = {'issued': 0}
+    deadline = time.perf_counter() + duration if duration is not None else None
+
+    def next_ticket():
+        with samples_lock:
+            if total_requests is not None and counter['issued'] >= total_requests:
+                return False
+            counter['issued'] += 1
+            return True
+
+    def worker(worker_id):
+        rng = random.Random(f'{seed}-{worker_id}')
+        session = requests.Session()
+        local = []
+        while (deadline is None or time.perf_counter() < deadline) and next_ticket():
+            name = rng.choices(names, weights)[0]
+            start = time.perf_counter()
+            label = name
+            try:
+                response = OPERATIONS[name](session, base_url, state, rng)
+                if response is None:
+                    # Nothing to vote on or delete, so no request was sent;
+                    # kept out of the operation's latency and error rate
+                    label = f'{name}:noop'
+                ok = response is None or response.status_code < 400
+            except requests.RequestException:
+                ok = False
+            local.append((label, time.perf_counter() - start, ok))
+        session.close()
+        with samples_lock:
+            samples.extend(local)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    return summarize_samples(samples, elapsed, concurrency)
+
+
+def _route_summary(latencies, errors, elapsed):
+    ordered = sorted(latencies)
+    count = len(ordered)
+    return {
+        'requests': count,
+        'errors': errors,
+        'error_rate': errors / count if count else 0.0,
+        'throughput': count / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(ordered, 0.50) * 1000 if count else None,
+        'p95_ms': percentile(ordered, 0.95) * 1000 if count else None,
+        'p99_ms': percentile(ordered, 0.99) * 1000 if count else None,
+        'max_ms': ordered[-1] * 1000 if count else None,
+    }
+
+
+def summarize_samples(samples, elapsed, concurrency):
+    """Per-operation and overall summaries; ``<operation>:noop`` samples are left out of the overall one."""
+    requests_sent = [sample for sample in samples if not sample[0].endswith(':noop')]
+    routes = {}
+    for name in sorted({name for name, _, _ in samples}):
+        latencies = [seconds for n, seconds, _ in samples if n == name]
+        errors = sum(1 for n, _, ok in samples if n == name and not ok)
+        routes[name] = _route_summary(latencies, errors, elapsed)
+    return {
+        'duration_seconds': elapsed,
+        'concurrency': concurrency,
+        'overall': _route_summary([s for _, s, _ in requests_sent], sum(1 for _, _, ok in requests_sent if not ok), elapsed),
+        'routes': routes,
+    }
+
+
+def check_slos(results, p95_ms=None, p99_ms=None, max_error_rate=None, min_throughput=None):
+    """Return a list of human-readable SLO violations (empty when all pass).
+
+    Latency and error-rate limits apply to every route; the throughput
+    floor applies to the whole run.
+    """
+    violations = []
+    for name, route in results['routes'].items():
+        if p95_ms is not None and route['p95_ms'] is not None and route['p95_ms'] > p95_ms:
+            violations.append(f"{name}: p95 {route['p95_ms']:.1f} ms > {p95_ms} ms")
+        if p99_ms is not None and route['p99_ms'] is not None and route['p99_ms'] > p99_ms:
+            violations.append(f"{name}: p99 {route['p99_ms']:.1f} ms > {p99_ms} ms")
+        if max_error_rate is not None and route['error_rate'] > max_error_rate:
+            violations.append(f"{name}: error rate {route['error_rate']:.2%} > {max_error_rate:.2%}")
+    throughput = results['overall']['throughput']
+    if min_throughput is not None and throughput < min_throughput:
+        violations.append(f"overall: throughput {throughput:.1f} req/s < {min_throughput} req/s")
+    return violations
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """Skip the per-request access log, which would dominate a load run."""
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+@contextlib.contextmanager
+def local_server(**catalog):
+    """Serve the app on a free local port against a synthetic catalog.
+
+    Yields the base URL. ``catalog`` is passed to ``generate_catalog``.
+    """
+    from app import app
+
+    workdir = tempfile.mkdtemp(prefix='pdf-browser-load-')
+    database_path = os.path.join(workdir, 'load.db')
+    upload_folder = os.path.join(workdir, 'uploads')
+    os.makedirs(upload_folder)
+    generate_catalog(database_path, upload_folder=upload_folder, **catalog)
+
+    original_config = {key: app.config.get(key) for key in ('DATABASE', 'UPLOAD_FOLDER')}
+    app.config['DATABASE'] = database_path
+    app.config['UPLOAD_FOLDER'] = upload_folder
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_port}'
+    finally:
+        server.shutdown()
+        thread.join()
+        app.config.update(original_config)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def print_report(results, out=sys.stdout):
+    print(f"{'route':<18}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}", file=out)
+    rows = list(results['routes'].items()) + [('overall', results['overall'])]
+    for name, r in rows:
+        if not r['requests']:
+            continue
+        print(f"{name:<18}{r['requests']:>10}{r['errors']:>8}{r['throughput']:>10.1f}"
+              f"{r['p50_ms']:>10.1f}{r['p95_ms']:>10.1f}{r['p99_ms']:>10.1f}", file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a traffic mix against the PDF browser and check SLOs.")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--url", help="Base URL of a running server.")
+    target.add_argument("--serve", action="store_true", help="Start a local server on a synthetic catalog.")
+    parser.add_argument("--documents", type=int, default=1000, help="Synthetic documents when using --serve.")
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX,
+                        help="Traffic mix as name=weight pairs, e.g. 'list_documents=40,search=40,vote=15,upload=3,delete_version=2'.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Number of worker threads.")
+    parser.add_argument("--duration", type=float, help="Run for this many seconds.")
+    parser.add_argument("--requests", type=int, help="Stop after this many requests.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the traffic mix.")
+    parser.add_argument("--slo-p95-ms", type=float, help="Fail if any route's p95 latency exceeds this.")
+    parser.add_argument("--slo-p99-ms", type=float, help="Fail if any route's p99 latency exceeds this.")
+    parser.add_argument("--slo-error-rate", type=float, help="Fail if any route's error rate exceeds this fraction.")
+    parser.add_argument("--slo-throughput", type=float, help="Fail if overall requests per second fall below this.")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON.")
+    args = parser.parse_args(argv)
+    if args.duration is None and args.requests is None:
+        args.duration = 10.0
+
+    def run(base_url):
+        return run_load(base_url, mix=args.mix, concurrency=args.concurrency, duration=args.duration,
+                        total_requests=args.requests, seed=args.seed)
+
+    if args.serve:
+        with local_server(documents=args.documents, versions_per_document=2, metadata_keys=5, seed=args.seed) as base_url:
+            results = run(base_url)
+    else:
+        results = run(args.url.rstrip('/'))
+
+    violations = check_slos(results, p95_ms=args.slo_p95_ms, p99_ms=args.slo_p99_ms,
+                            max_error_rate=args.slo_error_rate, min_throughput=args.slo_throughput)
+    results['slo_violations'] = violations
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results)
+        for violation in violations:
+            print(f"SLO violated: {violation}")
+    return 1 if violations else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,123 @@
+"""Compare the legacy Python listing path with the SQL-built JSON path.
+
+The legacy path reproduces the old ``get_documents()``: one query per
+document and per version, ``json.loads`` of every metadata blob and a
+final ``json.dumps``. Metadata filters have to be applied in Python.
+The SQL path uses ``query_documents_json()``.
+
+Usage::
+
+    python -m benchmarks.metadata_query --documents 100000
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from app import app
+from benchmarks.generator import generate_catalog
+from database import get_db_connection, query_documents_json
+
+def populate(database_path, documents, seed=0):
+    generate_catalog(database_path, documents=documents, index_min_docs=1, seed=seed)
+
+
+def legacy_documents(predicate=None):
+    cursor = get_db_connection().cursor()
+    cursor.execute('SELECT * FROM documents ORDER BY id DESC')
+    results = []
+    for doc in cursor.fetchall():
+        doc_dict = dict(doc)
+        doc_dict['metadata'] = json.loads(doc_dict['metadata'])
+        if predicate and not predicate(doc_dict['metadata']):
+            continue
+        versions = cursor.execute('SELECT * FROM versions WHERE document_id = ? ORDER BY version DESC',
+                                  (doc['id'],)).fetchall()
+        versions_list = []
+        for v in versions:
+            v_dict = dict(v)
+            v_dict['file_consistent'] = True
+            html_docs = cursor.execute('SELECT file_path FROM html_documents WHERE version_id = ?',
+                                       (v['id'],)).fetchall()
+            v_dict['html_paths'] = [{'path': hp['file_path'], 'consistent': True} for hp in html_docs]
+            versions_list.append(v_dict)
+        doc_dict['versions'] = versions_list
+        results.append(doc_dict)
+    return json.dumps(results, default=str)
+
+
+def sql_documents(filters=None, sort=None):
+    return '[' + ','.join(query_documents_json(filters, sort, file_consistent=lambda path: True)) + ']'
+
+
+def best_of(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = func()
+        timings.append(time.perf_counter() - start)
+    return min(timings), len(body)
+
+
+SCENARIOS = {
+    'list_all': (
+        lambda: legacy_documents(),
+        lambda: sql_documents(),
+    ),
+    'filter_author_year_range': (
+        lambda: legacy_documents(lambda m: m.get('author') == 'author-7' and 2000 <= m.get('year', 0) < 2010),
+        lambda: sql_documents([('author', 'eq', 'author-7'), ('year', 'gte', '2000'), ('year', 'lt', '2010')]),
+    ),
+    'filter_status_in_sorted': (
+        lambda: legacy_documents(lambda m: m.get('status') in ('draft', 'review')),
+        lambda: sql_documents([('status', 'in', ['draft', 'review'])], sort='-year'),
+    ),
+}
+
+
+def run(documents, repeat):
+    db_fd, database_path = tempfile.mkstemp(suffix='.db')
+    os.close(db_fd)
+    original_database = app.config.get('DATABASE')
+    results = []
+    try:
+        populate(database_path, documents)
+        app.config['DATABASE'] = database_path
+        with app.app_context():
+            for name, (legacy, sql) in SCENARIOS.items():
+                legacy_seconds, legacy_bytes = best_of(legacy, repeat)
+                sql_seconds, sql_bytes = best_of(sql, repeat)
+                results.append({
+                    'scenario': name,
+                    'documents': documents,
+                    'legacy_seconds': legacy_seconds,
+                    'sql_seconds': sql_seconds,
+                    'speedup': legacy_seconds / sql_seconds if sql_seconds else None,
+                    'legacy_bytes': legacy_bytes,
+                    'sql_bytes': sql_bytes,
+                })
+    finally:
+        app.config['DATABASE'] = original_database
+        os.unlink(database_path)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark metadata filtering in SQL against the legacy Python path.")
+    parser.add_argument("--documents", type=int, default=100000, help="Number of synthetic documents.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per scenario; the best time is reported.")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON.")
+    args = parser.parse_args()
+
+    results = run(args.documents, args.repeat)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'scenario':<28}{'legacy (s)':>12}{'sql (s)':>12}{'speedup':>10}")
+    for r in results:
+        print(f"{r['scenario']:<28}{r['legacy_seconds']:>12.3f}{r['sql_seconds']:>12.3f}{r['speedup']:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""Server CPU time per GB downloaded from /uploads in each SERVE_MODE.
+
+For every mode a development server is started in a child process over a
+temporary upload folder holding one file of ``--size-mb``. Client threads
+download it ``--requests`` times and discard the bytes, while the child's
+user + system CPU time is read from /proc (on other systems the total at
+exit is used, which includes start-up). The result is CPU seconds per GB of
+file content served.
+
+In the offload modes (``x-accel``, ``x-sendfile``) the application only
+sends headers and the proxy would stream the file. The proxy is not part of
+this benchmark, so those figures show the cost left on the WSGI workers.
+
+Usage::
+
+    python -m benchmarks.serving --size-mb 256 --requests 40 --concurrency 4
+    python -m benchmarks.serving --modes python sendfile --output serving.json
+"""
+import argparse
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from serving import SERVE_MODES
+from storage import shard_key
+
+FILENAME = 'benchmark.pdf'
+
+
+def process_cpu_seconds(pid):
+    """User + system CPU seconds of ``pid`` from /proc, or None where unavailable."""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def write_upload(upload_folder, size):
+    key = shard_key(FILENAME)
+    path = os.path.join(upload_folder, key)
+    os.makedirs(os.path.dirname(path))
+    block = os.urandom(1024 * 1024)
+    with open(path, 'wb') as f:
+        for _ in range(size // len(block)):
+            f.write(block)
+        f.write(block[:size % len(block)])
+
+
+def serve(mode, upload_folder, database):
+    """Child process: serve the app in ``mode`` and print the port."""
+    from werkzeug.serving import WSGIRequestHandler, make_server
+    from app import app
+    from database import create_tables
+
+    class QuietRequestHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    app.config.update(TESTING=True, SERVE_MODE=mode, UPLOAD_FOLDER=upload_folder, DATABASE=database)
+    with app.app_context():
+        create_tables()
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietRequestHandler)
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    print(server.server_port, flush=True)
+    server.serve_forever()
+
+
+def download(url):
+    """Fetch ``url``; returns (bytes received, Content-Length)."""
+    received = 0
+    with requests.get(url, stream=True) as response:
+        response.raise_for_status()
+        # Offload responses announce the file's length but leave the body to the proxy
+        if 'X-Accel-Redirect' not in response.headers and 'X-Sendfile' not in response.headers:
+            for chunk in response.iter_content(1024 * 1024):
+                received += len(chunk)
+        return received, int(response.headers.get('Content-Length', 0))
+
+
+def measure(mode, workdir, requests_count, concurrency):
+    child = subprocess.Popen(
+        [sys.executable, '-m', 'benchmarks.serving', '--child', mode, '--workdir', workdir],
+        stdout=subprocess.PIPE, text=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    try:
+        url = f'http://127.0.0.1:{child.stdout.readline().strip()}/uploads/{FILENAME}'
+        download(url)  # warm up
+        cpu_before = process_cpu_seconds(child.pid)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(lambda _: download(url), range(requests_count)))
+        elapsed = time.perf_counter() - started
+        cpu_after = process_cpu_seconds(child.pid)
+    finally:
+        child.terminate()
+        _, _, usage = os.wait4(child.pid, 0)
+        child.returncode = 0
+    if cpu_before is None or cpu_after is None:
+        cpu = usage.ru_utime + usage.ru_stime
+    else:
+        cpu = cpu_after - cpu_before
+    served = sum(length for _, length in results)
+    gigabytes = served / 1024 ** 3
+    return {
+        'mode': mode,
+        'requests': requests_count,
+        'bytes_served': served,
+        'bytes_received': sum(received for received, _ in results),
+        'seconds': elapsed,
+        'server_cpu_seconds': cpu,
+        'cpu_seconds_per_gb': cpu / gigabytes if gigabytes else None,
+        'throughput_mb_per_second': served / 1024 ** 2 / elapsed if elapsed else None,
+    }
+
+
+def run(modes=SERVE_MODES, size_mb=64, requests_count=20, concurrency=4):
+    workdir = tempfile.mkdtemp(prefix='pdf-browser-serving-')
+    try:
+        os.makedirs(os.path.join(workdir, 'uploads'))
+        write_upload(os.path.join(workdir, 'uploads'), size_mb * 1024 * 1024)
+        return [measure(mode, workdir, requests_count, concurrency) for mode in modes]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def print_report(results, out=sys.stdout):
+    print(f"{'mode':<12}{'requests':>10}{'GB':>8}{'CPU s':>10}{'CPU s/GB':>10}{'MB/s':>10}", file=out)
+    for r in results:
+        per_gb = f"{r['cpu_seconds_per_gb']:.3f}" if r['cpu_seconds_per_gb'] is not None else '-'
+        print(f"{r['mode']:<12}{r['requests']:>10}{r['bytes_served'] / 1024 ** 3:>8.2f}"
+              f"{r['server_cpu_seconds']:>10.3f}{per_gb:>10}{r['throughput_mb_per_second']:>10.1f}", file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare server CPU per GB served across SERVE_MODEs.")
+    parser.add_argument("--modes", nargs='+', choices=SERVE_MODES, default=list(SERVE_MODES), help="Modes to measure.")
+    parser.add_argument("--size-mb", type=int, default=64, help="Size of the served file in MB.")
+    parser.add_argument("--requests", type=int, default=20, help="Downloads per mode.")
+    parser.add_argument("--concurrency", type=int, default=4, help="Concurrent downloads.")
+    parser.add_argument("--output", help="Write the results as JSON to this file.")
+    parser.add_argument("--child", choices=SERVE_MODES, help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        serve(args.child, os.path.join(args.workdir, 'uploads'), os.path.join(args.workdir, f'{args.child}.db'))
+        return 0
+    results = run(args.modes, args.size_mb, args.requests, args.concurrency)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+    print_report(results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
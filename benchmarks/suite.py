@@ -0,0 +1,182 @@
+"""Request-level benchmark scenarios run through the Flask test client.
+
+Each scenario times one kind of request against a synthetic catalog built
+by ``benchmarks.generator``. Timings are summarised the way
+pytest-benchmark does (min/max/mean/stddev/median/iqr/ops) and results are
+plain JSON so runs from different commits can be compared with
+``compare_results``.
+"""
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import tempfile
+import time
+
+from app import app
+from benchmarks.generator import generate_catalog
+
+
+def _list_documents(client, ctx, i):
+    return client.get('/documents')
+
+def _filter_documents(client, ctx, i):
+    return client.get('/documents?filter[status]=draft&filter[year][gte]=2010&sort=-year')
+
+def _search(client, ctx, i):
+    return client.get('/search?q=report')
+
+def _vote(client, ctx, i):
+    doc = ctx['rng'].randrange(1, ctx['documents'] + 1)
+    version = ctx['rng'].randrange(1, ctx['versions_per_document'] + 1)
+    return client.post('/vote', json={'doc_id': f'doc-{doc}', 'version': version, 'vote_type': 'good'})
+
+def _upload_new_document(client, ctx, i):
+    return client.post('/upload', content_type='multipart/form-data', data={
+        'doc_id': f'bench-new-{i}',
+        'metadata': json.dumps({'name': f'benchmark upload {i}', 'status': 'draft'}),
+        'change_description': 'benchmark upload',
+        'file': (io.BytesIO(ctx['payload']), 'bench.pdf'),
+    })
+
+def _upload_new_version(client, ctx, i):
+    doc = ctx['rng'].randrange(1, ctx['documents'] + 1)
+    return client.post('/upload', content_type='multipart/form-data', data={
+        'doc_id': f'doc-{doc}',
+        'metadata': json.dumps({'status': 'review'}),
+        'change_description': 'benchmark version',
+        'file': (io.BytesIO(ctx['payload']), 'bench.pdf'),
+    })
+
+def _delete_version(client, ctx, i):
+    # Walk the catalog from the top so every round deletes an existing version
+    doc = ctx['documents'] - i
+    return client.delete(f'/documents/doc-{doc}/versions/1')
+
+
+# Read-only scenarios first: the write scenarios change the catalog
+SCENARIOS = {
+    'list_documents': _list_documents,
+    'filter_documents': _filter_documents,
+    'search': _search,
+    'vote': _vote,
+    'upload_new_document': _upload_new_document,
+    'upload_new_version': _upload_new_version,
+    'delete_version': _delete_version,
+}
+
+
+def summarize(timings):
+    """pytest-benchmark style statistics for a list of durations in seconds."""
+    ordered = sorted(timings)
+    quartiles = statistics.quantiles(ordered, n=4) if len(ordered) > 1 else [ordered[0]] * 3
+    mean = statistics.fmean(ordered)
+    return {
+        'min': ordered[0],
+        'max': ordered[-1],
+        'mean': mean,
+        'stddev': statistics.stdev(ordered) if len(ordered) > 1 else 0.0,
+        'median': statistics.median(ordered),
+        'iqr': quartiles[2] - quartiles[0],
+        'ops': 1 / mean if mean else None,
+        'rounds': len(ordered),
+    }
+
+
+def _commit_info():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        commit = ''
+    return {'id': commit or None}
+
+
+def run_suite(scenarios=None, rounds=20, warmup=2, seed=0, **catalog):
+    """Build a synthetic catalog and time each scenario against it.
+
+    ``catalog`` is passed to ``generate_catalog`` (documents,
+    versions_per_document, html_per_version, metadata_keys, votes,
+    write_files...). Returns a JSON-serializable dict.
+    """
+    names = list(scenarios or SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        raise ValueError(f"Unknown scenarios: {', '.join(unknown)}")
+
+    workdir = tempfile.mkdtemp(prefix='pdf-browser-bench-')
+    database_path = os.path.join(workdir, 'bench.db')
+    upload_folder = os.path.join(workdir, 'uploads')
+    os.makedirs(upload_folder)
+    original_config = {key: app.config.get(key) for key in ('DATABASE', 'UPLOAD_FOLDER')}
+
+    try:
+        summary = generate_catalog(database_path, upload_folder=upload_folder, seed=seed, **catalog)
+        app.config['DATABASE'] = database_path
+        app.config['UPLOAD_FOLDER'] = upload_folder
+        ctx = {
+            'rng': random.Random(seed),
+            'documents': summary['documents'],
+            'versions_per_document': max(1, summary['versions'] // max(1, summary['documents'])),
+            'payload': b'%PDF-1.4\n' + b'0' * 64 * 1024 + b'\n%%EOF\n',
+        }
+        client = app.test_client()
+
+        benchmarks = []
+        for name in names:
+            scenario = SCENARIOS[name]
+            timings = []
+            for i in range(warmup + rounds):
+                start = time.perf_counter()
+                response = scenario(client, ctx, i)
+                elapsed = time.perf_counter() - start
+                if response.status_code >= 400:
+                    raise RuntimeError(f'{name}: request failed with {response.status_code}: {response.get_data(as_text=True)}')
+                if i >= warmup:
+                    timings.append(elapsed)
+            benchmarks.append({'name': name, 'stats': summarize(timings)})
+    finally:
+        app.config.update(original_config)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'datetime': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'machine_info': {
+            'python_version': platform.python_version(),
+            'platform': platform.platform(),
+            'sqlite_version': sqlite3.sqlite_version,
+        },
+        'commit_info': _commit_info(),
+        'catalog': summary,
+        'benchmarks': benchmarks,
+    }
+
+
+def compare_results(baseline, current, stat='median', threshold=0.1):
+    """Compare two ``run_suite`` results scenario by scenario.
+
+    Returns a list of dicts with the baseline and current value of ``stat``,
+    their ratio and whether the current run is more than ``threshold``
+    (a fraction) slower.
+    """
+    baseline_stats = {b['name']: b['stats'] for b in baseline['benchmarks']}
+    rows = []
+    for bench in current['benchmarks']:
+        old = baseline_stats.get(bench['name'])
+        if old is None:
+            continue
+        before, after = old[stat], bench['stats'][stat]
+        ratio = after / before if before else None
+        rows.append({
+            'name': bench['name'],
+            'baseline': before,
+            'current': after,
+            'ratio': ratio,
+            'regression': ratio is not None and ratio > 1 + threshold,
+        })
+    return rows
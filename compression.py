@@ -0,0 +1,120 @@
+import json
+import zlib
+
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+from werkzeug.wrappers import Response
+from werkzeug.wsgi import LimitedStream, get_content_length
+
+# Compressed request bodies. A request sent with ``Content-Encoding: gzip``
+# (or ``deflate``) is decompressed while the form parser reads it, and
+# multipart parts carrying their own ``Content-Encoding`` header (such as
+# gzipped HTML files) are decompressed as they are staged. Either way the
+# decompressed size is capped at MAX_DECOMPRESSED_BODY_SIZE; going over it
+# answers 413, so a small "zip bomb" cannot fill memory or disk.
+
+MAX_DECOMPRESSED_BODY_SIZE = 4 * 1024 * 1024 * 1024
+READ_SIZE = 64 * 1024
+WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'x-gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+
+class DecompressingStream:
+    """Readable stream of the decompressed contents of ``stream``.
+
+    Reads return at most ``size`` bytes, however well the input compresses.
+    Raises RequestEntityTooLarge once more than ``limit`` bytes were
+    decompressed and BadRequest on corrupt or truncated input.
+    """
+
+    def __init__(self, stream, encoding, limit=MAX_DECOMPRESSED_BODY_SIZE):
+        self.stream = stream
+        self.decompressor = zlib.decompressobj(WBITS[encoding])
+        self.limit = limit
+        self.total = 0
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b''.join(iter(lambda: self.read(READ_SIZE), b''))
+        while not self.eof and size:
+            data = self.decompressor.unconsumed_tail or self.stream.read(READ_SIZE)
+            try:
+                if data:
+                    chunk = self.decompressor.decompress(data, size)
+                else:
+                    chunk = self.decompressor.flush()
+                    if not self.decompressor.eof:
+                        raise BadRequest("Truncated compressed request body")
+            except zlib.error:
+                raise BadRequest("Corrupt compressed request body")
+            if self.decompressor.eof or not data:
+                self.eof = True
+            if chunk:
+                self.total += len(chunk)
+                if self.limit is not None and self.total > self.limit:
+                    raise RequestEntityTooLarge(f"Decompressed body exceeds {self.limit} bytes")
+                return chunk
+        return b''
+
+    def close(self):
+        close = getattr(self.stream, 'close', None)
+        if close is not None:
+            close()
+
+
+def decode_file(file, limit=MAX_DECOMPRESSED_BODY_SIZE):
+    """Decompress an uploaded FileStorage in place if its part has a Content-Encoding.
+
+    Raises BadRequest for an unsupported encoding. Returns ``file``.
+    """
+    encoding = file.headers.get('Content-Encoding', '').strip().lower()
+    if encoding and encoding != 'identity':
+        if encoding not in WBITS:
+            raise BadRequest(f"Unsupported Content-Encoding: {encoding}")
+        file.stream = DecompressingStream(file.stream, encoding, limit)
+    return file
+
+
+def init_compression(app):
+    app.wsgi_app = RequestDecompressionMiddleware(app.wsgi_app, app.config)
+    return app.wsgi_app
+
+
+class RequestDecompressionMiddleware:
+    """WSGI middleware that decompresses request bodies sent with a Content-Encoding.
+
+    The application sees the decompressed body as a stream of unknown
+    length (``wsgi.input_terminated``), so nothing is buffered. The cap is
+    read from ``config`` on every request.
+    """
+
+    def __init__(self, wsgi_app, config=None):
+        self.wsgi_app = wsgi_app
+        self.config = config if config is not None else {}
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+        if not encoding or encoding == 'identity':
+            return self.wsgi_app(environ, start_response)
+        if encoding not in WBITS:
+            response = Response(json.dumps({'error': f'Unsupported Content-Encoding: {encoding}'}),
+                                415, mimetype='application/json')
+            return response(environ, start_response)
+
+        stream = environ['wsgi.input']
+        content_length = get_content_length(environ)
+        if content_length is not None and 'wsgi.input_terminated' not in environ:
+            stream = LimitedStream(stream, content_length)
+        max_size = self.config.get('MAX_DECOMPRESSED_BODY_SIZE', MAX_DECOMPRESSED_BODY_SIZE)
+        environ['wsgi.input'] = DecompressingStream(stream, encoding, max_size)
+        environ['wsgi.input_terminated'] = True
+        environ.pop('CONTENT_LENGTH', None)
+        environ.pop('HTTP_CONTENT_ENCODING', None)
+        environ['pdf_browser.compressed_length'] = content_length
+        return self.wsgi_app(environ, start_response)
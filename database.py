@@ -1,31 +1,232 @@
 import sqlite3
 from flask import current_app, g
 import os
+import re
 import json
+import time
+import logging
+import random
+import threading
+from collections import deque
+from logging.handlers import RotatingFileHandler
+from instrumentation import record_sql_statement, record_sql_time
 
 DATABASE_NAME = 'pdf_browser.db'
 
+# Metadata keys that may be used in SQL json paths and index names.
+METADATA_KEY_PATTERN = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+# A key gets a json_extract expression index once this many documents use it.
+METADATA_INDEX_MIN_DOCS = 100
+# Statements slower than this are recorded in the slow query log
+# (overridable per app through the SLOW_QUERY_THRESHOLD_MS setting)
+SLOW_QUERY_THRESHOLD_MS = 100
+# BEGIN IMMEDIATE attempts while another connection holds the write lock.
+# Each attempt already waits up to the connection timeout in SQLite's busy
+# handler, so these retries only cover long write bursts.
+BUSY_RETRIES = 5
+BUSY_BACKOFF_SECONDS = 0.05
+
+class DatabaseBusyError(sqlite3.OperationalError):
+    """The write lock could not be acquired within BUSY_RETRIES attempts."""
+
+class SlowQueryLog:
+    """Statements slower than the connection's threshold.
+
+    Entries are kept in an in-memory ring buffer and, once ``configure``
+    has been given a path, also written to a size-rotated log file.
+    """
+
+    def __init__(self, capacity=1000):
+        self.entries = deque(maxlen=capacity)
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger('pdf_browser.slow_queries')
+        self.logger.setLevel(logging.WARNING)
+        self.logger.propagate = False
+        self.log_path = None
+        self.max_bytes = 10 * 1024 * 1024
+        self.backup_count = 5
+        self._handler = None
+
+    def configure(self, log_path=None, max_bytes=None, backup_count=None):
+        with self.lock:
+            self.log_path = log_path
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            if backup_count is not None:
+                self.backup_count = backup_count
+            if self._handler is not None:
+                self.logger.removeHandler(self._handler)
+                self._handler.close()
+                self._handler = None
+
+    def _ensure_handler(self):
+        # The log file is only created once there is something to write
+        if self._handler is None and self.log_path:
+            os.makedirs(os.path.dirname(os.path.abspath(self.log_path)), exist_ok=True)
+            self._handler = RotatingFileHandler(self.log_path, maxBytes=self.max_bytes, backupCount=self.backup_count)
+            self._handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            self.logger.addHandler(self._handler)
+
+    def record(self, conn, sql, parameters, seconds):
+        entry = {
+            'fingerprint': fingerprint_sql(sql),
+            'sql': sql,
+            'parameter_shape': parameter_shape(parameters),
+            'duration_ms': seconds * 1000,
+            'plan': explain_query_plan(conn, sql, parameters),
+            'recorded_at': time.time(),
+        }
+        with self.lock:
+            self.entries.append(entry)
+            self._ensure_handler()
+        self.logger.warning(json.dumps(entry))
+
+    def top(self, limit=10):
+        """Slowest statement fingerprints in the buffer, by maximum duration."""
+        with self.lock:
+            entries = list(self.entries)
+        groups = {}
+        for entry in entries:
+            group = groups.setdefault(entry['fingerprint'], {
+                'fingerprint': entry['fingerprint'],
+                'count': 0,
+                'total_ms': 0.0,
+                'max_ms': 0.0,
+            })
+            group['count'] += 1
+            group['total_ms'] += entry['duration_ms']
+            if entry['duration_ms'] >= group['max_ms']:
+                group['max_ms'] = entry['duration_ms']
+                group['parameter_shape'] = entry['parameter_shape']
+                group['plan'] = entry['plan']
+        for group in groups.values():
+            group['mean_ms'] = group['total_ms'] / group['count']
+        return sorted(groups.values(), key=lambda g: g['max_ms'], reverse=True)[:limit]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+slow_query_log = SlowQueryLog()
+
+def fingerprint_sql(sql):
+    """Normalize a statement so that queries differing only in literals group together."""
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'\b\d+(?:\.\d+)?\b', '?', sql)
+    return re.sub(r'\s+', ' ', sql).strip()
+
+def parameter_shape(parameters):
+    if isinstance(parameters, dict):
+        return {name: type(value).__name__ for name, value in parameters.items()}
+    return [type(value).__name__ for value in parameters or ()]
+
+def explain_query_plan(conn, sql, parameters=()):
+    """Return the EXPLAIN QUERY PLAN detail lines for a statement, or [] if it has none."""
+    try:
+        # A plain cursor, so explaining is not itself timed or logged
+        cursor = conn.cursor(sqlite3.Cursor)
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, parameters)
+        return [row[3] for row in cursor.fetchall()]
+    except sqlite3.Error:
+        return []
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that times each statement, including the time spent fetching rows.
+
+    Durations are reported to ``instrumentation`` as they accrue. Once a
+    statement is finished (fully fetched, replaced or closed), it is
+    recorded in the slow query log if it took longer than the connection's
+    ``slow_query_threshold_ms``.
+    """
+
+    _statement = None
+    _parameters = ()
+    _elapsed = 0.0
+
+    def execute(self, sql, parameters=()):
+        self._finish_statement()
+        self._statement, self._parameters, self._elapsed = sql, parameters, 0.0
+        self._timed(super().execute, sql, parameters)
+        if self.description is None:
+            self._finish_statement()
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self._finish_statement()
+        self._timed(super().executemany, sql, seq_of_parameters)
+        return self
+
+    def fetchone(self):
+        row = self._timed(super().fetchone)
+        if row is None:
+            self._finish_statement()
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        rows = self._timed(super().fetchmany, size)
+        if len(rows) < size:
+            self._finish_statement()
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(super().fetchall)
+        self._finish_statement()
+        return rows
+
+    def close(self):
+        self._finish_statement()
+        super().close()
+
+    def _timed(self, func, *args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            self._elapsed += elapsed
+            record_sql_time(elapsed)
+
+    def _finish_statement(self):
+        sql, self._statement = self._statement, None
+        threshold_ms = getattr(self.connection, 'slow_query_threshold_ms', None)
+        if sql is not None and threshold_ms is not None and self._elapsed * 1000 >= threshold_ms:
+            slow_query_log.record(self.connection, sql, self._parameters, self._elapsed)
+
+class InstrumentedConnection(sqlite3.Connection):
+    slow_query_threshold_ms = None
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+def _connect(database_name, slow_query_threshold_ms=SLOW_QUERY_THRESHOLD_MS):
+    conn = sqlite3.connect(
+        database_name,
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        factory=InstrumentedConnection
+    )
+    conn.slow_query_threshold_ms = slow_query_threshold_ms
+    conn.set_trace_callback(record_sql_statement) # Count every statement SQLite runs
+    return conn
+
 def get_db_connection(database_name=None):
     if database_name:
-        conn = sqlite3.connect(
-            database_name,
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
+        conn = _connect(database_name)
         conn.row_factory = sqlite3.Row
         conn.execute('PRAGMA foreign_keys = ON;') # Enable foreign key enforcement
         return conn
     else:
         if 'db' not in g:
-            if current_app.config.get('DATABASE'):
-                g.db = sqlite3.connect(
-                    current_app.config['DATABASE'],
-                    detect_types=sqlite3.PARSE_DECLTYPES
-                )
-            else:
-                g.db = sqlite3.connect(
-                    DATABASE_NAME,
-                    detect_types=sqlite3.PARSE_DECLTYPES
-                )
+            g.db = _connect(
+                current_app.config.get('DATABASE') or DATABASE_NAME,
+                current_app.config.get('SLOW_QUERY_THRESHOLD_MS', SLOW_QUERY_THRESHOLD_MS)
+            )
             g.db.row_factory = sqlite3.Row
             g.db.execute('PRAGMA foreign_keys = ON;') # Enable foreign key enforcement
         return g.db
@@ -84,10 +285,124 @@ def create_tables(conn=None):
         )
     ''')
 
+    # Size and SHA-256 of each stored file, recorded at upload and checked by integrity.py
+    for table in ('versions', 'html_documents'):
+        add_column_if_missing(cursor, table, 'file_size', 'INTEGER')
+        add_column_if_missing(cursor, table, 'checksum', 'TEXT')
+        # Storage tier (see tiering.py): cold files live compressed at archive_path
+        add_column_if_missing(cursor, table, 'tier', "TEXT NOT NULL DEFAULT 'hot'")
+        add_column_if_missing(cursor, table, 'archive_path', 'TEXT')
+        add_column_if_missing(cursor, table, 'access_count', 'INTEGER NOT NULL DEFAULT 0')
+        add_column_if_missing(cursor, table, 'last_accessed_at', 'REAL')
+        # Downloads look rows up by path to count accesses
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_file_path ON {table} (file_path)')
+
+    # Files of committed uploads that are not yet renamed out of staging (see ingest.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS upload_journal (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            staging_path TEXT NOT NULL,
+            final_path TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Files of deleted versions waiting to be unlinked by the reaper (see reaper.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS file_tombstones (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            file_path TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_file_tombstones_next_attempt ON file_tombstones (next_attempt_at)')
+
+    # Resumable uploads in progress and the chunks received so far (see resumable.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS upload_sessions (
+            id TEXT PRIMARY KEY,
+            doc_id TEXT NOT NULL,
+            metadata TEXT NOT NULL,
+            change_description TEXT,
+            filename TEXT NOT NULL,
+            total_size INTEGER NOT NULL,
+            chunk_size INTEGER NOT NULL,
+            checksum TEXT,
+            status TEXT NOT NULL DEFAULT 'open',
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_upload_sessions_expires_at ON upload_sessions (expires_at)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS upload_chunks (
+            session_id TEXT NOT NULL,
+            chunk_index INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            checksum TEXT NOT NULL,
+            PRIMARY KEY (session_id, chunk_index),
+            FOREIGN KEY (session_id) REFERENCES upload_sessions (id) ON DELETE CASCADE
+        )
+    ''')
+
+    # Append-only log of catalog changes for incremental sync (GET /changes).
+    # Rows are written in the same transaction as the change they describe.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS catalog_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            doc_id TEXT NOT NULL,
+            change_type TEXT NOT NULL,
+            version INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Per-document and per-version lookups used when listing documents
+    try:
+        cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_versions_document_version ON versions (document_id, version)')
+        cursor.execute('DROP INDEX IF EXISTS idx_versions_document_id')
+    except sqlite3.IntegrityError:
+        # Duplicate versions left by racing uploads before versions were allocated atomically
+        logging.getLogger(__name__).warning("Duplicate (document_id, version) rows found; versions are not unique-indexed")
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_versions_document_id ON versions (document_id, version)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_html_documents_version_id ON html_documents (version_id)')
+    # Vote lookups and the ON DELETE CASCADE checks when versions are removed
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_votes_version_id ON votes (version_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_votes_document_id ON votes (document_id)')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS metadata_keys (
+            key TEXT PRIMARY KEY,
+            doc_count INTEGER NOT NULL DEFAULT 0,
+            value_type TEXT
+        )
+    ''')
+
+    # Backfill the key catalog for databases created before it existed
+    cursor.execute('SELECT 1 FROM metadata_keys LIMIT 1')
+    if cursor.fetchone() is None:
+        rebuild_metadata_keys(conn)
+
     conn.commit()
 
+def add_column_if_missing(cursor, table, column, declaration):
+    """ALTER TABLE migration for databases created before ``column`` existed."""
+    cursor.execute(f'PRAGMA table_info({table})')
+    if column in {row[1] for row in cursor.fetchall()}:
+        return False
+    cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {declaration}')
+    return True
+
 def init_app(app):
     app.teardown_appcontext(close_db)
+    slow_query_log.configure(
+        app.config.get('SLOW_QUERY_LOG', os.path.join('logs', 'slow_queries.log')),
+        app.config.get('SLOW_QUERY_LOG_MAX_BYTES'),
+        app.config.get('SLOW_QUERY_LOG_BACKUP_COUNT')
+    )
 
 def delete_document_version(doc_id, version_number):
     conn = get_db_connection()
@@ -95,14 +410,14 @@ def delete_document_version(doc_id, version_number):
 
     try:
         # Get document_id from doc_id
-        cursor.execute('SELECT id FROM documents WHERE doc_id = ?', (doc_id,))
+        cursor.execute('SELECT id, metadata FROM documents WHERE doc_id = ?', (doc_id,))
         document = cursor.fetchone()
         if not document:
             return False, "Document not found."
         document_id = document['id']
 
         # Get version details
-        cursor.execute('SELECT id, file_path FROM versions WHERE document_id = ? AND version = ?', (document_id, version_number))
+        cursor.execute('SELECT id, COALESCE(archive_path, file_path) AS file_path FROM versions WHERE document_id = ? AND version = ?', (document_id, version_number))
         version_to_delete = cursor.fetchone()
         if not version_to_delete:
             return False, "Version not found."
@@ -110,18 +425,10 @@ def delete_document_version(doc_id, version_number):
         version_id = version_to_delete['id']
         file_path_to_delete = version_to_delete['file_path']
 
-        # Get associated HTML files
-        cursor.execute('SELECT file_path FROM html_documents WHERE version_id = ?', (version_id,))
-        html_files_to_delete = cursor.fetchall()
-
-        # Delete HTML documents from filesystem
-        for html_file in html_files_to_delete:
-            if os.path.exists(html_file['file_path']):
-                os.remove(html_file['file_path'])
-
-        # Delete main PDF file from filesystem
-        if os.path.exists(file_path_to_delete):
-            os.remove(file_path_to_delete)
+        # Queue the PDF and HTML files for the reaper; they are only unlinked
+        # after this transaction commits (see reaper.py)
+        cursor.execute('SELECT COALESCE(archive_path, file_path) AS file_path FROM html_documents WHERE version_id = ?', (version_id,))
+        tombstone_files(cursor, [file_path_to_delete] + [row['file_path'] for row in cursor.fetchall()])
 
         # Delete from html_documents table
         cursor.execute('DELETE FROM html_documents WHERE version_id = ?', (version_id,))
@@ -136,9 +443,13 @@ def delete_document_version(doc_id, version_number):
 
         cursor.execute('UPDATE documents SET latest_version = ? WHERE id = ?', (max_version, document_id))
 
+        record_change(cursor, doc_id, 'version_deleted', version_number)
+
         # If no versions remain, delete the document entry itself
         if max_version == 0:
             cursor.execute('DELETE FROM documents WHERE id = ?', (document_id,))
+            update_metadata_keys(cursor, json.loads(document['metadata'] or '{}'), {})
+            record_change(cursor, doc_id, 'document_deleted')
 
         conn.commit()
         return True, "Version deleted successfully."
@@ -146,6 +457,105 @@ def delete_document_version(doc_id, version_number):
         conn.rollback()
         return False, str(e)
 
+def delete_document(doc_id):
+    """Delete a document and all of its versions in one transaction."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute('SELECT id, metadata FROM documents WHERE doc_id = ?', (doc_id,))
+        document = cursor.fetchone()
+        if not document:
+            return False, "Document not found."
+        document_id = document['id']
+
+        cursor.execute('''
+            SELECT COALESCE(archive_path, file_path) AS file_path FROM versions WHERE document_id = ?
+            UNION ALL
+            SELECT COALESCE(h.archive_path, h.file_path) FROM html_documents h JOIN versions v ON h.version_id = v.id WHERE v.document_id = ?
+        ''', (document_id, document_id))
+        tombstone_files(cursor, [row['file_path'] for row in cursor.fetchall()])
+
+        cursor.execute('DELETE FROM html_documents WHERE version_id IN (SELECT id FROM versions WHERE document_id = ?)', (document_id,))
+        cursor.execute('DELETE FROM versions WHERE document_id = ?', (document_id,))
+        cursor.execute('DELETE FROM documents WHERE id = ?', (document_id,))
+        update_metadata_keys(cursor, json.loads(document['metadata'] or '{}'), {})
+        record_change(cursor, doc_id, 'document_deleted')
+
+        conn.commit()
+        return True, "Document deleted successfully."
+    except Exception as e:
+        conn.rollback()
+        return False, str(e)
+
+def begin_immediate(conn, retries=BUSY_RETRIES, backoff=BUSY_BACKOFF_SECONDS):
+    """Start a transaction that holds the write lock from its first statement.
+
+    Retries with jittered exponential backoff while the database is locked
+    and raises DatabaseBusyError once ``retries`` are used up.
+    """
+    for attempt in range(retries + 1):
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            return
+        except sqlite3.OperationalError as e:
+            if 'locked' not in str(e) and 'busy' not in str(e):
+                raise
+            if attempt == retries:
+                raise DatabaseBusyError(str(e)) from e
+            time.sleep(backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
+def allocate_version(cursor, doc_id, metadata):
+    """Create the document if needed and reserve its next version number.
+
+    Must run inside a write transaction (see begin_immediate). Returns
+    ``(document id, version, previous metadata)``; the previous metadata
+    is None for a document created by this call.
+    """
+    cursor.execute(
+        'INSERT INTO documents (doc_id, metadata, latest_version) VALUES (?, ?, 0) ON CONFLICT (doc_id) DO NOTHING',
+        (doc_id, json.dumps(metadata))
+    )
+    created = cursor.rowcount == 1
+    cursor.execute(
+        'UPDATE documents SET latest_version = latest_version + 1 WHERE doc_id = ? RETURNING id, latest_version, metadata',
+        (doc_id,)
+    )
+    document_id, version, previous_metadata = cursor.fetchone()
+    return document_id, version, None if created else json.loads(previous_metadata)
+
+def record_change(cursor, doc_id, change_type, version=None):
+    """Append to catalog_changes; call inside the transaction making the change.
+
+    ``change_type`` is one of document_created, metadata_updated,
+    version_added, version_deleted and document_deleted.
+    """
+    cursor.execute('INSERT INTO catalog_changes (doc_id, change_type, version) VALUES (?, ?, ?)',
+                   (doc_id, change_type, version))
+
+def get_changes(since=0, limit=100, conn=None):
+    """Changes with a sequence number above ``since``, oldest first."""
+    if conn is None:
+        conn = get_db_connection()
+    cursor = conn.execute(
+        'SELECT seq, doc_id, change_type, version, CAST(created_at AS TEXT) FROM catalog_changes WHERE seq > ? ORDER BY seq LIMIT ?',
+        (since, limit)
+    )
+    return [dict(zip(('seq', 'doc_id', 'change_type', 'version', 'created_at'), row)) for row in cursor.fetchall()]
+
+def latest_change_seq(conn=None):
+    if conn is None:
+        conn = get_db_connection()
+    return conn.execute('SELECT COALESCE(MAX(seq), 0) FROM catalog_changes').fetchone()[0]
+
+def tombstone_files(cursor, file_paths):
+    """Record files to unlink once the current transaction commits."""
+    cursor.executemany('INSERT INTO file_tombstones (file_path) VALUES (?)', [(path,) for path in file_paths])
+
+def clear_tombstones(cursor, file_paths):
+    """Cancel pending unlinks of files written again; call in the transaction that references them."""
+    cursor.executemany('DELETE FROM file_tombstones WHERE file_path = ?', [(path,) for path in file_paths])
+
 def insert_vote(doc_id, version_number, vote_type, voter_info):
     conn = get_db_connection()
     cursor = conn.cursor()
@@ -206,56 +616,276 @@ def get_all_individual_votes():
     results = cursor.fetchall()
     return [dict(row) for row in results]
 
-
-if __name__ == '__main__':
-    conn = sqlite3.connect(DATABASE_NAME)
-    conn.row_factory = sqlite3.Row
+def _metadata_value_type(value):
+    if isinstance(value, bool):
+        return 'boolean'
+    if isinstance(value, int):
+        return 'integer'
+    if isinstance(value, float):
+        return 'real'
+    if isinstance(value, str):
+        return 'text'
+    if isinstance(value, list):
+        return 'array'
+    if isinstance(value, dict):
+        return 'object'
+    return 'null'
+
+def _merge_value_types(current, new):
+    if current is None or current == 'null' or current == new:
+        return new
+    if new == 'null':
+        return current
+    if {current, new} == {'integer', 'real'}:
+        return 'real'
+    return 'mixed'
+
+def metadata_index_name(key):
+    return f'idx_documents_meta_{key}'
+
+def metadata_json_path(key):
+    if not METADATA_KEY_PATTERN.match(key):
+        raise ValueError(f"Invalid metadata key: {key}")
+    return f'$.{key}'
+
+def ensure_metadata_index(cursor, key):
+    # The indexed expression must match the one used in queries exactly,
+    # so the json path is inlined rather than bound as a parameter.
+    if not METADATA_KEY_PATTERN.match(key):
+        return False
+    cursor.execute(
+        f"CREATE INDEX IF NOT EXISTS {metadata_index_name(key)} "
+        f"ON documents (json_extract(metadata, '{metadata_json_path(key)}'))"
+    )
+    return True
+
+def update_metadata_keys(cursor, old_metadata, new_metadata, index_min_docs=None):
+    """Apply one document's metadata change to the metadata_keys catalog."""
+    if index_min_docs is None:
+        index_min_docs = METADATA_INDEX_MIN_DOCS
+    old_metadata = old_metadata if isinstance(old_metadata, dict) else {}
+    new_metadata = new_metadata if isinstance(new_metadata, dict) else {}
+
+    for key, value in new_metadata.items():
+        cursor.execute('SELECT doc_count, value_type FROM metadata_keys WHERE key = ?', (key,))
+        row = cursor.fetchone()
+        added = 0 if key in old_metadata else 1
+        value_type = _merge_value_types(row['value_type'] if row else None, _metadata_value_type(value))
+        if row:
+            doc_count = row['doc_count'] + added
+            cursor.execute('UPDATE metadata_keys SET doc_count = ?, value_type = ? WHERE key = ?',
+                           (doc_count, value_type, key))
+        else:
+            doc_count = added
+            cursor.execute('INSERT INTO metadata_keys (key, doc_count, value_type) VALUES (?, ?, ?)',
+                           (key, doc_count, value_type))
+        if added and doc_count == index_min_docs:
+            ensure_metadata_index(cursor, key)
+
+    removed_keys = [key for key in old_metadata if key not in new_metadata]
+    for key in removed_keys:
+        cursor.execute('UPDATE metadata_keys SET doc_count = doc_count - 1 WHERE key = ?', (key,))
+    if removed_keys:
+        cursor.execute('DELETE FROM metadata_keys WHERE doc_count <= 0')
+
+def rebuild_metadata_keys(conn=None, index_min_docs=None):
+    """Recompute the metadata_keys catalog from scratch."""
+    if conn is None:
+        conn = get_db_connection()
+    if index_min_docs is None:
+        index_min_docs = METADATA_INDEX_MIN_DOCS
     cursor = conn.cursor()
-
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS documents (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            doc_id TEXT NOT NULL UNIQUE,
-            metadata TEXT,
-            latest_version INTEGER DEFAULT 1
-        )
+        SELECT j.key, COUNT(DISTINCT d.id) AS doc_count, GROUP_CONCAT(DISTINCT j.type) AS types
+        FROM documents d, json_each(d.metadata) j
+        WHERE json_valid(d.metadata) AND json_type(d.metadata) = 'object'
+        GROUP BY j.key
     ''')
+    sqlite_types = {'true': 'boolean', 'false': 'boolean'}
+    catalog = []
+    for row in cursor.fetchall():
+        value_type = None
+        for sqlite_type in row['types'].split(','):
+            value_type = _merge_value_types(value_type, sqlite_types.get(sqlite_type, sqlite_type))
+        catalog.append((row['key'], row['doc_count'], value_type))
+
+    cursor.execute('DELETE FROM metadata_keys')
+    cursor.executemany('INSERT INTO metadata_keys (key, doc_count, value_type) VALUES (?, ?, ?)', catalog)
+    for key, doc_count, _ in catalog:
+        if doc_count >= index_min_docs:
+            ensure_metadata_index(cursor, key)
+    conn.commit()
 
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS versions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            document_id INTEGER NOT NULL,
-            version INTEGER NOT NULL,
-            change_description TEXT,
-            file_path TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (document_id) REFERENCES documents (id) ON DELETE CASCADE
-        )
-    ''')
+def _indexed_metadata_keys(cursor):
+    prefix = metadata_index_name('')
+    cursor.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'documents' AND name LIKE ?",
+        (prefix + '%',)
+    )
+    return {row['name'][len(prefix):] for row in cursor.fetchall()}
 
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS html_documents (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            version_id INTEGER NOT NULL,
-            file_path TEXT NOT NULL,
-            FOREIGN KEY (version_id) REFERENCES versions (id) ON DELETE CASCADE
-        )
-    ''')
+def get_metadata_keys():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    indexed = _indexed_metadata_keys(cursor)
+    cursor.execute('SELECT key, doc_count, value_type FROM metadata_keys ORDER BY key')
+    return [dict(row, indexed=row['key'] in indexed) for row in cursor.fetchall()]
 
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS votes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            document_id INTEGER NOT NULL,
-            version_id INTEGER NOT NULL,
-            vote_type TEXT NOT NULL,
-            voter_info TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (document_id) REFERENCES documents (id) ON DELETE CASCADE,
-            FOREIGN KEY (version_id) REFERENCES versions (id) ON DELETE CASCADE
+def _coerce_metadata_value(value, value_type):
+    # Query-string values are text; match the stored JSON type so that
+    # comparisons against json_extract() (and its index) line up.
+    try:
+        if value_type == 'integer':
+            return int(value)
+        if value_type == 'real':
+            return float(value)
+    except ValueError:
+        return value
+    if value_type == 'boolean':
+        flag = str(value).lower()
+        if flag not in ('1', 'true', '0', 'false'):
+            raise ValueError(f"Invalid boolean value: {value}")
+        return 1 if flag in ('1', 'true') else 0
+    return value
+
+# Filter operators accepted by compile_metadata_query and their SQL form
+METADATA_FILTER_OPERATORS = {
+    'eq': '=',
+    'ne': '!=',
+    'gt': '>',
+    'gte': '>=',
+    'lt': '<',
+    'lte': '<=',
+    'in': 'IN',
+}
+
+def compile_metadata_query(filters=None, sort=None, cursor=None):
+    """Compile metadata predicates and sort keys to SQL.
+
+    ``filters`` is a list of ``(key, operator, value)`` tuples where the
+    operator is one of METADATA_FILTER_OPERATORS; ``in`` takes a list of
+    values. ``sort`` is a comma-separated list of keys, each optionally
+    prefixed with ``-`` for descending order. Returns ``(where, order_by,
+    params)`` for a query over ``documents d``. Keys are inlined as json
+    paths so the expression indexes match; values are always bound.
+    Raises ValueError for invalid keys, operators or boolean values.
+    """
+    filters = filters or []
+    if cursor is None:
+        cursor = get_db_connection().cursor()
+
+    value_types = {}
+    keys = sorted({key for key, _, _ in filters})
+    if keys:
+        placeholders = ', '.join('?' for _ in keys)
+        cursor.execute(f'SELECT key, value_type FROM metadata_keys WHERE key IN ({placeholders})', keys)
+        value_types = {row['key']: row['value_type'] for row in cursor.fetchall()}
+
+    clauses = []
+    params = []
+    for key, operator, value in filters:
+        if operator not in METADATA_FILTER_OPERATORS:
+            raise ValueError(f"Invalid filter operator: {operator}")
+        expression = f"json_extract(d.metadata, '{metadata_json_path(key)}')"
+        if operator == 'in':
+            values = [_coerce_metadata_value(v, value_types.get(key)) for v in value]
+            if not values:
+                raise ValueError(f"Empty 'in' filter for key: {key}")
+            clauses.append(f"{expression} IN ({', '.join('?' for _ in values)})")
+            params.extend(values)
+        else:
+            clauses.append(f"{expression} {METADATA_FILTER_OPERATORS[operator]} ?")
+            params.append(_coerce_metadata_value(value, value_types.get(key)))
+
+    order_by = []
+    for sort_key in (sort or '').split(','):
+        sort_key = sort_key.strip()
+        if not sort_key:
+            continue
+        direction = 'DESC' if sort_key.startswith('-') else 'ASC'
+        order_by.append(f"json_extract(d.metadata, '{metadata_json_path(sort_key.lstrip('-'))}') {direction}")
+    order_by.append('d.id DESC')
+
+    where = ' AND '.join(clauses) if clauses else '1'
+    return where, ', '.join(order_by), params
+
+# A stored CURRENT_TIMESTAMP rendered as an HTTP date
+# ('Mon, 19 Oct 2026 09:27:55 GMT'), the form Flask gives datetimes.
+HTTP_DATE_SQL = (
+    "substr('SunMonTueWedThuFriSat', 1 + 3 * strftime('%w', {column}), 3)"
+    " || strftime(', %d ', {column})"
+    " || substr('JanFebMarAprMayJunJulAugSepOctNovDec', 3 * strftime('%m', {column}) - 2, 3)"
+    " || strftime(' %Y %H:%M:%S GMT', {column})"
+)
+
+# Builds each document, with its versions and HTML files, as one JSON text
+# inside SQLite. Metadata is embedded through json() so it is never decoded
+# and re-encoded in Python. file_consistent() is registered per connection.
+DOCUMENT_JSON_SQL = '''
+    SELECT json_object(
+        'id', d.id,
+        'doc_id', d.doc_id,
+        'metadata', json(d.metadata),
+        'latest_version', d.latest_version,
+        'versions', (
+            SELECT json_group_array(json(version_json)) FROM (
+                SELECT json_object(
+                    'id', v.id,
+                    'document_id', v.document_id,
+                    'version', v.version,
+                    'change_description', v.change_description,
+                    'file_path', v.file_path,
+                    'created_at', {created_at},
+                    'tier', v.tier,
+                    'file_consistent', json(CASE WHEN file_consistent(COALESCE(v.archive_path, v.file_path)) THEN 'true' ELSE 'false' END),
+                    'html_paths', (
+                        SELECT json_group_array(json_object(
+                            'path', h.file_path,
+                            'consistent', json(CASE WHEN file_consistent(COALESCE(h.archive_path, h.file_path)) THEN 'true' ELSE 'false' END)
+                        ))
+                        FROM html_documents h
+                        WHERE h.version_id = v.id
+                    )
+                ) AS version_json
+                FROM versions v
+                WHERE v.document_id = d.id
+                ORDER BY v.version DESC
+            )
         )
-    ''')
+    ) AS document_json
+    FROM documents d
+    WHERE {where}
+    ORDER BY {order_by}
+'''
+
+def query_documents_json(filters=None, sort=None, where=None, params=(), file_consistent=None):
+    """Return one JSON text per matching document, built entirely in SQL.
+
+    ``filters`` and ``sort`` are passed to compile_metadata_query. An extra
+    ``where`` clause over ``documents d`` (with its ``params``) can be given
+    to narrow the result further. ``file_consistent`` is called with each
+    stored file path and defaults to os.path.exists.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    if file_consistent is None:
+        file_consistent = os.path.exists
+    conn.create_function('file_consistent', 1, file_consistent)
 
-    conn.commit()
+    metadata_where, order_by, query_params = compile_metadata_query(filters, sort, cursor)
+    if where:
+        metadata_where = f'({metadata_where}) AND ({where})'
+        query_params = query_params + list(params)
+
+    sql = DOCUMENT_JSON_SQL.format(where=metadata_where, order_by=order_by,
+                                   created_at=HTTP_DATE_SQL.format(column='v.created_at'))
+    cursor.execute(sql, query_params)
+    return [row['document_json'] for row in cursor.fetchall()]
+
+if __name__ == '__main__':
+    conn = sqlite3.connect(DATABASE_NAME)
+    conn.row_factory = sqlite3.Row
+    create_tables(conn)
     conn.close()
 
 
@@ -267,22 +897,22 @@ if __name__ == '__main__':
     cursor = conn.cursor()
 
     doc_id = "example_doc_1"
-    metadata = json.dumps({"title": "Example Document", "author": "Gemini"})
+    metadata = {"title": "Example Document", "author": "Gemini"}
     file_path = "uploads/example_doc_1_v1.pdf"
     change_description = "Initial upload"
 
-    cursor.execute('INSERT OR IGNORE INTO documents (doc_id, metadata) VALUES (?, ?)', (doc_id, metadata))
-    document_id = cursor.lastrowid
-
-    # If document already exists, get its ID
-    if not document_id:
-        cursor.execute('SELECT id FROM documents WHERE doc_id = ?', (doc_id,))
-        document_id = cursor.fetchone()['id']
-
-    cursor.execute(
-        'INSERT INTO versions (document_id, version, change_description, file_path) VALUES (?, ?, ?, ?)',
-        (document_id, 1, change_description, file_path)
-    )
+    # Only add the example once, so rerunning the script does not trip the
+    # unique (document_id, version) index or stack up example versions
+    begin_immediate(conn)
+    if cursor.execute('SELECT 1 FROM documents WHERE doc_id = ?', (doc_id,)).fetchone() is None:
+        document_id, version, _ = allocate_version(cursor, doc_id, metadata)
+        cursor.execute(
+            'INSERT INTO versions (document_id, version, change_description, file_path) VALUES (?, ?, ?, ?)',
+            (document_id, version, change_description, file_path)
+        )
+        record_change(cursor, doc_id, 'document_created')
+        record_change(cursor, doc_id, 'version_added', version)
     conn.commit()
+    rebuild_metadata_keys(conn)
     conn.close()
     print(f"Added example document: {doc_id}, version 1")
\ No newline at end of file
@@ -0,0 +1,200 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from storage import get_storage, shard_key, storage_path
+
+# Crash-safe uploads. Files are first written to a hidden staging prefix of
+# the storage backend (for local storage, a directory inside UPLOAD_FOLDER
+# on the same filesystem, so renames are atomic) and fsynced. The document
+# rows and one upload_journal row per file are then committed in a single
+# transaction, after which the staged files are moved into place and the
+# journal rows deleted. Journal rows hold storage keys.
+#
+# A crash before the commit leaves only staged files, which recovery
+# deletes. A crash after it leaves journal rows, which recovery uses to
+# finish the renames. Either way no file ends up without a row. A move
+# that keeps failing after the commit does not fail the upload, whose rows
+# are durable: its journal rows stay and the next request replays them.
+
+logger = logging.getLogger(__name__)
+
+STAGING_DIR = '.staging'
+# Staged files younger than this may belong to an upload still in progress
+# in another worker process, so recovery leaves them alone.
+STAGING_GRACE_SECONDS = 3600
+MOVE_ATTEMPTS = 3
+MOVE_RETRY_SECONDS = 0.1
+
+_recovery_lock = threading.Lock()
+# Set when a committed upload left journal rows behind
+_replay_needed = threading.Event()
+
+
+def staging_folder(upload_folder):
+    return os.path.join(upload_folder, STAGING_DIR)
+
+
+class StagedUpload:
+    """Files and rows of one upload, published atomically.
+
+    Use as a context manager around the database writes::
+
+        with StagedUpload(conn, storage, upload_folder) as upload:
+            path, size, checksum = upload.stage(file)
+            ... insert rows referencing path ...
+            upload.commit()
+
+    If the block raises before ``commit()``, the transaction is rolled
+    back and the staged files are deleted.
+    """
+
+    def __init__(self, conn, storage, upload_folder):
+        self.conn = conn
+        self.storage = storage
+        self.upload_folder = upload_folder
+        self.staged = []  # (staging key, final key)
+        self.committed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None and not self.committed:
+            self.conn.rollback()
+            self.discard()
+        return False
+
+    def stage(self, file):
+        """Write an uploaded file to the staging area.
+
+        Returns the path the file will have once published, its size and
+        its SHA-256 hex digest.
+        """
+        return self.stage_stream(file.filename, file.stream, file.mimetype)
+
+    def stage_stream(self, filename, stream, content_type=None):
+        """Like stage(), for a readable binary ``stream`` uploaded as ``filename``."""
+        filename = str(uuid.uuid4()) + os.path.splitext(filename)[1]
+        staging_key = f'{STAGING_DIR}/{filename}'
+        key = shard_key(filename)
+        self.staged.append((staging_key, key))
+        size, checksum = self.storage.put_stream(staging_key, stream, content_type)
+        return storage_path(self.upload_folder, key), size, checksum
+
+    def commit(self):
+        """Commit the transaction together with the journal, then publish the files.
+
+        Once the rows are committed this does not raise: files that cannot
+        be moved into place are left to the journal replay.
+        """
+        cursor = self.conn.cursor()
+        cursor.executemany('INSERT INTO upload_journal (staging_path, final_path) VALUES (?, ?)', self.staged)
+        self.conn.commit()
+        self.committed = True
+
+        published = [(staging_key,) for staging_key, key in self.staged if self.publish(staging_key, key)]
+        try:
+            cursor.executemany('DELETE FROM upload_journal WHERE staging_path = ?', published)
+            self.conn.commit()
+        except sqlite3.Error:
+            logger.exception("Could not clear the upload journal; it will be replayed")
+            self.conn.rollback()
+            _replay_needed.set()
+        if len(published) < len(self.staged):
+            _replay_needed.set()
+
+    def publish(self, staging_key, key):
+        """Move a staged file into place, retrying with backoff. Returns False if it is still staged."""
+        for attempt in range(MOVE_ATTEMPTS):
+            try:
+                move_staged(self.storage, staging_key, key)
+                return True
+            except Exception:
+                if attempt == MOVE_ATTEMPTS - 1:
+                    logger.exception("Could not publish %s; the upload journal will retry", key)
+                    return False
+                time.sleep(MOVE_RETRY_SECONDS * 2 ** attempt)
+
+    def discard(self):
+        for staging_key, _ in self.staged:
+            self.storage.delete(staging_key)
+        self.staged = []
+
+
+def move_staged(storage, staging_key, key):
+    try:
+        storage.move(staging_key, key)
+    except FileNotFoundError:
+        # Published concurrently, by recovery or by the upload itself
+        if not storage.exists(key):
+            raise
+
+
+def replay_journal(conn, storage):
+    """Move the files of committed uploads into place. Returns how many were moved."""
+    cursor = conn.cursor()
+    try:
+        cursor.execute('SELECT id, staging_path, final_path FROM upload_journal')
+    except sqlite3.OperationalError:
+        # Schema not created yet, so there cannot be any journaled uploads
+        return 0
+    completed = 0
+    for row_id, staging_key, key in cursor.fetchall():
+        if storage.exists(staging_key):
+            move_staged(storage, staging_key, key)
+            completed += 1
+        elif not storage.exists(key):
+            logger.warning("Upload journal entry %s has neither %s nor %s", row_id, staging_key, key)
+        cursor.execute('DELETE FROM upload_journal WHERE id = ?', (row_id,))
+    conn.commit()
+    return completed
+
+
+def recover_uploads(conn, storage, grace_seconds=STAGING_GRACE_SECONDS):
+    """Finish committed uploads and delete staged files that were never committed.
+
+    Returns ``(completed, discarded)`` counts.
+    """
+    completed = replay_journal(conn, storage)
+
+    # Anything left in staging has no committed rows
+    discarded = 0
+    cutoff = time.time() - grace_seconds
+    for info in list(storage.list(STAGING_DIR + '/')):
+        if info.modified <= cutoff:
+            storage.delete(info.key)
+            discarded += 1
+    if completed or discarded:
+        logger.info("Upload recovery completed %d and discarded %d staged files", completed, discarded)
+    return completed, discarded
+
+
+def init_ingest(app, get_connection):
+    """Run recover_uploads once per database/upload folder before the first request.
+
+    The journal is also replayed on the request after an upload could not
+    publish its files.
+    """
+    recovered = app.extensions.setdefault('ingest_recovered', set())
+
+    def recover_once():
+        key = (app.config.get('DATABASE'), app.config['UPLOAD_FOLDER'])
+        if key in recovered and not _replay_needed.is_set():
+            return
+        with _recovery_lock:
+            if key not in recovered:
+                recover_uploads(get_connection(), get_storage(app))
+                recovered.add(key)
+            elif _replay_needed.is_set():
+                _replay_needed.clear()
+                try:
+                    replay_journal(get_connection(), get_storage(app))
+                except Exception:
+                    _replay_needed.set()
+                    logger.exception("Upload journal replay failed")
+
+    app.before_request(recover_once)
@@ -0,0 +1,73 @@
+import time
+from flask import current_app, g, has_app_context, has_request_context, request
+import metrics
+
+# Per-request accounting of where time goes: SQL statements (counted by the
+# sqlite3 trace callback, timed by the instrumented cursor in database.py),
+# filesystem checks and JSON serialization. Totals are folded into the
+# process-wide histograms in ``metrics`` when the request finishes.
+
+def init_instrumentation(app):
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+
+def _start_request():
+    g.request_started = time.perf_counter()
+    g.sql_statements = 0
+    g.sql_seconds = 0.0
+    g.fs_checks = 0
+    g.fs_seconds = 0.0
+    g.serialization_seconds = 0.0
+
+def _route():
+    return request.endpoint or 'unmatched'
+
+def record_sql_statement(statement):
+    """sqlite3 trace callback: called once for every statement SQLite runs."""
+    if has_app_context() and 'sql_statements' in g:
+        g.sql_statements += 1
+
+def record_sql_time(seconds):
+    if has_app_context() and 'sql_seconds' in g:
+        g.sql_seconds += seconds
+
+def record_fs_check(seconds):
+    if has_app_context() and 'fs_checks' in g:
+        g.fs_checks += 1
+        g.fs_seconds += seconds
+
+def record_serialization_time(seconds):
+    if has_request_context():
+        g.serialization_seconds = g.get('serialization_seconds', 0.0) + seconds
+        metrics.observe('serialization_seconds', seconds, route=_route())
+    else:
+        metrics.observe('serialization_seconds', seconds, route='none')
+
+def record_upload(num_bytes, seconds):
+    metrics.increment('upload_bytes_total', num_bytes)
+    if seconds > 0:
+        metrics.observe('upload_throughput_bytes_per_second', num_bytes / seconds,
+                        buckets=metrics.THROUGHPUT_BUCKETS)
+
+def _finish_request(response):
+    if 'request_started' not in g:
+        return response
+    duration = time.perf_counter() - g.request_started
+    route = _route()
+
+    metrics.increment('requests_total', route=route, method=request.method, status=response.status_code)
+    metrics.observe('request_duration_seconds', duration, route=route, method=request.method)
+    metrics.increment('sql_statements_total', g.sql_statements, route=route)
+    metrics.observe('sql_duration_seconds', g.sql_seconds, route=route)
+    if g.fs_checks:
+        metrics.increment('fs_checks_total', g.fs_checks, route=route)
+        metrics.observe('fs_check_duration_seconds', g.fs_seconds, route=route)
+
+    if current_app.config.get('SERVER_TIMING'):
+        response.headers['Server-Timing'] = ', '.join([
+            f'sql;dur={g.sql_seconds * 1000:.3f};desc="{g.sql_statements} statements"',
+            f'fs;dur={g.fs_seconds * 1000:.3f};desc="{g.fs_checks} checks"',
+            f'serialize;dur={g.serialization_seconds * 1000:.3f}',
+            f'total;dur={duration * 1000:.3f}',
+        ])
+    return response
@@ -0,0 +1,284 @@
+"""Check that the files in UPLOAD_FOLDER match what the database references.
+
+The scan walks the upload folder with ``os.scandir`` and cross-references
+``versions.file_path`` and ``html_documents.file_path`` with set
+operations, giving three lists:
+
+* missing: referenced by a row but not on disk
+* orphaned: on disk but not referenced by any row
+* corrupt: size or SHA-256 differs from what was recorded at upload, or a
+  PDF without a ``%PDF-`` header or a trailing ``%%EOF`` marker (truncated)
+
+Files are verified in a process pool. Each finished file is appended to an
+optional checkpoint file, so an interrupted scan or one stopped by
+``max_seconds`` resumes where it left off instead of rehashing everything.
+``max_seconds`` also bounds the walk of the upload folder.
+
+Usage::
+
+    python integrity.py --database pdf_browser.db --uploads uploads --workers 8 --checkpoint scan.ckpt
+"""
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+HASH_CHUNK_SIZE = 1024 * 1024
+PDF_TAIL_BYTES = 1024
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def walk_files(root):
+    """Yield ``(absolute path, size, mtime_ns)`` for every file under ``root``.
+
+    Hidden files and directories (such as upload staging areas) are skipped.
+    """
+    stack = [os.path.abspath(root)]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    yield entry.path, stat.st_size, stat.st_mtime_ns
+
+
+def load_references(conn, base_dir):
+    """Map absolute file path to the rows that reference it.
+
+    Cold rows reference their compressed archive, whose size and checksum
+    are not recorded (see tiering.py).
+    """
+    references = {}
+    for table in ('versions', 'html_documents'):
+        for row in conn.execute(f'SELECT id, COALESCE(archive_path, file_path), file_size, checksum, archive_path IS NOT NULL FROM {table}'):
+            path = os.path.normpath(os.path.join(base_dir, row[1]))
+            archived = bool(row[4])
+            references.setdefault(path, []).append({
+                'table': table, 'id': row[0], 'archived': archived,
+                'file_size': None if archived else row[2], 'checksum': None if archived else row[3],
+            })
+    return references
+
+
+def verify_file(task):
+    """Check one file. Runs in a worker process.
+
+    ``task`` is ``(path, expected_size, expected_checksum, compute_hash)``.
+    Returns ``(path, problems, checksum)``; ``checksum`` is None when the
+    file was not hashed.
+    """
+    path, expected_size, expected_checksum, compute_hash = task
+    problems = []
+    checksum = None
+    try:
+        size = os.path.getsize(path)
+        if expected_size is not None and size != expected_size:
+            problems.append(f'size {size} != recorded {expected_size}')
+        if path.lower().endswith('.pdf'):
+            with open(path, 'rb') as f:
+                if not f.read(5) == b'%PDF-':
+                    problems.append('missing %PDF- header')
+                f.seek(max(0, size - PDF_TAIL_BYTES))
+                if b'%%EOF' not in f.read():
+                    problems.append('missing %%EOF marker (truncated?)')
+        if compute_hash:
+            checksum = hash_file(path)
+            if expected_checksum is not None and checksum != expected_checksum:
+                problems.append('checksum mismatch')
+    except OSError as e:
+        problems.append(f'unreadable: {e.strerror}')
+    return path, problems, checksum
+
+
+def _load_checkpoint(path):
+    done = {}
+    if path and os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # partial line from an interrupted write
+                done[(record['path'], record['size'], record['mtime_ns'])] = record
+    return done
+
+
+def scan(conn, upload_folder, base_dir='.', workers=None, verify_hashes=True, checkpoint_path=None,
+         max_seconds=None, backfill=False):
+    """Cross-reference ``upload_folder`` with the database and verify files.
+
+    Paths stored in the database are resolved against ``base_dir``.
+    ``workers=0`` verifies in the calling process. When ``backfill`` is
+    true, sizes and checksums are stored for rows that have none yet.
+    Returns a JSON-serializable report; ``complete`` is False when
+    ``max_seconds`` ran out before every file was listed and verified. An
+    incomplete listing reports no missing files.
+    """
+    started = time.perf_counter()
+    deadline = started + max_seconds if max_seconds is not None else None
+    base_dir = os.path.abspath(base_dir)
+
+    # The deadline covers the walk too: a huge tree must not be listed in
+    # full before max_seconds is first looked at.
+    on_disk = {}
+    timed_out = False
+    for path, size, mtime_ns in walk_files(upload_folder):
+        if deadline is not None and time.perf_counter() > deadline:
+            timed_out = True
+            break
+        on_disk[path] = (size, mtime_ns)
+    references = load_references(conn, base_dir)
+    disk_paths, referenced_paths = set(on_disk), set(references)
+    # Files not reached by an interrupted walk would look missing
+    missing = set() if timed_out else referenced_paths - disk_paths
+    orphaned = disk_paths - referenced_paths
+    to_verify = sorted(disk_paths & referenced_paths)
+
+    checkpoint = _load_checkpoint(checkpoint_path)
+    results = {}
+    tasks = []
+    for path in to_verify:
+        size, mtime_ns = on_disk[path]
+        previous = checkpoint.get((path, size, mtime_ns))
+        if previous is not None:
+            results[path] = (previous['problems'], previous['checksum'])
+            continue
+        rows = references[path]
+        expected_size = next((r['file_size'] for r in rows if r['file_size'] is not None), None)
+        expected_checksum = next((r['checksum'] for r in rows if r['checksum'] is not None), None)
+        compute_hash = verify_hashes and (expected_checksum is not None or backfill)
+        tasks.append((path, expected_size, expected_checksum, compute_hash))
+
+    checkpoint_file = open(checkpoint_path, 'a') if checkpoint_path else None
+
+    def record(result):
+        path, problems, checksum = result
+        results[path] = (problems, checksum)
+        if checkpoint_file:
+            size, mtime_ns = on_disk[path]
+            checkpoint_file.write(json.dumps({'path': path, 'size': size, 'mtime_ns': mtime_ns,
+                                              'problems': problems, 'checksum': checksum}) + '\n')
+            checkpoint_file.flush()
+
+    try:
+        if timed_out:
+            pass
+        elif workers == 0:
+            for task in tasks:
+                if deadline is not None and time.perf_counter() > deadline:
+                    timed_out = True
+                    break
+                record(verify_file(task))
+        elif tasks:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                pending = set()
+                queue = iter(tasks)
+                # Keep a bounded number of tasks in flight so a huge tree
+                # does not queue millions of futures up front.
+                limit = (workers or os.cpu_count() or 1) * 4
+                while True:
+                    if not timed_out:
+                        for task in queue:
+                            pending.add(pool.submit(verify_file, task))
+                            if len(pending) >= limit:
+                                break
+                    if not pending:
+                        break
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        record(future.result())
+                    if deadline is not None and time.perf_counter() > deadline:
+                        timed_out = True
+                        for future in pending:
+                            future.cancel()
+                        done, _ = wait(pending)
+                        for future in done:
+                            if not future.cancelled():
+                                record(future.result())
+                        pending = set()
+    finally:
+        if checkpoint_file:
+            checkpoint_file.close()
+
+    complete = not timed_out and len(results) == len(to_verify)
+    if backfill:
+        _backfill(conn, references, on_disk, results)
+    if complete and checkpoint_path and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    def rel(path):
+        return os.path.relpath(path, base_dir)
+
+    corrupt = [{'path': rel(path), 'problems': problems}
+               for path, (problems, _) in sorted(results.items()) if problems]
+    return {
+        'complete': complete,
+        'duration_seconds': time.perf_counter() - started,
+        'files_on_disk': len(on_disk),
+        'bytes_on_disk': sum(size for size, _ in on_disk.values()),
+        'referenced_files': len(references),
+        'verified': len(results),
+        'hashed': sum(1 for _, checksum in results.values() if checksum is not None),
+        'missing': sorted(rel(p) for p in missing),
+        'orphaned': sorted(rel(p) for p in orphaned),
+        'corrupt': corrupt,
+    }
+
+
+def _backfill(conn, references, on_disk, results):
+    updates = {'versions': [], 'html_documents': []}
+    for path, (problems, checksum) in results.items():
+        if problems or checksum is None:
+            continue
+        for row in references[path]:
+            if row['checksum'] is None and not row['archived']:
+                updates[row['table']].append((on_disk[path][0], checksum, row['id']))
+    for table, rows in updates.items():
+        conn.executemany(f'UPDATE {table} SET file_size = ?, checksum = ? WHERE id = ?', rows)
+    conn.commit()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Find missing, orphaned and corrupt uploaded files.")
+    parser.add_argument("--database", default='pdf_browser.db', help="SQLite database file.")
+    parser.add_argument("--uploads", default='uploads', help="Upload folder to scan.")
+    parser.add_argument("--base-dir", default='.', help="Directory the stored file paths are relative to.")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: CPU count, 0 = in-process).")
+    parser.add_argument("--no-hash", action="store_true", help="Only check existence, sizes and PDF structure.")
+    parser.add_argument("--checkpoint", help="Progress file for resuming an interrupted scan.")
+    parser.add_argument("--max-seconds", type=float, help="Stop verifying after this long; rerun with --checkpoint to continue.")
+    parser.add_argument("--backfill", action="store_true", help="Store sizes and checksums for rows that have none.")
+    args = parser.parse_args(argv)
+
+    conn = sqlite3.connect(args.database)
+    try:
+        report = scan(conn, args.uploads, base_dir=args.base_dir, workers=args.workers,
+                      verify_hashes=not args.no_hash, checkpoint_path=args.checkpoint,
+                      max_seconds=args.max_seconds, backfill=args.backfill)
+    finally:
+        conn.close()
+    print(json.dumps(report, indent=2))
+    return 0 if not (report['missing'] or report['orphaned'] or report['corrupt']) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
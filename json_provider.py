@@ -0,0 +1,114 @@
+import json
+import re
+import time
+import uuid
+from flask.json.provider import DefaultJSONProvider
+from instrumentation import record_serialization_time
+
+try:
+    import orjson
+except ImportError: # orjson is an optional speed-up
+    orjson = None
+
+
+class RawJSON:
+    """JSON text that is already serialized, e.g. a row built by SQLite.
+
+    It is spliced into the output verbatim instead of being decoded and
+    encoded again.
+    """
+    __slots__ = ('text',)
+
+    def __init__(self, text):
+        self.text = text
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """JSON provider that uses orjson when it is installed.
+
+    Falls back to the stdlib encoder when orjson is missing, when
+    ``use_orjson`` is False, or for calls that need options orjson does not
+    support (indentation, a custom ``default``...). Both paths understand
+    RawJSON values. Time spent serializing responses is recorded per
+    request by ``instrumentation``.
+    """
+
+    use_orjson = orjson is not None
+
+    def dumps(self, obj, **kwargs):
+        return self._dumps(obj, kwargs).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if self.use_orjson and not kwargs:
+            return orjson.loads(s)
+        return super().loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        dump_args = {}
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            dump_args['indent'] = 2
+        else:
+            dump_args['separators'] = (',', ':')
+
+        start = time.perf_counter()
+        body = self._dumps(obj, dump_args)
+        record_serialization_time(time.perf_counter() - start)
+        return self._app.response_class(body + b'\n', mimetype=self.mimetype)
+
+    def _dumps(self, obj, kwargs):
+        # Common case for the document listing: a list of pre-built rows
+        if isinstance(obj, list) and obj and all(isinstance(item, RawJSON) for item in obj):
+            return ('[' + ','.join(item.text for item in obj) + ']').encode('utf-8')
+
+        if self.use_orjson and set(kwargs) <= {'separators'}:
+            return self._dumps_orjson(obj)
+        return self._dumps_stdlib(obj, kwargs).encode('utf-8')
+
+    def _dumps_orjson(self, obj):
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+
+        fragment = getattr(orjson, 'Fragment', None)
+        raw_values = []
+        token = uuid.uuid4().hex
+
+        def default(o):
+            if isinstance(o, RawJSON):
+                if fragment is not None:
+                    return fragment(o.text)
+                raw_values.append(o.text)
+                return f'\x00{token}:{len(raw_values) - 1}\x00'
+            return self.default(o)
+
+        body = orjson.dumps(obj, default=default, option=option)
+        if raw_values:
+            body = _splice(body.decode('utf-8'), token, raw_values).encode('utf-8')
+        return body
+
+    def _dumps_stdlib(self, obj, kwargs):
+        raw_values = []
+        token = uuid.uuid4().hex
+        fallback = kwargs.pop('default', self.default)
+
+        def default(o):
+            if isinstance(o, RawJSON):
+                raw_values.append(o.text)
+                return f'\x00{token}:{len(raw_values) - 1}\x00'
+            return fallback(o)
+
+        kwargs.setdefault('ensure_ascii', self.ensure_ascii)
+        kwargs.setdefault('sort_keys', self.sort_keys)
+        body = json.dumps(obj, default=default, **kwargs)
+        if raw_values:
+            body = _splice(body, token, raw_values)
+        return body
+
+
+def _splice(body, token, raw_values):
+    # Both encoders escape the NUL markers as \u0000, which cannot clash
+    # with a real string because the token is random per call.
+    pattern = re.compile(r'"\\u0000' + token + r':(\d+)\\u0000"')
+    return pattern.sub(lambda m: raw_values[int(m.group(1))], body)
+
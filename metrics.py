@@ -0,0 +1,126 @@
+import threading
+from collections import Counter
+
+# Process-wide metrics: counters (e.g. how many times /search was called),
+# gauges (e.g. uploads currently in flight) and histograms (e.g. request
+# latency per route). All accept labels and can be rendered in the
+# Prometheus text exposition format.
+
+# Upper bounds for latency histograms, in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds for throughput histograms, in bytes per second
+THROUGHPUT_BUCKETS = (1e5, 1e6, 1e7, 5e7, 1e8, 5e8, 1e9)
+
+_lock = threading.Lock()
+_counters = Counter()
+_gauges = {}
+_histograms = {}
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.bucket_counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+                break
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape_label_value(v)}"' for k, v in pairs) + '}'
+
+def increment(name, amount=1, **labels):
+    with _lock:
+        _counters[_key(name, labels)] += amount
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+def observe(name, value, buckets=None, **labels):
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram(buckets or DEFAULT_BUCKETS)
+        histogram.observe(value)
+
+def get_counters():
+    with _lock:
+        return {name + _format_labels(labels): value for (name, labels), value in _counters.items()}
+
+def get_gauges():
+    with _lock:
+        return {name + _format_labels(labels): value for (name, labels), value in _gauges.items()}
+
+def get_timings():
+    with _lock:
+        return {
+            name + _format_labels(labels): {
+                'count': h.count,
+                'total_seconds': h.sum,
+                'mean_seconds': h.sum / h.count,
+                'max_seconds': h.max,
+            }
+            for (name, labels), h in _histograms.items()
+        }
+
+def render_prometheus(prefix='pdf_browser'):
+    lines = []
+    with _lock:
+        counters = sorted(_counters.items())
+        gauges = sorted(_gauges.items())
+        histograms = sorted(_histograms.items(), key=lambda item: item[0])
+
+        declared = set()
+        for (name, labels), value in counters:
+            metric = f'{prefix}_{name}' if name.endswith('_total') else f'{prefix}_{name}_total'
+            if metric not in declared:
+                lines.append(f'# TYPE {metric} counter')
+                declared.add(metric)
+            lines.append(f'{metric}{_format_labels(labels)} {value}')
+
+        for (name, labels), value in gauges:
+            metric = f'{prefix}_{name}'
+            if metric not in declared:
+                lines.append(f'# TYPE {metric} gauge')
+                declared.add(metric)
+            lines.append(f'{metric}{_format_labels(labels)} {value}')
+
+        for (name, labels), h in histograms:
+            metric = f'{prefix}_{name}'
+            if metric not in declared:
+                lines.append(f'# TYPE {metric} histogram')
+                declared.add(metric)
+            cumulative = 0
+            for bound, count in zip(h.buckets, h.bucket_counts):
+                cumulative += count
+                lines.append(f'{metric}_bucket{_format_labels(labels, [("le", repr(float(bound)))])} {cumulative}')
+            lines.append(f'{metric}_bucket{_format_labels(labels, [("le", "+Inf")])} {h.count}')
+            lines.append(f'{metric}_sum{_format_labels(labels)} {h.sum}')
+            lines.append(f'{metric}_count{_format_labels(labels)} {h.count}')
+    return '\n'.join(lines) + '\n'
+
+def reset_counters():
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
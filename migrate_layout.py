@@ -0,0 +1,105 @@
+"""Move flat uploads (``uploads/<name>``) to the sharded layout (``uploads/ab/cd/<name>``).
+
+The migration runs online, next to a live server. Rows of ``versions`` and
+``html_documents`` are processed in batches of ``batch_size``. For each
+batch the files are moved first, then the rows are updated in one
+transaction. A crash between the two leaves rows pointing at the old flat
+path. ``/uploads`` still resolves those, and the next run sees that the
+file has already moved and just updates the row. If a row was deleted
+while its file was being moved, the moved file is tombstoned for the
+reaper instead of being left orphaned.
+
+Usage::
+
+    python migrate_layout.py --database pdf_browser.db --uploads uploads --batch-size 500 --pause 0.1
+"""
+import argparse
+import json
+import logging
+import sys
+import time
+
+from database import DATABASE_NAME, get_db_connection, tombstone_files
+from storage import LocalStorage, shard_key, storage_key, storage_path
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+TABLES = ('versions', 'html_documents')
+
+
+def migrate_batch(conn, storage, upload_folder, table, rows):
+    """Move the files of ``rows`` (``(id, file_path)``) and repoint the rows.
+
+    Returns ``(moved, missing)`` counts.
+    """
+    updates = []
+    missing = 0
+    for row_id, file_path in rows:
+        key = storage_key(file_path, upload_folder)
+        new_key = shard_key(key)
+        if storage.exists(key):
+            storage.move(key, new_key)
+        elif not storage.exists(new_key):
+            logger.warning("%s row %s references missing file %s", table, row_id, file_path)
+            missing += 1
+            continue
+        updates.append((storage_path(upload_folder, new_key), row_id, file_path))
+
+    cursor = conn.cursor()
+    orphaned = []
+    for new_path, row_id, old_path in updates:
+        cursor.execute(f'UPDATE {table} SET file_path = ? WHERE id = ? AND file_path = ?', (new_path, row_id, old_path))
+        if cursor.rowcount == 0:
+            orphaned.append(new_path)  # deleted or changed while the file moved
+    tombstone_files(cursor, orphaned)
+    conn.commit()
+    return len(updates) - len(orphaned), missing
+
+
+def migrate(conn, storage, upload_folder, batch_size=BATCH_SIZE, pause=0.0):
+    """Migrate every flat file referenced by the database.
+
+    ``pause`` seconds are slept between batches to leave room for the
+    server's own writes. Returns counts of moved and missing files.
+    """
+    moved = missing = 0
+    for table in TABLES:
+        last_id = 0
+        while True:
+            # Cold files are left alone; they are migrated once promoted back to hot
+            rows = conn.execute(f"SELECT id, file_path FROM {table} WHERE id > ? AND tier = 'hot' ORDER BY id LIMIT ?",
+                                (last_id, batch_size)).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            flat = [(row_id, path) for row_id, path in rows if '/' not in storage_key(path, upload_folder)]
+            if flat:
+                batch_moved, batch_missing = migrate_batch(conn, storage, upload_folder, table, flat)
+                moved += batch_moved
+                missing += batch_missing
+                if pause:
+                    time.sleep(pause)
+    return {'moved': moved, 'missing': missing}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Move flat uploads into the sharded directory layout.")
+    parser.add_argument("--database", default=DATABASE_NAME, help="SQLite database file.")
+    parser.add_argument("--uploads", default='uploads', help="Upload folder, as stored in the database file paths.")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Rows updated per transaction.")
+    parser.add_argument("--pause", type=float, default=0.0, help="Seconds to sleep between batches.")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    conn = get_db_connection(args.database)
+    try:
+        result = migrate(conn, LocalStorage(args.uploads), args.uploads, args.batch_size, args.pause)
+    finally:
+        conn.close()
+    print(json.dumps(result))
+    return 1 if result['missing'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
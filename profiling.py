@@ -0,0 +1,166 @@
+import cProfile
+import hmac
+import logging
+import os
+import random
+import re
+import threading
+import time
+
+try:
+    import pyinstrument
+    from pyinstrument.renderers import SpeedscopeRenderer
+except ImportError: # pyinstrument is only needed for speedscope output
+    pyinstrument = None
+
+# Opt-in request profiling. When PROFILING is enabled the WSGI app is
+# wrapped by ProfilingMiddleware, which profiles a random sample of
+# requests (PROFILE_SAMPLE_RATE) plus any request whose PROFILE_HEADER
+# header carries PROFILE_TOKEN. Without a token the header is ignored, so
+# clients cannot make the server write profiles. Profiles are written to PROFILE_DIR, which is
+# kept under PROFILE_MAX_FILES / PROFILE_MAX_BYTES by deleting the oldest
+# files first. When PROFILING is off nothing is wrapped, so requests pay
+# no cost at all.
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROFILE_DIR = 'profiles'
+DEFAULT_HEADER = 'X-Profile'
+PROFILE_EXTENSIONS = ('.prof', '.speedscope.json')
+
+
+def init_profiling(app):
+    if not app.config.get('PROFILING'):
+        return None
+    middleware = ProfilingMiddleware(
+        app.wsgi_app,
+        profile_dir=app.config.get('PROFILE_DIR', DEFAULT_PROFILE_DIR),
+        sample_rate=float(app.config.get('PROFILE_SAMPLE_RATE', 0.0)),
+        header=app.config.get('PROFILE_HEADER', DEFAULT_HEADER),
+        token=app.config.get('PROFILE_TOKEN'),
+        output=app.config.get('PROFILE_OUTPUT', 'pstats'),
+        max_files=app.config.get('PROFILE_MAX_FILES', 100),
+        max_bytes=app.config.get('PROFILE_MAX_BYTES'),
+    )
+    app.wsgi_app = middleware
+    app.extensions['profiling'] = middleware
+    return middleware
+
+
+class ProfilingMiddleware:
+    """WSGI middleware that profiles sampled or explicitly requested calls.
+
+    A request is profiled when ``random() < sample_rate`` or when it sends
+    ``header`` with ``token`` as its value. Without a token the header is
+    ignored.
+    Only one request is profiled at a time; others run unprofiled while a
+    profile is in progress. The profile covers the application call, so
+    streamed response bodies are not included.
+    """
+
+    def __init__(self, wsgi_app, profile_dir=DEFAULT_PROFILE_DIR, sample_rate=0.0, header=DEFAULT_HEADER,
+                 token=None, output='pstats', max_files=100, max_bytes=None):
+        if output not in ('pstats', 'speedscope'):
+            raise ValueError("output must be 'pstats' or 'speedscope'")
+        if output == 'speedscope' and pyinstrument is None:
+            logger.warning("pyinstrument is not installed; writing pstats profiles instead of speedscope")
+            output = 'pstats'
+        self.wsgi_app = wsgi_app
+        self.profile_dir = profile_dir
+        self.sample_rate = sample_rate
+        self.environ_key = 'HTTP_' + header.upper().replace('-', '_')
+        if not token:
+            logger.warning("PROFILE_TOKEN is not set; the %s header is ignored", header)
+        self.token = token
+        self.output = output
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def should_profile(self, environ):
+        requested = environ.get(self.environ_key)
+        if requested is not None and self.token and hmac.compare_digest(requested.encode(), self.token.encode()):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def __call__(self, environ, start_response):
+        if not self.should_profile(environ) or not self._lock.acquire(blocking=False):
+            return self.wsgi_app(environ, start_response)
+        try:
+            return self._profile(environ, start_response)
+        finally:
+            self._lock.release()
+
+    def _profile(self, environ, start_response):
+        start = time.perf_counter()
+        if self.output == 'speedscope':
+            profiler = pyinstrument.Profiler()
+            profiler.start()
+            try:
+                return self.wsgi_app(environ, start_response)
+            finally:
+                profiler.stop()
+                body = profiler.output(renderer=SpeedscopeRenderer())
+                self._save(environ, time.perf_counter() - start, '.speedscope.json',
+                           lambda path: _write_text(path, body))
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            return self.wsgi_app(environ, start_response)
+        finally:
+            profiler.disable()
+            self._save(environ, time.perf_counter() - start, '.prof', profiler.dump_stats)
+
+    def _save(self, environ, seconds, extension, write):
+        try:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            path = os.path.join(self.profile_dir, profile_filename(environ, seconds) + extension)
+            write(path)
+            self.evict()
+        except OSError:
+            logger.exception("Could not save request profile")
+
+    def evict(self):
+        """Delete the oldest profiles until the directory is within its limits."""
+        profiles = list_profiles(self.profile_dir)
+        total = sum(p['size'] for p in profiles)
+        # list_profiles returns newest first
+        while profiles and ((self.max_files is not None and len(profiles) > self.max_files) or
+                            (self.max_bytes is not None and total > self.max_bytes)):
+            oldest = profiles.pop()
+            total -= oldest['size']
+            try:
+                os.remove(os.path.join(self.profile_dir, oldest['name']))
+            except FileNotFoundError:
+                pass
+
+
+def profile_filename(environ, seconds):
+    """``<unix ms>-<METHOD>-<path slug>-<duration ms>ms``, safe for any OS."""
+    path = environ.get('PATH_INFO', '/').strip('/') or 'root'
+    slug = re.sub(r'[^A-Za-z0-9]+', '_', path)[:80]
+    return f"{int(time.time() * 1000)}-{environ.get('REQUEST_METHOD', 'GET')}-{slug}-{seconds * 1000:.0f}ms"
+
+
+def _write_text(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def list_profiles(profile_dir):
+    """Saved profiles, newest first."""
+    try:
+        entries = [e for e in os.scandir(profile_dir) if e.is_file() and e.name.endswith(PROFILE_EXTENSIONS)]
+    except FileNotFoundError:
+        return []
+    profiles = []
+    for entry in entries:
+        stat = entry.stat()
+        profiles.append({
+            'name': entry.name,
+            'size': stat.st_size,
+            'created': stat.st_mtime,
+            'format': 'speedscope' if entry.name.endswith('.speedscope.json') else 'pstats',
+        })
+    profiles.sort(key=lambda p: (p['created'], p['name']), reverse=True)
+    return profiles
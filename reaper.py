@@ -0,0 +1,179 @@
+"""Unlink files of deleted versions in the background.
+
+Deleting a version only records its files in ``file_tombstones`` inside the
+same transaction as the row deletes, so nothing is removed from disk if the
+transaction rolls back and no filesystem work happens while the SQLite
+write lock is held. The reaper then unlinks tombstoned files in batches.
+Files that cannot be removed stay queued and are retried with exponential
+backoff.
+
+Usage::
+
+    python reaper.py --database pdf_browser.db
+    python reaper.py --database /srv/pdf/pdf_browser.db --uploads uploads --base-dir /srv/pdf
+"""
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+
+from database import DATABASE_NAME, get_db_connection
+from storage import LocalStorage, get_storage, storage_key
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+MAX_BACKOFF_SECONDS = 3600
+REAPER_INTERVAL_SECONDS = 5.0
+
+
+def reap_tombstones(conn, batch_size=BATCH_SIZE, now=None, remove=None):
+    """Unlink every due tombstoned file, ``batch_size`` rows per transaction.
+
+    ``remove`` deletes one stored file path (default: ``os.remove``).
+    Missing files count as removed; any other error from ``remove``, such as
+    a storage backend's, is retried later. Returns ``(removed, failed)`` counts.
+    """
+    now = time.time() if now is None else now
+    remove = remove or os.remove
+    removed = failed = 0
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            'SELECT id, file_path, attempts FROM file_tombstones WHERE next_attempt_at <= ? AND id > ? ORDER BY id LIMIT ?',
+            (now, last_id, batch_size)
+        ).fetchall()
+        if not rows:
+            break
+        done = []
+        retries = []
+        for row_id, file_path, attempts in rows:
+            try:
+                remove(file_path)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                backoff = min(2 ** attempts, MAX_BACKOFF_SECONDS)
+                retries.append((attempts + 1, now + backoff, str(e), row_id))
+                logger.warning("Could not remove %s (attempt %d), retrying in %ds: %s", file_path, attempts + 1, backoff, e)
+                continue
+            done.append((row_id,))
+        conn.executemany('DELETE FROM file_tombstones WHERE id = ?', done)
+        conn.executemany('UPDATE file_tombstones SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?', retries)
+        conn.commit()
+        removed += len(done)
+        failed += len(retries)
+        last_id = rows[-1][0]
+    return removed, failed
+
+
+class TombstoneReaper:
+    """Background thread that runs reap_tombstones every ``interval`` seconds.
+
+    ``database`` is a path or a callable returning one, so the thread
+    follows configuration changes. ``remove`` is passed to reap_tombstones.
+    ``wake()`` triggers a pass right away, e.g. after a delete commits.
+    """
+
+    def __init__(self, database, interval=REAPER_INTERVAL_SECONDS, batch_size=BATCH_SIZE, remove=None):
+        self.database = database
+        self.remove = remove
+        self.interval = interval
+        self.batch_size = batch_size
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='tombstone-reaper', daemon=True)
+        self._thread.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                database = self.database() if callable(self.database) else self.database
+                if not os.path.exists(database):
+                    raise FileNotFoundError(database)
+                conn = get_db_connection(database)
+                try:
+                    reap_tombstones(conn, self.batch_size, remove=self.remove)
+                finally:
+                    conn.close()
+            except FileNotFoundError:
+                pass  # nothing to reap until the database exists
+            except Exception:
+                logger.exception("Tombstone reaper pass failed")
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+
+def init_reaper(app):
+    """Start the reaper thread on the first request unless TOMBSTONE_REAPER is off.
+
+    It is not started for testing apps, whose database changes between tests.
+    """
+    lock = threading.Lock()
+
+    def start_once():
+        if 'tombstone_reaper' in app.extensions or app.testing or not app.config.get('TOMBSTONE_REAPER', True):
+            return
+        with lock:
+            if 'tombstone_reaper' in app.extensions:
+                return
+            reaper = TombstoneReaper(
+                lambda: app.config.get('DATABASE') or DATABASE_NAME,
+                interval=app.config.get('TOMBSTONE_REAPER_INTERVAL', REAPER_INTERVAL_SECONDS),
+                remove=lambda path: get_storage(app).delete(storage_key(path, app.config['UPLOAD_FOLDER'])),
+            )
+            reaper.start()
+            app.extensions['tombstone_reaper'] = reaper
+
+    app.before_request(start_once)
+
+
+def wake_reaper(app):
+    reaper = app.extensions.get('tombstone_reaper')
+    if reaper is not None:
+        reaper.wake()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Unlink files queued by deleted versions.")
+    parser.add_argument("--database", default=DATABASE_NAME, help="SQLite database file.")
+    parser.add_argument("--uploads", help="Local upload folder, as stored in the database file paths "
+                                          "(default: the app's configured storage backend).")
+    parser.add_argument("--base-dir", default='.', help="Directory the stored file paths are relative to.")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Tombstones removed per transaction.")
+    args = parser.parse_args(argv)
+
+    # Files are removed through the storage backend, as the app's reaper
+    # thread does, so keys resolve the same way whatever the working directory.
+    if args.uploads:
+        storage, upload_folder = LocalStorage(os.path.join(args.base_dir, args.uploads)), args.uploads
+    else:
+        from app import app  # STORAGE_BACKEND, UPLOAD_FOLDER and S3_* settings, FLASK_* overrides
+        storage, upload_folder = get_storage(app), app.config['UPLOAD_FOLDER']
+
+    conn = get_db_connection(args.database)
+    try:
+        removed, failed = reap_tombstones(conn, args.batch_size,
+                                          remove=lambda path: storage.delete(storage_key(path, upload_folder)))
+    finally:
+        conn.close()
+    print(f"Removed {removed} files, {failed} left for retry.")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,221 @@
+import base64
+import binascii
+import logging
+import time
+import uuid
+
+from database import begin_immediate
+
+# Resumable chunked uploads, for files too large to send in one request.
+#
+# A client creates a session with the document fields and the file's total
+# size, then sends the file in fixed-size chunks, each with its byte offset
+# and optionally a SHA-256 checksum. Chunks may arrive in any order and in
+# parallel; re-sending a chunk replaces it. Each chunk is stored as its own
+# object under .sessions/<session id>/ so the protocol works with every
+# storage backend. Finalizing concatenates the chunks into a regular staged
+# upload (see ingest.py) and deletes the session in the same transaction
+# that creates the version.
+#
+# Sessions expire UPLOAD_SESSION_TTL_SECONDS after their last chunk, and
+# expire_sessions() deletes their rows and chunks.
+
+logger = logging.getLogger(__name__)
+
+SESSIONS_DIR = '.sessions'
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+MIN_CHUNK_SIZE = 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+SESSION_TTL_SECONDS = 24 * 3600
+READ_SIZE = 1024 * 1024
+
+SESSION_COLUMNS = ('id', 'doc_id', 'metadata', 'change_description', 'filename', 'total_size',
+                   'chunk_size', 'checksum', 'status', 'created_at', 'expires_at')
+
+
+class SessionError(Exception):
+    """A request that does not fit the upload session; ``status`` is the HTTP status to answer with."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def chunk_key(session_id, index):
+    return f'{SESSIONS_DIR}/{session_id}/{index:08d}'
+
+
+def chunk_count(session):
+    return -(-session['total_size'] // session['chunk_size'])
+
+
+def create_session(conn, doc_id, metadata, change_description, filename, total_size,
+                   chunk_size=DEFAULT_CHUNK_SIZE, checksum=None, ttl=SESSION_TTL_SECONDS, now=None):
+    """Open an upload session for a file of ``total_size`` bytes. Returns the session dict."""
+    if not isinstance(total_size, int) or isinstance(total_size, bool) or total_size <= 0:
+        raise SessionError("size must be a positive integer")
+    if not isinstance(chunk_size, int) or isinstance(chunk_size, bool):
+        raise SessionError("chunk_size must be an integer")
+    chunk_size = max(MIN_CHUNK_SIZE, min(chunk_size, MAX_CHUNK_SIZE))
+    now = time.time() if now is None else now
+    session = dict(zip(SESSION_COLUMNS, (
+        uuid.uuid4().hex, doc_id, metadata, change_description, filename, total_size,
+        chunk_size, checksum, 'open', now, now + ttl,
+    )))
+    begin_immediate(conn)
+    conn.execute(f'INSERT INTO upload_sessions ({", ".join(SESSION_COLUMNS)}) VALUES ({", ".join("?" * len(SESSION_COLUMNS))})',
+                 tuple(session.values()))
+    conn.commit()
+    return session
+
+
+def get_session(conn, session_id, now=None):
+    """The session dict, with ``received`` chunk sizes by index; None if unknown or expired."""
+    row = conn.execute(f'SELECT {", ".join(SESSION_COLUMNS)} FROM upload_sessions WHERE id = ? AND expires_at > ?',
+                       (session_id, time.time() if now is None else now)).fetchone()
+    if row is None:
+        return None
+    session = dict(zip(SESSION_COLUMNS, row))
+    session['received'] = dict(conn.execute('SELECT chunk_index, size FROM upload_chunks WHERE session_id = ?',
+                                            (session_id,)).fetchall())
+    return session
+
+
+def contiguous_offset(session):
+    """Bytes received without gaps from the start of the file."""
+    offset = 0
+    index = 0
+    while index in session['received']:
+        offset += session['received'][index]
+        index += 1
+    return offset
+
+
+def missing_chunks(session):
+    return [index for index in range(chunk_count(session)) if index not in session['received']]
+
+
+def parse_checksum(header):
+    """The digest of an ``Upload-Checksum: sha256 <base64>`` header, or None if absent."""
+    if not header:
+        return None
+    algorithm, _, value = header.partition(' ')
+    if algorithm.lower() != 'sha256':
+        raise SessionError(f"Unsupported checksum algorithm: {algorithm}")
+    try:
+        return base64.b64decode(value.strip(), validate=True).hex()
+    except (binascii.Error, ValueError):
+        raise SessionError("Malformed Upload-Checksum header")
+
+
+def store_chunk(conn, storage, session, offset, length, stream, checksum=None, ttl=SESSION_TTL_SECONDS, now=None):
+    """Store the chunk at byte ``offset`` read from ``stream``.
+
+    ``length`` is the request's Content-Length (None for compressed or
+    chunked bodies, which are checked once read) and ``checksum`` an optional
+    SHA-256 hex digest. Raises SessionError when the chunk does not fit the
+    session or is corrupt.
+    """
+    if session['status'] != 'open':
+        raise SessionError("Upload session is being finalized", 409)
+    if offset is None or offset < 0 or offset >= session['total_size'] or offset % session['chunk_size']:
+        raise SessionError(f"Upload-Offset must be a multiple of {session['chunk_size']} below {session['total_size']}", 409)
+    index = offset // session['chunk_size']
+    expected = min(session['chunk_size'], session['total_size'] - offset)
+    if length is not None and length != expected:
+        raise SessionError(f"Chunk at offset {offset} must be {expected} bytes")
+
+    # Parallel re-sends of one chunk write separate objects; the last one wins
+    temporary_key = f"{chunk_key(session['id'], index)}.{uuid.uuid4().hex}"
+    size, digest = storage.put_stream(temporary_key, stream)
+    if size != expected or (checksum is not None and digest != checksum):
+        storage.delete(temporary_key)
+        if size != expected:
+            raise SessionError(f"Chunk at offset {offset} is {size} bytes, expected {expected}")
+        raise SessionError("Chunk checksum mismatch", 460)
+    storage.move(temporary_key, chunk_key(session['id'], index))
+
+    now = time.time() if now is None else now
+    begin_immediate(conn)
+    cursor = conn.cursor()
+    cursor.execute("UPDATE upload_sessions SET expires_at = ? WHERE id = ? AND status = 'open'", (now + ttl, session['id']))
+    if not cursor.rowcount:
+        conn.rollback()
+        raise SessionError("Upload session is being finalized", 409)
+    cursor.execute('INSERT OR REPLACE INTO upload_chunks (session_id, chunk_index, size, checksum) VALUES (?, ?, ?, ?)',
+                   (session['id'], index, size, digest))
+    conn.commit()
+    session['received'][index] = size
+    session['expires_at'] = now + ttl
+
+
+def claim_session(conn, session_id):
+    """Mark an open session as finalizing so it is finalized once; returns False if it is not open."""
+    begin_immediate(conn)
+    claimed = conn.execute("UPDATE upload_sessions SET status = 'finalizing' WHERE id = ? AND status = 'open'",
+                           (session_id,)).rowcount
+    conn.commit()
+    return bool(claimed)
+
+
+def release_session(conn, session_id):
+    """Reopen a session whose finalization failed."""
+    begin_immediate(conn)
+    conn.execute("UPDATE upload_sessions SET status = 'open' WHERE id = ?", (session_id,))
+    conn.commit()
+
+
+class ChunkReader:
+    """File-like ``read()`` over a session's chunks, in order."""
+
+    def __init__(self, storage, session):
+        self.storage = storage
+        self.keys = [chunk_key(session['id'], index) for index in range(chunk_count(session))]
+        self.current = None
+
+    def read(self, size=READ_SIZE):
+        while True:
+            if self.current is None:
+                if not self.keys:
+                    return b''
+                self.current = self.storage.get_stream(self.keys.pop(0))
+            data = self.current.read(size)
+            if data:
+                return data
+            self.current.close()
+            self.current = None
+
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+            self.current = None
+
+
+def delete_session_rows(cursor, session_id):
+    """Delete a session's rows as part of the caller's transaction."""
+    cursor.execute('DELETE FROM upload_chunks WHERE session_id = ?', (session_id,))
+    cursor.execute('DELETE FROM upload_sessions WHERE id = ?', (session_id,))
+
+
+def delete_session_files(storage, session_id):
+    for info in list(storage.list(f'{SESSIONS_DIR}/{session_id}/')):
+        storage.delete(info.key)
+
+
+def delete_session(conn, storage, session_id):
+    begin_immediate(conn)
+    delete_session_rows(conn.cursor(), session_id)
+    conn.commit()
+    delete_session_files(storage, session_id)
+
+
+def expire_sessions(conn, storage, now=None):
+    """Delete sessions past their expiry, and their chunks. Returns the number deleted."""
+    now = time.time() if now is None else now
+    expired = [row[0] for row in conn.execute('SELECT id FROM upload_sessions WHERE expires_at <= ?', (now,))]
+    for session_id in expired:
+        delete_session(conn, storage, session_id)
+    if expired:
+        logger.info("Expired %d abandoned upload sessions", len(expired))
+    return len(expired)
+
@@ -1,5 +1,6 @@
 import sqlite3
 import json
+from database import rebuild_metadata_keys
 
 DATABASE_NAME = 'pdf_browser.db'
 
@@ -51,6 +52,7 @@ def seed_data(conn=None):
     cursor.execute('INSERT INTO html_documents (version_id, file_path) VALUES (?, ?)', (version3_id, 'uploads/doc-b-v2-html2.html'))
 
     conn.commit()
+    rebuild_metadata_keys(conn)
     if conn is None: # Only close if this function opened the connection
         conn.close()
 
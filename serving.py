@@ -0,0 +1,150 @@
+import mimetypes
+import os
+from urllib.parse import quote
+
+from flask import Response, abort, current_app, request, send_from_directory
+from werkzeug.datastructures import ContentRange
+from werkzeug.utils import send_file
+
+import metrics
+
+# How /uploads/<filename> sends files from local storage (SERVE_MODE):
+#
+# python      Flask's send_from_directory. The WSGI server decides how the
+#             bytes are copied; the development server reads them in Python.
+# sendfile    The kernel copies the file to the socket with sendfile(2).
+#             Under the development server (python app.py) the client socket
+#             comes from the WSGI environ and is written with
+#             socket.sendfile(). Other servers get the file through their
+#             wsgi.file_wrapper, which gunicorn and uWSGI implement with
+#             sendfile.
+# x-accel     An empty response with X-Accel-Redirect pointing at
+#             SERVE_ACCEL_PREFIX/<key>, so nginx streams the file from an
+#             internal location.
+# x-sendfile  An empty response with X-Sendfile: <absolute path>, for
+#             lighttpd or Apache with mod_xsendfile.
+#
+# In the offload modes the proxy also handles ranges and conditional
+# requests.
+
+SERVE_MODES = ('python', 'sendfile', 'x-accel', 'x-sendfile')
+DEFAULT_ACCEL_PREFIX = '/protected-uploads'
+BLOCK_SIZE = 1024 * 1024
+
+
+class SocketSendfile:
+    """Response iterable that sends a byte range of ``file`` straight to the client socket.
+
+    Its first chunk is empty, which makes the development server send the
+    status line and headers; the body then bypasses the server.
+    """
+
+    def __init__(self, file, sock, offset, count):
+        self.file = file
+        self.sock = sock
+        self.offset = offset
+        self.count = count
+
+    def __iter__(self):
+        yield b''
+        if self.count:
+            self.sock.sendfile(self.file, self.offset, self.count)
+
+    def close(self):
+        self.file.close()
+
+
+class FileRange:
+    """Response iterable that reads a byte range of ``file`` in blocks."""
+
+    def __init__(self, file, offset, count):
+        self.file = file
+        self.offset = offset
+        self.count = count
+
+    def __iter__(self):
+        self.file.seek(self.offset)
+        remaining = self.count
+        while remaining > 0:
+            data = self.file.read(min(BLOCK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+    def close(self):
+        self.file.close()
+
+
+def file_body(environ, file, offset, count, size):
+    """The best zero-copy response iterable the WSGI server offers."""
+    sock = environ.get('werkzeug.socket')
+    if sock is not None:
+        return SocketSendfile(file, sock, offset, count)
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    # Servers' wrappers send the file from its current position to the end,
+    # so they are only used for whole files
+    if file_wrapper is not None and offset == 0 and count == size:
+        return file_wrapper(file, BLOCK_SIZE)
+    return FileRange(file, offset, count)
+
+
+def sendfile_response(path, mimetype):
+    file = open(path, 'rb')
+    try:
+        stat = os.fstat(file.fileno())
+        size = stat.st_size
+        etag = f'{stat.st_mtime_ns:x}-{size:x}'
+        byte_range = None
+        if_range = request.if_range
+        # An If-Range that does not match (dates are not compared) asks for the whole file
+        if request.range and (if_range.etag == etag or (if_range.etag is None and if_range.date is None)):
+            byte_range = request.range.range_for_length(size)
+            if byte_range is None:
+                file.close()
+                response = Response(status=416)
+                response.content_range = ContentRange('bytes', None, None, size)
+                return response
+        start, stop = byte_range or (0, size)
+        response = Response(file_body(request.environ, file, start, stop - start, size),
+                            206 if byte_range else 200, mimetype=mimetype, direct_passthrough=True)
+    except BaseException:
+        file.close()
+        raise
+    response.content_length = stop - start
+    if byte_range:
+        response.content_range = ContentRange('bytes', start, stop, size)
+    response.accept_ranges = 'bytes'
+    response.last_modified = int(stat.st_mtime)
+    response.set_etag(etag)
+    return response.make_conditional(request.environ)
+
+
+def offload_response(path, key, mode, mimetype):
+    response = send_file(os.path.abspath(path), request.environ, mimetype=mimetype,
+                         use_x_sendfile=True, conditional=False)
+    if mode == 'x-accel':
+        del response.headers['X-Sendfile']
+        prefix = current_app.config.get('SERVE_ACCEL_PREFIX', DEFAULT_ACCEL_PREFIX).rstrip('/')
+        response.headers['X-Accel-Redirect'] = f'{prefix}/{quote(key)}'
+    return response
+
+
+def send_local_file(storage, key):
+    """Response serving ``key`` of LocalStorage ``storage`` according to SERVE_MODE."""
+    mode = current_app.config.get('SERVE_MODE', 'python')
+    if mode not in SERVE_MODES:
+        raise RuntimeError(f"Unknown SERVE_MODE: {mode!r}")
+    path = storage.path(key)
+    mimetype = mimetypes.guess_type(key)[0] or 'application/octet-stream'
+    if mode == 'python':
+        response = send_from_directory(storage.root, key)
+    elif not os.path.isfile(path):
+        abort(404)
+    elif mode == 'sendfile':
+        response = sendfile_response(path, mimetype)
+    else:
+        response = offload_response(path, key, mode, mimetype)
+    if response.status_code in (200, 206):
+        metrics.increment('served_bytes_total', response.content_length or 0, mode=mode)
+    return response
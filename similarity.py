@@ -0,0 +1,535 @@
+"""Similar-document search over a hashed n-gram TF-IDF index.
+
+Every document is turned into text from its metadata values, the change
+descriptions of all its versions and the text of its latest version's HTML
+files. Words and word pairs are hashed into ``DIMENSIONS`` buckets, weighted
+by (1 + log tf) * idf and L2-normalized, so the dot product of two rows is
+their cosine similarity.
+
+build_index() writes the rows to a new generation directory as NumPy
+arrays, both row-major (CSR, to look up a document's vector) and
+term-major (CSC, to score against it), and then points ``CURRENT`` at it.
+Queries memory-map the current generation and only touch the postings of
+the query's terms.
+
+The index is updated incrementally from the catalog change feed: before a
+query the app re-indexes the documents changed since the generation was
+built, in memory and weighted with the generation's idf, and masks their
+stale rows. A full rebuild ("compaction") folds these back in and
+recomputes idf. Queries never build: a background thread compacts when
+there is no index yet, once more than SIMILARITY_MAX_OVERLAY documents
+changed (queries wait for it rather than re-index them all), and every
+SIMILARITY_COMPACT_INTERVAL_SECONDS if set. The CLI
+below builds from cron. numpy is required.
+
+Usage::
+
+    python similarity.py --database pdf_browser.db --uploads uploads --index-dir similarity_index
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+import uuid
+import zlib
+from html.parser import HTMLParser
+
+from database import DATABASE_NAME, get_changes, get_db_connection, latest_change_seq
+from storage import LocalStorage, get_storage, storage_key
+
+try:
+    import numpy as np
+except ImportError: # numpy is only needed for similarity search
+    np = None
+
+try:
+    import fcntl
+except ImportError: # Windows; concurrent builds are not serialized there
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INDEX_DIR = 'similarity_index'
+DIMENSIONS = 2 ** 18
+MAX_TOKENS = 200000
+MAX_HTML_BYTES = 1024 * 1024
+CHANGES_BATCH = 1000
+DEFAULT_K = 10
+MAX_K = 100
+MAX_OVERLAY = 1000
+ARRAYS = ('indptr', 'indices', 'data', 'term_ptr', 'term_rows', 'term_data', 'idf')
+TOKEN_PATTERN = re.compile(r'\w+')
+
+
+class IndexNotReady(Exception):
+    """No usable index yet; one is being built in the background."""
+
+
+class TextExtractor(HTMLParser):
+    """Collects the text of an HTML document, without scripts and styles."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('script', 'style'):
+            self.skip += 1
+
+    def handle_endtag(self, tag):
+        if tag in ('script', 'style') and self.skip:
+            self.skip -= 1
+
+    def handle_data(self, data):
+        if not self.skip:
+            self.parts.append(data)
+
+
+def html_text(html):
+    extractor = TextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    return ' '.join(extractor.parts)
+
+
+def metadata_values(value):
+    """The strings and numbers in a metadata JSON value."""
+    if isinstance(value, dict):
+        return [text for item in value.values() for text in metadata_values(item)]
+    if isinstance(value, list):
+        return [text for item in value for text in metadata_values(item)]
+    if isinstance(value, bool) or value is None:
+        return []
+    return [str(value)]
+
+
+def document_text(conn, storage, upload_folder, doc_id):
+    """The indexed text of ``doc_id``, or None if the document does not exist."""
+    row = conn.execute('SELECT id, metadata FROM documents WHERE doc_id = ?', (doc_id,)).fetchone()
+    if row is None:
+        return None
+    document_id, metadata = row[0], row[1]
+    parts = metadata_values(json.loads(metadata or '{}'))
+    parts.extend(description for (description,) in conn.execute(
+        'SELECT change_description FROM versions WHERE document_id = ? AND change_description IS NOT NULL',
+        (document_id,)))
+    html_paths = conn.execute('''
+        SELECT h.file_path FROM html_documents h JOIN versions v ON v.id = h.version_id
+        WHERE v.document_id = ? AND h.tier = 'hot'
+          AND v.version = (SELECT MAX(version) FROM versions WHERE document_id = ?)
+    ''', (document_id, document_id)).fetchall()
+    for (file_path,) in html_paths:
+        try:
+            stream = storage.get_stream(storage_key(file_path, upload_folder))
+            try:
+                html = stream.read(MAX_HTML_BYTES).decode('utf-8', errors='replace')
+            finally:
+                stream.close()
+        except OSError:
+            logger.warning("Could not read %s for the similarity index", file_path)
+            continue
+        parts.append(html_text(html))
+    return '\n'.join(parts)
+
+
+def term_frequencies(text, dimensions=DIMENSIONS):
+    """Hashed word and word-pair buckets of ``text`` with their (1 + log tf) weights."""
+    tokens = TOKEN_PATTERN.findall(text.lower())[:MAX_TOKENS]
+    grams = tokens + [f'{a} {b}' for a, b in zip(tokens, tokens[1:])]
+    buckets = np.fromiter((zlib.crc32(gram.encode('utf-8')) for gram in grams), dtype=np.int64, count=len(grams))
+    indices, counts = np.unique(buckets & (dimensions - 1), return_counts=True)
+    return indices.astype(np.int32), (1 + np.log(counts)).astype(np.float32)
+
+
+def weigh(indices, tf, idf):
+    """TF-IDF weights of a row, L2-normalized."""
+    weights = tf * idf[indices]
+    norm = np.sqrt(np.dot(weights, weights))
+    return weights / norm if norm else weights
+
+
+def generation_time(generation):
+    """Milliseconds timestamp of the build that made ``generation`` ('gen-<ms>-<id>')."""
+    return int(generation.split('-')[1])
+
+
+def current_generation(index_dir):
+    try:
+        with open(os.path.join(index_dir, 'CURRENT')) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+@contextlib.contextmanager
+def publish_lock(index_dir):
+    """Hold an exclusive lock on ``index_dir``, across processes, while a build publishes."""
+    with open(os.path.join(index_dir, 'LOCK'), 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def build_index(conn, storage, upload_folder, index_dir, dimensions=DIMENSIONS):
+    """Index every document into a new generation of ``index_dir`` and make it current.
+
+    Generations are named after the time their build started. If a build
+    that started later has already published, this one is discarded;
+    otherwise older generations are deleted. Returns a summary dict.
+    """
+    started = time.perf_counter()
+    generation = f'gen-{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}'
+    # Read before the documents, so changes made during the build are replayed
+    seq = latest_change_seq(conn)
+    doc_ids, rows = [], []
+    for (doc_id,) in conn.execute('SELECT doc_id FROM documents ORDER BY id').fetchall():
+        text = document_text(conn, storage, upload_folder, doc_id)
+        if text is not None:
+            doc_ids.append(doc_id)
+            rows.append(term_frequencies(text, dimensions))
+
+    lengths = np.array([len(indices) for indices, _ in rows], dtype=np.int64)
+    indices = np.concatenate([r[0] for r in rows]) if rows else np.zeros(0, np.int32)
+    document_frequency = np.bincount(indices, minlength=dimensions)
+    idf = (np.log((1 + len(rows)) / (1 + document_frequency)) + 1).astype(np.float32)
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    data = np.concatenate([weigh(i, t, idf) for i, t in rows]).astype(np.float32) if rows else np.zeros(0, np.float32)
+    order = np.argsort(indices, kind='stable')
+    term_ptr = np.zeros(dimensions + 1, dtype=np.int64)
+    np.cumsum(document_frequency, out=term_ptr[1:])
+    arrays = {
+        'indptr': indptr,
+        'indices': indices,
+        'data': data,
+        'term_ptr': term_ptr,
+        'term_rows': np.repeat(np.arange(len(rows), dtype=np.int32), lengths)[order],
+        'term_data': data[order],
+        'idf': idf,
+    }
+
+    # Written under a temporary name, so a concurrent build never takes a
+    # half-written generation for a complete one
+    os.makedirs(index_dir, exist_ok=True)
+    staging = os.path.join(index_dir, f'tmp-{generation}')
+    os.makedirs(staging)
+    for name, array in arrays.items():
+        np.save(os.path.join(staging, f'{name}.npy'), array)
+    with open(os.path.join(staging, 'meta.json'), 'w') as f:
+        json.dump({'dimensions': dimensions, 'seq': seq, 'doc_ids': doc_ids}, f)
+    path = os.path.join(index_dir, generation)
+    os.rename(staging, path)
+
+    # Deciding and replacing CURRENT under the lock, so an older build that
+    # finishes last (the CLI from cron next to the app's thread) cannot
+    # point CURRENT at a generation the newer build deletes
+    with publish_lock(index_dir):
+        current = current_generation(index_dir)
+        published = current is None or generation_time(current) <= generation_time(generation)
+        if published:
+            pointer = os.path.join(index_dir, f'CURRENT.{uuid.uuid4().hex}.tmp')
+            with open(pointer, 'w') as f:
+                f.write(generation)
+            os.replace(pointer, os.path.join(index_dir, 'CURRENT'))
+        # Only older generations: a build that started later may be publishing
+        # its own. Readers that still map an old generation keep their open files.
+        for entry in os.listdir(index_dir):
+            if entry.startswith('gen-') and (entry == generation and not published
+                                             or generation_time(entry) < generation_time(generation)):
+                shutil.rmtree(os.path.join(index_dir, entry), ignore_errors=True)
+    return {
+        'generation': generation,
+        'published': published,
+        'documents': len(doc_ids),
+        'nonzeros': int(len(indices)),
+        'seq': seq,
+        'seconds': round(time.perf_counter() - started, 3),
+    }
+
+
+class SimilarityIndex:
+    """The current generation of an index directory plus the documents changed since.
+
+    Callers hold ``lock`` around refresh(), catch_up() and similar().
+    """
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self.lock = threading.Lock()
+        self.generation = None
+
+    def refresh(self):
+        """Map the current generation if it changed. Returns False if there is none."""
+        for attempt in range(2):
+            generation = current_generation(self.index_dir)
+            if generation is None:
+                return False
+            if generation == self.generation:
+                return True
+            try:
+                self.load(generation)
+                return True
+            except FileNotFoundError:
+                if attempt:
+                    raise  # superseded and deleted while being loaded; CURRENT is newer now
+
+    def load(self, generation):
+        path = os.path.join(self.index_dir, generation)
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in ARRAYS}
+        for name, array in arrays.items():
+            setattr(self, name, array)
+        self.dimensions = meta['dimensions']
+        self.seq = meta['seq']
+        self.doc_ids = meta['doc_ids']
+        self.rows = {doc_id: row for row, doc_id in enumerate(self.doc_ids)}
+        self.stale = np.zeros(len(self.doc_ids), dtype=bool)
+        self.overlay = {}
+        self.stacked = None
+        self.generation = generation
+
+    def catch_up(self, conn, storage, upload_folder, limit=None):
+        """Re-index the documents changed since the last catch-up.
+
+        Returns how many changed, or None, leaving the index as it was, if the
+        overlay would then hold more than ``limit`` documents.
+        """
+        seq, changed = self.seq, set()
+        while True:
+            changes = get_changes(seq, CHANGES_BATCH, conn)
+            if not changes:
+                break
+            changed.update(change['doc_id'] for change in changes)
+            seq = changes[-1]['seq']
+            if limit is not None and len(changed.union(self.overlay)) > limit:
+                return None
+        self.seq = seq
+        for doc_id in changed:
+            if doc_id in self.rows:
+                self.stale[self.rows[doc_id]] = True
+            text = document_text(conn, storage, upload_folder, doc_id)
+            if text is None:
+                self.overlay.pop(doc_id, None)
+            else:
+                indices, tf = term_frequencies(text, self.dimensions)
+                self.overlay[doc_id] = (indices, weigh(indices, tf, self.idf))
+        if changed:
+            self.stacked = None
+        return len(changed)
+
+    def overlay_matrix(self):
+        """The overlay stacked as (doc_ids, row of each nonzero, indices, weights), rebuilt after changes."""
+        if self.stacked is None:
+            doc_ids = list(self.overlay)
+            vectors = [self.overlay[doc_id] for doc_id in doc_ids]
+            lengths = [len(indices) for indices, _ in vectors]
+            self.stacked = (
+                doc_ids,
+                np.repeat(np.arange(len(doc_ids)), lengths),
+                np.concatenate([indices for indices, _ in vectors]),
+                np.concatenate([weights for _, weights in vectors]),
+            )
+        return self.stacked
+
+    def vector(self, doc_id):
+        if doc_id in self.overlay:
+            return self.overlay[doc_id]
+        row = self.rows.get(doc_id)
+        if row is None or self.stale[row]:
+            return None
+        start, stop = self.indptr[row], self.indptr[row + 1]
+        return np.asarray(self.indices[start:stop]), np.asarray(self.data[start:stop])
+
+    def base_scores(self, indices, weights):
+        """Cosine similarity of the query with every row of the generation."""
+        starts = self.term_ptr[indices]
+        lengths = self.term_ptr[indices + 1] - starts
+        total = int(lengths.sum())
+        if total == 0:
+            return np.zeros(len(self.doc_ids), dtype=np.float32)
+        # Positions of all the query terms' postings, concatenated
+        offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(total)
+        contributions = self.term_data[offsets] * np.repeat(weights, lengths)
+        return np.bincount(self.term_rows[offsets], weights=contributions, minlength=len(self.doc_ids))
+
+    def similar(self, doc_id, k=DEFAULT_K):
+        """The ``k`` documents most similar to ``doc_id`` as (doc_id, score), or None if it is unknown."""
+        query = self.vector(doc_id)
+        if query is None:
+            return None
+        indices, weights = query
+        scores = self.base_scores(indices, weights)
+        scores[self.stale] = 0
+        if doc_id in self.rows:
+            scores[self.rows[doc_id]] = 0
+        overlay_ids = []
+        if self.overlay:
+            # Overlay rows are scored in one sparse product, appended after the generation's rows
+            overlay_ids, overlay_rows, overlay_indices, overlay_weights = self.overlay_matrix()
+            dense = np.zeros(self.dimensions, dtype=np.float32)
+            dense[indices] = weights
+            overlay_scores = np.bincount(overlay_rows, weights=dense[overlay_indices] * overlay_weights,
+                                         minlength=len(overlay_ids))
+            if doc_id in self.overlay:
+                overlay_scores[overlay_ids.index(doc_id)] = 0
+            scores = np.concatenate([scores, overlay_scores])
+        base = len(self.doc_ids)
+        top = np.argpartition(-scores, k - 1)[:k] if len(scores) > k else np.arange(len(scores))
+        candidates = [(self.doc_ids[row] if row < base else overlay_ids[row - base], float(scores[row]))
+                      for row in top if scores[row] > 0]
+        candidates.sort(key=lambda item: (-item[1], item[0]))
+        return candidates
+
+
+def index_dir_for(app):
+    return os.path.join(app.root_path, app.config.get('SIMILARITY_INDEX_DIR', DEFAULT_INDEX_DIR))
+
+
+def get_index(app):
+    index_dir = index_dir_for(app)
+    index = app.extensions.get('similarity')
+    if index is None or index.index_dir != index_dir:
+        index = app.extensions['similarity'] = SimilarityIndex(index_dir)
+    return index
+
+
+def compact_app(app, conn=None):
+    """build_index with the app's database, storage and SIMILARITY_INDEX_DIR."""
+    close = conn is None
+    if close:
+        conn = get_db_connection(app.config.get('DATABASE') or DATABASE_NAME)
+    try:
+        return build_index(conn, get_storage(app), app.config['UPLOAD_FOLDER'], index_dir_for(app))
+    finally:
+        if close:
+            conn.close()
+
+
+def find_similar(app, conn, doc_id, k=DEFAULT_K):
+    """Top-``k`` similar documents of ``doc_id`` for ``app``, or None if it is unknown.
+
+    Raises IndexNotReady, and asks for a background build, when there is no
+    index, when it was built from a newer change feed than the database has
+    (a different or restored database), or when catching up would put more
+    than SIMILARITY_MAX_OVERLAY documents in the overlay. Queries so only
+    re-index a bounded number of documents.
+    """
+    index = get_index(app)
+    with index.lock:
+        if (not index.refresh() or index.seq > latest_change_seq(conn)
+                or index.catch_up(conn, get_storage(app), app.config['UPLOAD_FOLDER'],
+                                  app.config.get('SIMILARITY_MAX_OVERLAY', MAX_OVERLAY)) is None):
+            get_scheduler(app).wake()
+            raise IndexNotReady("The similarity index is being built")
+        return index.similar(doc_id, k)
+
+
+class CompactionScheduler:
+    """Background thread that rebuilds the index when woken, and every ``interval`` seconds if set.
+
+    Wake-ups during a rebuild are dropped; that rebuild already covers them.
+    """
+
+    def __init__(self, compact, interval=None):
+        self.compact = compact
+        self.interval = interval
+        self.compacting = False
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='similarity-compaction', daemon=True)
+        self._thread.start()
+
+    def wake(self):
+        if not self.compacting:
+            self._wake.set()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            if self._stop.is_set():
+                return
+            self.compacting = True
+            self._wake.clear()
+            try:
+                self.compact()
+            except Exception:
+                logger.exception("Similarity index compaction failed")
+            finally:
+                self.compacting = False
+
+
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler(app):
+    """The app's compaction thread, started on first use."""
+    with _scheduler_lock:
+        scheduler = app.extensions.get('similarity_scheduler')
+        if scheduler is None:
+            scheduler = CompactionScheduler(lambda: compact_app(app), app.config.get('SIMILARITY_COMPACT_INTERVAL_SECONDS'))
+            scheduler.start()
+            app.extensions['similarity_scheduler'] = scheduler
+        return scheduler
+
+
+def init_similarity(app):
+    """Start the compaction thread on the first request, building the index right away if there is none.
+
+    Not for testing apps, nor without numpy. Testing apps still get the
+    thread once a query asks for a build.
+    """
+    def start_once():
+        if 'similarity_scheduler' in app.extensions or app.testing or np is None:
+            return
+        scheduler = get_scheduler(app)
+        if current_generation(index_dir_for(app)) is None:
+            scheduler.wake()
+
+    app.before_request(start_once)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the similar-document index.")
+    parser.add_argument("--database", default=DATABASE_NAME, help="SQLite database file.")
+    parser.add_argument("--uploads", default='uploads', help="Upload folder (local storage).")
+    parser.add_argument("--index-dir", default=DEFAULT_INDEX_DIR, help="Directory of the index generations.")
+    parser.add_argument("--dimensions", type=int, default=DIMENSIONS, help="Hash buckets, a power of two.")
+    args = parser.parse_args(argv)
+
+    if np is None:
+        print("numpy is required to build the similarity index", file=sys.stderr)
+        return 1
+    if args.dimensions & (args.dimensions - 1):
+        parser.error("--dimensions must be a power of two")
+    conn = get_db_connection(args.database)
+    try:
+        summary = build_index(conn, LocalStorage(args.uploads), args.uploads, args.index_dir, args.dimensions)
+    finally:
+        conn.close()
+    print(json.dumps(summary))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,129 +3,428 @@ document.addEventListener('DOMContentLoaded', () => {
     const documentsTable = document.getElementById('documents-table');
     const documentsTableHead = documentsTable.querySelector('thead');
     const documentsTableBody = documentsTable.querySelector('tbody');
+    const documentsViewport = document.getElementById('documents-viewport');
+    const messageDiv = document.getElementById('message');
+
+    const SEARCH_DEBOUNCE_MS = 250;
+    const SEARCH_CACHE_SIZE = 50;
+
+    // Small LRU of recent query results. A Map iterates in insertion order,
+    // so the first key is always the least recently used one.
+    const searchCache = new Map();
+    let inFlightController = null;
+    let searchDebounceTimer = null;
+
+    const cacheGet = (key) => {
+        if (!searchCache.has(key)) {
+            return undefined;
+        }
+        const value = searchCache.get(key);
+        searchCache.delete(key);
+        searchCache.set(key, value);
+        return value;
+    };
+
+    const cachePut = (key, value) => {
+        searchCache.delete(key);
+        searchCache.set(key, value);
+        if (searchCache.size > SEARCH_CACHE_SIZE) {
+            searchCache.delete(searchCache.keys().next().value);
+        }
+    };
 
     const fetchAndRenderDocuments = async (query = '') => {
+        query = query.trim();
+        const url = query ? `/search?${new URLSearchParams({ q: query })}` : '/documents';
+
+        const cached = cacheGet(url);
+        if (cached !== undefined) {
+            // A request still in flight is for an older query; don't let it
+            // overwrite these results when it lands.
+            if (inFlightController) {
+                inFlightController.abort();
+                inFlightController = null;
+            }
+            messageDiv.hidden = true;
+            renderDocuments(cached);
+            return;
+        }
+
+        // Cancel the previous request so a stale response can never
+        // overwrite the results of a newer query.
+        if (inFlightController) {
+            inFlightController.abort();
+        }
+        const controller = new AbortController();
+        inFlightController = controller;
+
         try {
-            const url = query ? `/search?q=${query}` : '/documents';
-            const response = await fetch(url);
+            const response = await fetch(url, { signal: controller.signal });
             const documents = await response.json();
+            if (!response.ok) {
+                // Errors (a bad query, a busy server) are shown, never cached
+                messageDiv.textContent = `Error: ${documents.error}`;
+                messageDiv.className = 'error';
+                messageDiv.hidden = false;
+                return;
+            }
+            messageDiv.hidden = true;
+            cachePut(url, documents);
             renderDocuments(documents);
+            if (changeSource === null && response.headers.has('X-Catalog-Seq')) {
+                followChanges(response.headers.get('X-Catalog-Seq'));
+            }
         } catch (error) {
-            console.error('Error fetching documents:', error);
+            if (error.name !== 'AbortError') {
+                console.error('Error fetching documents:', error);
+            }
+        } finally {
+            if (inFlightController === controller) {
+                inFlightController = null;
+            }
         }
     };
 
-    const renderDocuments = (documents) => {
-        // Clear existing table
-        documentsTableHead.innerHTML = '';
-        documentsTableBody.innerHTML = '';
+    const refreshDocuments = async () => {
+        searchCache.clear();
+        await fetchMetadataKeys();
+        fetchAndRenderDocuments(searchBar.value);
+    };
 
-        if (documents.length === 0) {
-            return;
+    // Rendering is windowed: only the rows inside the scroll viewport (plus a
+    // small overscan) exist in the DOM. Two spacer rows stand in for the
+    // documents above and below the window so the scrollbar stays accurate.
+    const ROW_HEIGHT = 40; // px, must match `.doc-row` in style.css
+    const OVERSCAN = 10;
+
+    let metadataKeys = [];
+    let headers = [];
+    let currentDocuments = [];
+    // doc_id -> measured height (px) of its expanded versions row
+    const expandedDocs = new Map();
+    // rowOffsets[i] is the pixel offset of document i; the last entry is the total height
+    let rowOffsets = new Float64Array(1);
+    let renderScheduled = false;
+
+    const fetchMetadataKeys = async () => {
+        try {
+            const response = await fetch('/metadata_keys');
+            metadataKeys = (await response.json()).map(entry => entry.key);
+        } catch (error) {
+            console.error('Error fetching metadata keys:', error);
+            metadataKeys = [];
         }
+    };
 
-        // Get all unique metadata keys
-        const allKeys = new Set();
-        documents.forEach(doc => {
-            Object.keys(doc.metadata).forEach(key => allKeys.add(key));
-        });
-        const headers = ['doc_id', ...Array.from(allKeys), 'latest_version', 'Actions'];
+    const computeRowOffsets = () => {
+        rowOffsets = new Float64Array(currentDocuments.length + 1);
+        for (let i = 0; i < currentDocuments.length; i++) {
+            const extra = expandedDocs.get(currentDocuments[i].doc_id) || 0;
+            rowOffsets[i + 1] = rowOffsets[i] + ROW_HEIGHT + extra;
+        }
+    };
 
-        // Create table header
-        const headerRow = document.createElement('tr');
-        headers.forEach(header => {
+    // Index of the document whose row contains the given pixel offset.
+    const findRowAt = (offset) => {
+        let low = 0;
+        let high = currentDocuments.length - 1;
+        while (low < high) {
+            const mid = (low + high + 1) >> 1;
+            if (rowOffsets[mid] <= offset) {
+                low = mid;
+            } else {
+                high = mid - 1;
+            }
+        }
+        return Math.max(low, 0);
+    };
+
+    const createSpacerRow = (height) => {
+        const spacer = document.createElement('tr');
+        spacer.classList.add('spacer-row');
+        const td = document.createElement('td');
+        td.colSpan = headers.length;
+        td.style.height = `${height}px`;
+        spacer.appendChild(td);
+        return spacer;
+    };
+
+    const createLink = (path, label) => {
+        const a = document.createElement('a');
+        a.href = `/uploads/${encodeURIComponent(path.split('/').pop())}`;
+        a.target = '_blank';
+        a.textContent = label;
+        return a;
+    };
+
+    const createVoteButton = (className, label, doc, version) => {
+        const button = document.createElement('button');
+        button.className = className;
+        button.textContent = label;
+        button.dataset.docId = doc.doc_id;
+        button.dataset.version = version.version;
+        return button;
+    };
+
+    // Built only when a document is expanded, never up front.
+    const createVersionsRow = (doc) => {
+        const versionsRow = document.createElement('tr');
+        versionsRow.classList.add('versions-row');
+        const versionsCell = document.createElement('td');
+        versionsCell.colSpan = headers.length;
+        const versionsTable = document.createElement('table');
+        versionsTable.classList.add('versions-table');
+
+        const headRow = versionsTable.createTHead().insertRow();
+        ['Version', 'Change Description', 'File', 'HTML Files', 'File Consistency',
+            'HTML Consistency', 'Created At', 'Actions'].forEach(label => {
             const th = document.createElement('th');
-            th.textContent = header;
-            headerRow.appendChild(th);
+            th.textContent = label;
+            headRow.appendChild(th);
         });
-        documentsTableHead.appendChild(headerRow);
 
-        // Create table rows
-        documents.forEach(doc => {
-            const row = document.createElement('tr');
-            headers.forEach(header => {
-                const td = document.createElement('td');
-                if (header === 'doc_id') {
-                    td.textContent = doc.doc_id;
-                } else if (header === 'latest_version') {
-                    td.textContent = doc.latest_version;
-                } else if (header === 'Actions') {
-                    const button = document.createElement('button');
-                    button.textContent = 'Show/Hide Versions';
-                    button.classList.add('toggle-versions');
-                    td.appendChild(button);
-                } else {
-                    td.textContent = doc.metadata[header] || '';
+        const body = versionsTable.createTBody();
+        doc.versions.forEach(v => {
+            const tr = body.insertRow();
+            tr.insertCell().textContent = v.version;
+            tr.insertCell().textContent = v.change_description;
+            tr.insertCell().appendChild(createLink(v.file_path, 'PDF'));
+            const htmlCell = tr.insertCell();
+            v.html_paths.forEach((hp, i) => {
+                if (i > 0) {
+                    htmlCell.appendChild(document.createTextNode(', '));
                 }
-                row.appendChild(td);
-            });
-            documentsTableBody.appendChild(row);
-
-            const versionsRow = document.createElement('tr');
-            versionsRow.style.display = 'none';
-            const versionsCell = document.createElement('td');
-            versionsCell.colSpan = headers.length;
-            const versionsTable = document.createElement('table');
-            versionsTable.innerHTML = `
-                <thead>
-                    <tr>
-                        <th>Version</th>
-                        <th>Change Description</th>
-                        <th>File</th>
-                        <th>HTML Files</th>
-                        <th>File Consistency</th>
-                        <th>HTML Consistency</th>
-                        <th>Created At</th>
-                        <th>Actions</th>
-                    </tr>
-                </thead>
-                <tbody>
-                    ${doc.versions.map(v => `
-                        <tr>
-                            <td>${v.version}</td>
-                            <td>${v.change_description}</td>
-                            <td><a href="/uploads/${v.file_path.split('/').pop()}" target="_blank">PDF</a></td>
-                            <td>${v.html_paths.map(hp => `<a href="/uploads/${hp.path.split('/').pop()}" target="_blank">HTML</a>`).join(', ')}</td>
-                            <td>${v.file_consistent ? '✅' : '❌'}</td>
-                            <td>${v.html_paths.map(hp => hp.consistent ? '✅' : '❌').join(', ')}</td>
-                            <td>${v.created_at}</td>
-                            <td>
-                                <button class="delete-version-btn" data-doc-id="${doc.doc_id}" data-version="${v.version}">Delete</button>
-                                <button class="vote-btn good" data-doc-id="${doc.doc_id}" data-version="${v.version}">Good</button>
-                                <button class="vote-btn bad" data-doc-id="${doc.doc_id}" data-version="${v.version}">Bad</button>
-                            </td>
-                        </tr>
-                    `).join('')}
-                </tbody>
-            `;
-            versionsCell.appendChild(versionsTable);
-            versionsRow.appendChild(versionsCell);
-            documentsTableBody.appendChild(versionsRow);
-
-            row.querySelector('.toggle-versions').addEventListener('click', () => {
-                versionsRow.style.display = versionsRow.style.display === 'none' ? 'table-row' : 'none';
+                htmlCell.appendChild(createLink(hp.path, 'HTML'));
             });
+            tr.insertCell().textContent = v.file_consistent ? '✅' : '❌';
+            tr.insertCell().textContent = v.html_paths.map(hp => hp.consistent ? '✅' : '❌').join(', ');
+            tr.insertCell().textContent = v.created_at;
+            const actions = tr.insertCell();
+            actions.appendChild(createVoteButton('delete-version-btn', 'Delete', doc, v));
+            actions.appendChild(createVoteButton('vote-btn good', 'Good', doc, v));
+            actions.appendChild(createVoteButton('vote-btn bad', 'Bad', doc, v));
         });
+
+        versionsCell.appendChild(versionsTable);
+        versionsRow.appendChild(versionsCell);
+        return versionsRow;
+    };
+
+    const createDocumentRow = (doc, index) => {
+        const row = document.createElement('tr');
+        row.classList.add('doc-row');
+        headers.forEach(header => {
+            const td = row.insertCell();
+            if (header === 'doc_id') {
+                td.textContent = doc.doc_id;
+            } else if (header === 'latest_version') {
+                td.textContent = doc.latest_version;
+            } else if (header === 'Actions') {
+                const button = document.createElement('button');
+                button.textContent = 'Show/Hide Versions';
+                button.classList.add('toggle-versions');
+                button.dataset.index = index;
+                td.appendChild(button);
+            } else {
+                const value = doc.metadata[header];
+                td.textContent = value === undefined || value === null ? '' : value;
+            }
+        });
+        return row;
+    };
+
+    const renderWindow = () => {
+        renderScheduled = false;
+        documentsTableBody.replaceChildren();
+        if (currentDocuments.length === 0) {
+            return;
+        }
+
+        const scrollTop = documentsViewport.scrollTop;
+        const viewportHeight = documentsViewport.clientHeight;
+        const first = Math.max(findRowAt(scrollTop) - OVERSCAN, 0);
+        const last = Math.min(findRowAt(scrollTop + viewportHeight) + OVERSCAN, currentDocuments.length - 1);
+
+        const fragment = document.createDocumentFragment();
+        fragment.appendChild(createSpacerRow(rowOffsets[first]));
+        const expandedRows = [];
+        for (let i = first; i <= last; i++) {
+            const doc = currentDocuments[i];
+            fragment.appendChild(createDocumentRow(doc, i));
+            if (expandedDocs.has(doc.doc_id)) {
+                const versionsRow = createVersionsRow(doc);
+                fragment.appendChild(versionsRow);
+                expandedRows.push([doc.doc_id, versionsRow]);
+            }
+        }
+        fragment.appendChild(createSpacerRow(rowOffsets[currentDocuments.length] - rowOffsets[last + 1]));
+        documentsTableBody.appendChild(fragment);
+
+        // Expanded rows have variable height; record it so offsets stay exact.
+        let offsetsChanged = false;
+        expandedRows.forEach(([docId, versionsRow]) => {
+            const height = versionsRow.offsetHeight;
+            if (expandedDocs.get(docId) !== height) {
+                expandedDocs.set(docId, height);
+                offsetsChanged = true;
+            }
+        });
+        if (offsetsChanged) {
+            computeRowOffsets();
+        }
+    };
+
+    const scheduleRender = () => {
+        if (!renderScheduled) {
+            renderScheduled = true;
+            requestAnimationFrame(renderWindow);
+        }
+    };
+
+    const renderDocuments = (documents) => {
+        currentDocuments = documents;
+        headers = ['doc_id', ...metadataKeys, 'latest_version', 'Actions'];
+
+        documentsTableHead.replaceChildren();
+        if (documents.length > 0) {
+            const headerRow = documentsTableHead.insertRow();
+            headers.forEach(header => {
+                const th = document.createElement('th');
+                th.textContent = header;
+                headerRow.appendChild(th);
+            });
+        }
+
+        computeRowOffsets();
+        renderWindow();
+    };
+
+    documentsViewport.addEventListener('scroll', scheduleRender);
+    window.addEventListener('resize', scheduleRender);
+
+    // Suggestions come from an in-memory index on the server and are cheap,
+    // so they are fetched on every keystroke; only the latest one is shown.
+    const searchSuggestions = document.getElementById('search-suggestions');
+    let suggestController = null;
+
+    const fetchSuggestions = async (query) => {
+        if (suggestController) {
+            suggestController.abort();
+        }
+        searchSuggestions.replaceChildren();
+        if (!query.trim()) {
+            return;
+        }
+        const controller = new AbortController();
+        suggestController = controller;
+        try {
+            const response = await fetch(`/suggest?${new URLSearchParams({ q: query })}`, { signal: controller.signal });
+            if (!response.ok) {
+                // 503 while the index is being built; the next keystroke retries
+                return;
+            }
+            const { suggestions } = await response.json();
+            searchSuggestions.replaceChildren(...suggestions.map(({ value }) => {
+                const option = document.createElement('option');
+                option.value = value;
+                return option;
+            }));
+        } catch (error) {
+            if (error.name !== 'AbortError') {
+                console.error('Error fetching suggestions:', error);
+            }
+        }
     };
 
     searchBar.addEventListener('input', (event) => {
-        fetchAndRenderDocuments(event.target.value);
+        fetchSuggestions(event.target.value);
+        clearTimeout(searchDebounceTimer);
+        searchDebounceTimer = setTimeout(() => {
+            fetchAndRenderDocuments(event.target.value);
+        }, SEARCH_DEBOUNCE_MS);
     });
 
-    fetchAndRenderDocuments();
+    fetchMetadataKeys().then(() => fetchAndRenderDocuments());
+
+    // Live updates. After the first full listing, the change feed is
+    // followed from the sequence number that listing was read at, and only
+    // the documents that changed are re-fetched and patched in place.
+    // EventSource reconnects by itself, resuming after the last event id.
+    const CHANGE_BATCH_MS = 200;
+    let changeSource = null;
+    const pendingDocIds = new Set();
+    let pendingChangesTimer = null;
+    let metadataKeysStale = false;
+
+    const followChanges = (seq) => {
+        changeSource = new EventSource(`/changes/stream?${new URLSearchParams({ since: seq })}`);
+        changeSource.addEventListener('change', (event) => {
+            const change = JSON.parse(event.data);
+            pendingDocIds.add(change.doc_id);
+            if (change.change_type !== 'version_added' && change.change_type !== 'version_deleted') {
+                metadataKeysStale = true;
+            }
+            if (pendingChangesTimer === null) {
+                pendingChangesTimer = setTimeout(applyPendingChanges, CHANGE_BATCH_MS);
+            }
+        });
+    };
+
+    const applyPendingChanges = async () => {
+        pendingChangesTimer = null;
+        const docIds = [...pendingDocIds];
+        pendingDocIds.clear();
+        searchCache.clear();
+        if (metadataKeysStale) {
+            metadataKeysStale = false;
+            await fetchMetadataKeys();
+        }
+        if (searchBar.value.trim()) {
+            // Search matches can change too; re-run the query instead
+            fetchAndRenderDocuments(searchBar.value);
+            return;
+        }
+
+        try {
+            const updates = await Promise.all(docIds.map(async (docId) => {
+                const response = await fetch(`/documents/${encodeURIComponent(docId)}`);
+                return [docId, response.ok ? await response.json() : null];
+            }));
+            const documents = currentDocuments.slice();
+            const positions = new Map(documents.map((doc, i) => [doc.doc_id, i]));
+            if (updates.some(([docId, doc]) => doc !== null && !positions.has(docId))) {
+                // New documents belong wherever the server's ordering puts
+                // them (newest first), so re-fetch the listing
+                fetchAndRenderDocuments(searchBar.value);
+                return;
+            }
+            const removed = new Set();
+            updates.forEach(([docId, doc]) => {
+                if (doc === null) {
+                    removed.add(docId);
+                    expandedDocs.delete(docId);
+                } else {
+                    documents[positions.get(docId)] = doc;
+                }
+            });
+            renderDocuments(removed.size ? documents.filter(doc => !removed.has(doc.doc_id)) : documents);
+        } catch (error) {
+            console.error('Error applying catalog changes:', error);
+        }
+    };
 
     // Function to handle version deletion
     const deleteVersion = async (docId, version) => {
         if (confirm(`Are you sure you want to delete version ${version} of document ${docId}?`)) {
             try {
-                const response = await fetch(`/documents/${docId}/versions/${version}`, {
+                const response = await fetch(`/documents/${encodeURIComponent(docId)}/versions/${encodeURIComponent(version)}`, {
                     method: 'DELETE',
                 });
                 const result = await response.json();
                 if (result.success) {
                     alert(result.message);
-                    // Re-fetch and render documents to update the UI
-                    fetchAndRenderDocuments(searchBar.value);
+                    // Drop cached results and re-fetch to update the UI
+                    refreshDocuments();
                 } else {
                     alert(`Error: ${result.error}`);
                 }
@@ -165,7 +464,17 @@ document.addEventListener('DOMContentLoaded', () => {
 
     // Event delegation for delete buttons (since they are dynamically created)
     documentsTableBody.addEventListener('click', async (event) => {
-        if (event.target.classList.contains('delete-version-btn')) {
+        if (event.target.classList.contains('toggle-versions')) {
+            const doc = currentDocuments[Number(event.target.dataset.index)];
+            if (expandedDocs.has(doc.doc_id)) {
+                expandedDocs.delete(doc.doc_id);
+            } else {
+                // Real height is measured on the next render
+                expandedDocs.set(doc.doc_id, 0);
+            }
+            computeRowOffsets();
+            renderWindow();
+        } else if (event.target.classList.contains('delete-version-btn')) {
             const docId = event.target.dataset.docId;
             const version = event.target.dataset.version;
             await deleteVersion(docId, version);
@@ -0,0 +1,338 @@
+import hashlib
+import os
+import threading
+import time
+from collections import namedtuple
+from flask import current_app
+from werkzeug.security import safe_join
+
+try:
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+    from botocore.exceptions import ClientError
+except ImportError: # boto3 is only needed for the S3 backend
+    boto3 = None
+
+# Where uploaded files live. Files are addressed by key: the path relative
+# to the storage root, always with '/' separators. The database keeps
+# storing ``UPLOAD_FOLDER/<key>`` in file_path columns, and storage_key()
+# maps it back to a key.
+#
+# New files use a sharded layout, ``ab/cd/<name>`` where ``abcd`` starts
+# the SHA-256 of the file name, so no directory grows past a few thousand
+# entries. Older files may still be flat (``<name>``) until
+# migrate_layout.py has moved them.
+#
+# STORAGE_BACKEND selects the implementation: 'local' (default) keeps files
+# under UPLOAD_FOLDER, 's3' stores them in an S3-compatible bucket (AWS,
+# MinIO...) configured by the S3_* settings.
+
+ObjectInfo = namedtuple('ObjectInfo', ['key', 'size', 'modified'])
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class StorageBackend:
+    """Interface implemented by every storage backend."""
+
+    def put_stream(self, key, stream, content_type=None):
+        """Store everything read from ``stream`` under ``key``.
+
+        Returns ``(size, sha256 hex digest)`` of the stored bytes.
+        """
+        raise NotImplementedError
+
+    def get_stream(self, key):
+        """Return a readable binary file object; raises FileNotFoundError."""
+        raise NotImplementedError
+
+    def get_range(self, key, start, length):
+        """Return up to ``length`` bytes starting at offset ``start``."""
+        raise NotImplementedError
+
+    def stat(self, key):
+        """Return an ObjectInfo, or None if the key does not exist."""
+        raise NotImplementedError
+
+    def exists(self, key):
+        return self.stat(key) is not None
+
+    def exists_cached(self, key):
+        """Like exists(), but may answer from a slightly stale cache.
+
+        Used for the per-row consistency flags of document listings.
+        """
+        return self.exists(key)
+
+    def delete(self, key):
+        """Delete ``key``. Returns False if it did not exist."""
+        raise NotImplementedError
+
+    def list(self, prefix=''):
+        """Yield an ObjectInfo for every key starting with ``prefix``."""
+        raise NotImplementedError
+
+    def move(self, source_key, destination_key):
+        """Rename a key, replacing the destination if it exists."""
+        raise NotImplementedError
+
+    def presigned_url(self, key, expires=None, filename=None):
+        """A URL clients can download ``key`` from directly, or None if unsupported."""
+        return None
+
+
+class _HashingReader:
+    """Wraps a stream and hashes everything read through it."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        chunk = self.stream.read(size)
+        self.digest.update(chunk)
+        self.size += len(chunk)
+        return chunk
+
+
+def _fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return  # e.g. Windows, where directories cannot be opened
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class LocalStorage(StorageBackend):
+    """Files under a directory on the local filesystem."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        path = safe_join(self.root, key)
+        if path is None or not key:
+            raise ValueError(f"Invalid storage key: {key!r}")
+        return path
+
+    def put_stream(self, key, stream, content_type=None):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        with open(path, 'wb') as out:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+                size += len(chunk)
+                out.write(chunk)
+            out.flush()
+            os.fsync(out.fileno())
+        _fsync_dir(os.path.dirname(path))
+        return size, digest.hexdigest()
+
+    def get_stream(self, key):
+        return open(self.path(key), 'rb')
+
+    def get_range(self, key, start, length):
+        with open(self.path(key), 'rb') as f:
+            f.seek(start)
+            return f.read(length)
+
+    def stat(self, key):
+        try:
+            st = os.stat(self.path(key))
+        except FileNotFoundError:
+            return None
+        return ObjectInfo(key, st.st_size, st.st_mtime)
+
+    def exists(self, key):
+        return os.path.isfile(self.path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def list(self, prefix=''):
+        stack = ['']
+        while stack:
+            relative = stack.pop()
+            try:
+                entries = os.scandir(os.path.join(self.root, relative))
+            except FileNotFoundError:
+                continue
+            with entries:
+                for entry in entries:
+                    key = f'{relative}/{entry.name}' if relative else entry.name
+                    if entry.is_dir(follow_symlinks=False):
+                        if key.startswith(prefix) or prefix.startswith(key + '/'):
+                            stack.append(key)
+                    elif entry.is_file(follow_symlinks=False) and key.startswith(prefix):
+                        st = entry.stat(follow_symlinks=False)
+                        yield ObjectInfo(key, st.st_size, st.st_mtime)
+
+    def move(self, source_key, destination_key):
+        destination = self.path(destination_key)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        os.replace(self.path(source_key), destination)
+        _fsync_dir(os.path.dirname(destination))
+
+
+class S3Storage(StorageBackend):
+    """Objects in an S3-compatible bucket (AWS S3, MinIO, moto...).
+
+    Uploads larger than ``multipart_threshold`` use multipart upload, and
+    downloads are served through presigned URLs so app workers do not
+    proxy the bytes. exists_cached() remembers each key's HEAD answer for
+    ``exists_ttl`` seconds, for up to ``exists_cache_size`` keys.
+    """
+
+    def __init__(self, bucket, prefix='', client=None, endpoint_url=None, region_name=None,
+                 multipart_threshold=8 * 1024 * 1024, multipart_chunksize=8 * 1024 * 1024, url_expires=3600,
+                 exists_ttl=30, exists_cache_size=10000):
+        # Even with a client passed in: TransferConfig and ClientError come from boto3
+        if boto3 is None:
+            raise RuntimeError("boto3 is required for the S3 storage backend")
+        if client is None:
+            client = boto3.client('s3', endpoint_url=endpoint_url, region_name=region_name)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self.transfer_config = TransferConfig(multipart_threshold=multipart_threshold,
+                                              multipart_chunksize=multipart_chunksize)
+        self.url_expires = url_expires
+        self.exists_ttl = exists_ttl
+        self.exists_cache_size = exists_cache_size
+        self._exists = {}  # key -> (exists, checked at)
+        self._exists_lock = threading.Lock()
+
+    def object_key(self, key):
+        if not key or key.startswith('/') or '..' in key.split('/'):
+            raise ValueError(f"Invalid storage key: {key!r}")
+        return self.prefix + key
+
+    def put_stream(self, key, stream, content_type=None):
+        reader = _HashingReader(stream)
+        extra_args = {'ContentType': content_type} if content_type else None
+        self.client.upload_fileobj(reader, self.bucket, self.object_key(key),
+                                   ExtraArgs=extra_args, Config=self.transfer_config)
+        self.forget(key)
+        return reader.size, reader.digest.hexdigest()
+
+    def _get_object(self, key, **kwargs):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self.object_key(key), **kwargs)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                raise FileNotFoundError(key) from e
+            raise
+
+    def get_stream(self, key):
+        return self._get_object(key)['Body']
+
+    def get_range(self, key, start, length):
+        if length <= 0:
+            return b''
+        return self._get_object(key, Range=f'bytes={start}-{start + length - 1}')['Body'].read()
+
+    def stat(self, key):
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=self.object_key(key))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404', 'NotFound'):
+                return None
+            raise
+        return ObjectInfo(key, head['ContentLength'], head['LastModified'].timestamp())
+
+    def exists_cached(self, key):
+        now = time.monotonic()
+        cached = self._exists.get(key)
+        if cached is not None and now - cached[1] <= self.exists_ttl:
+            return cached[0]
+        # The HEAD request runs outside the lock, so requests never queue behind it
+        exists = self.exists(key)
+        with self._exists_lock:
+            if len(self._exists) >= self.exists_cache_size:
+                self._exists = {k: v for k, v in self._exists.items() if now - v[1] <= self.exists_ttl}
+                if len(self._exists) >= self.exists_cache_size:
+                    self._exists.clear()
+            self._exists[key] = (exists, now)
+        return exists
+
+    def forget(self, *keys):
+        with self._exists_lock:
+            for key in keys:
+                self._exists.pop(key, None)
+
+    def delete(self, key):
+        existed = self.exists(key)
+        self.client.delete_object(Bucket=self.bucket, Key=self.object_key(key))
+        self.forget(key)
+        return existed
+
+    def list(self, prefix=''):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix + prefix):
+            for obj in page.get('Contents', []):
+                yield ObjectInfo(obj['Key'][len(self.prefix):], obj['Size'], obj['LastModified'].timestamp())
+
+    def move(self, source_key, destination_key):
+        # Managed copy switches to multipart copy for objects over 5 GB
+        self.client.copy({'Bucket': self.bucket, 'Key': self.object_key(source_key)},
+                         self.bucket, self.object_key(destination_key), Config=self.transfer_config)
+        self.client.delete_object(Bucket=self.bucket, Key=self.object_key(source_key))
+        self.forget(source_key, destination_key)
+
+    def presigned_url(self, key, expires=None, filename=None):
+        params = {'Bucket': self.bucket, 'Key': self.object_key(key)}
+        if filename:
+            params['ResponseContentDisposition'] = f'inline; filename="{filename}"'
+        return self.client.generate_presigned_url('get_object', Params=params,
+                                                  ExpiresIn=expires or self.url_expires)
+
+
+def shard_key(filename):
+    """Sharded key ``ab/cd/<filename>`` for a file name."""
+    digest = hashlib.sha256(filename.encode('utf-8')).hexdigest()
+    return f'{digest[:2]}/{digest[2:4]}/{filename}'
+
+
+def storage_path(upload_folder, key):
+    """The ``file_path`` stored in the database for ``key``; inverse of storage_key()."""
+    return os.path.join(upload_folder, *key.split('/'))
+
+
+def storage_key(file_path, upload_folder):
+    """Storage key of a ``file_path`` stored in the database."""
+    relative = os.path.relpath(file_path, upload_folder)
+    if relative.startswith('..') or os.path.isabs(relative):
+        relative = os.path.basename(file_path)
+    return relative.replace(os.sep, '/')
+
+
+def get_storage(app=None):
+    """The storage backend configured for ``app`` (default: the current app)."""
+    app = app or current_app
+    backend = app.config.get('STORAGE_BACKEND', 'local')
+    if isinstance(backend, StorageBackend):
+        return backend
+    if backend == 'local':
+        return LocalStorage(os.path.join(app.root_path, app.config['UPLOAD_FOLDER']))
+    if backend == 's3':
+        storage = app.extensions.get('s3_storage')
+        if storage is None:
+            storage = app.extensions['s3_storage'] = S3Storage(
+                app.config['S3_BUCKET'],
+                prefix=app.config.get('S3_PREFIX', ''),
+                endpoint_url=app.config.get('S3_ENDPOINT_URL'),
+                region_name=app.config.get('S3_REGION'),
+                url_expires=app.config.get('S3_URL_EXPIRES', 3600),
+            )
+        return storage
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend!r}")
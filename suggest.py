@@ -0,0 +1,457 @@
+import bisect
+import copy
+import heapq
+import json
+import logging
+import re
+import sys
+import threading
+from array import array
+from collections import Counter
+
+from flask import request
+
+from database import DATABASE_NAME, get_changes, get_db_connection, latest_change_seq
+
+# Autocomplete for the search bar. The vocabulary is every doc_id and every
+# string metadata value, lowercased, each with the number of documents
+# carrying it. It is kept in memory, compactly:
+#
+# * terms are interned strings indexed by a small integer id,
+# * a sorted array('I') holds one entry per word start of every term
+#   (id << 7 | offset), so a prefix of any word is found by bisection,
+# * trigram postings ('$' + each word) are array('I') lists of ids, used to
+#   find candidates within a few edits of a mistyped query.
+#
+# Exact prefix matches rank first; only when there are not enough of them
+# are fuzzy matches looked up.
+#
+# A published index is never modified. A background thread builds the first
+# one on the server's first request, then follows the catalog change feed,
+# every SUGGEST_REFRESH_SECONDS and right after each write: it reads the
+# changed documents, applies them to a copy of the index and swaps the copy
+# in. Queries read whichever index is current, with no lock and no SQL.
+
+logger = logging.getLogger(__name__)
+
+MAX_TERM_LENGTH = 100  # offsets must fit in the low 7 bits of an entry
+OFFSET_BITS = 7
+OFFSET_MASK = (1 << OFFSET_BITS) - 1
+PREFIX_SCAN_LIMIT = 2000
+FUZZY_MIN_LENGTH = 4
+FUZZY_CANDIDATES = 50
+FUZZY_SCAN_LIMIT = 100000
+TRIGRAM_WORD_LENGTH = 12
+CHANGES_BATCH = 1000
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 50
+REFRESH_INTERVAL_SECONDS = 2.0
+WORD_PATTERN = re.compile(r'[^\W_]+')
+
+
+def normalize(value):
+    return ' '.join(value.split()).lower()[:MAX_TERM_LENGTH]
+
+
+def max_edits(query):
+    """Edits tolerated for a query: none below FUZZY_MIN_LENGTH, then one, and two from 8 characters."""
+    if len(query) < FUZZY_MIN_LENGTH:
+        return 0
+    return 1 if len(query) < 8 else 2
+
+
+def word_starts(term):
+    return [match.start() for match in WORD_PATTERN.finditer(term)]
+
+
+def word_trigrams(word):
+    """Trigrams of ``'$' + word``; '$$x' would match a 26th of all words and is left out."""
+    padded = '$' + word[:TRIGRAM_WORD_LENGTH]
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def term_trigrams(term):
+    return set().union(*(word_trigrams(word) for word in WORD_PATTERN.findall(term)))
+
+
+def prefix_distance(query, text, limit):
+    """Edit distance between ``query`` and the closest prefix of ``text``, or ``limit + 1`` if above ``limit``.
+
+    Swapping two adjacent characters counts as one edit. Only cells within
+    ``limit`` of the diagonal are computed.
+    """
+    text = text[:len(query) + limit]
+    over = limit + 1
+    before = None
+    previous = [j if j <= limit else over for j in range(len(text) + 1)]
+    for i, char in enumerate(query, 1):
+        current = [i if i <= limit else over] + [over] * len(text)
+        for j in range(max(1, i - limit), min(len(text), i + limit) + 1):
+            cost = 0 if text[j - 1] == char else 1
+            distance = min(previous[j - 1] + cost, previous[j] + 1, current[j - 1] + 1, over)
+            if before is not None and j > 1 and char == text[j - 2] and query[i - 2] == text[j - 1]:
+                distance = min(distance, before[j - 2] + 1)
+            current[j] = distance
+        if min(current) > limit:
+            return over
+        before, previous = previous, current
+    return min(previous)
+
+
+def document_values(doc_id, metadata):
+    """The suggestible strings of a document: its doc_id and string metadata values, once per term."""
+    values = {normalize(doc_id): doc_id}
+    try:
+        stack = [json.loads(metadata or '{}')]
+    except ValueError:
+        logger.warning("Ignoring invalid metadata of %s in the suggestion index", doc_id)
+        stack = []
+    while stack:
+        value = stack.pop()
+        if isinstance(value, dict):
+            stack.extend(value.values())
+        elif isinstance(value, list):
+            stack.extend(value)
+        elif isinstance(value, str) and normalize(value):
+            values.setdefault(normalize(value), value)
+    return list(values.values())
+
+
+class IndexNotReady(Exception):
+    """The first index is still being built."""
+
+
+class SuggestIndex:
+    """In-memory prefix and trigram index of the catalog's values.
+
+    Once built, an index is read-only: updated() returns a new index that
+    shares whatever the changes do not touch.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self.built = False
+        self.seq = 0
+        self.ids = {}           # term -> id
+        self.terms = []         # id -> term (None once removed)
+        self.displays = []      # id -> value as first seen
+        self.counts = array('I')
+        self.free_ids = []
+        self.entries = array('I')
+        self.postings = {}      # trigram -> array of ids
+        self.documents = {}     # doc_id -> tuple of ids
+        self.pending = None     # changes being applied by updated()
+
+    def entry_key(self, entry):
+        return self.terms[entry >> OFFSET_BITS][entry & OFFSET_MASK:]
+
+    def term_entries(self, term_id):
+        return [(term_id << OFFSET_BITS) | start for start in word_starts(self.terms[term_id])]
+
+    def build(self, conn):
+        """Index every document from scratch."""
+        self.seq = latest_change_seq(conn)
+        entries = []
+        for row in conn.execute('SELECT doc_id, metadata FROM documents'):
+            term_ids = []
+            for value in document_values(row[0], row[1]):
+                term_id, new = self.add_term(value)
+                term_ids.append(term_id)
+                if new:
+                    entries.extend(self.term_entries(term_id))
+            self.documents[row[0]] = tuple(term_ids)
+        entries.sort(key=self.entry_key)
+        self.entries = array('I', entries)
+        self.built = True
+        return self
+
+    def updated(self, seq, documents):
+        """A copy re-indexing ``documents`` ({doc_id: metadata, or None once deleted}) as of change ``seq``.
+
+        Only the containers that change are copied. Postings are copied the
+        first time they change, and entries are merged once at the end.
+        """
+        index = copy.copy(self)
+        index.ids = dict(self.ids)
+        index.terms = list(self.terms)
+        index.displays = list(self.displays)
+        index.counts = array('I', self.counts)
+        index.free_ids = list(self.free_ids)
+        index.postings = dict(self.postings)
+        index.documents = dict(self.documents)
+        index.pending = {'removed': [], 'added': [], 'freed': [], 'copied': set()}
+        for doc_id, metadata in documents.items():
+            index.remove_document(doc_id)
+            if metadata is not None:
+                term_ids = []
+                for value in document_values(doc_id, metadata):
+                    term_id, new = index.add_term(value)
+                    term_ids.append(term_id)
+                    if new:
+                        index.pending['added'].extend(index.term_entries(term_id))
+                index.documents[doc_id] = tuple(term_ids)
+        index.merge_pending()
+        index.seq = seq
+        return index
+
+    def merge_pending(self):
+        """Drop removed entries and insert added ones into a new entries array."""
+        pending, self.pending = self.pending, None
+        kept = array('I')
+        start = 0
+        for position in sorted(pending['removed']):
+            kept.extend(self.entries[start:position])
+            start = position + 1
+        kept.extend(self.entries[start:])
+        # Freed ids are reused only now, so their terms stay readable while
+        # the old entries are searched
+        for term_id in pending['freed']:
+            self.terms[term_id] = self.displays[term_id] = None
+        self.free_ids.extend(pending['freed'])
+        merged = array('I')
+        start = 0
+        for entry in sorted(pending['added'], key=self.entry_key):
+            position = bisect.bisect_left(kept, self.entry_key(entry), start, key=self.entry_key)
+            merged.extend(kept[start:position])
+            merged.append(entry)
+            start = position
+        merged.extend(kept[start:])
+        self.entries = merged
+
+    def posting_list(self, trigram):
+        """The postings of ``trigram`` to modify, copied first if the published index shares them."""
+        postings = self.postings.get(trigram)
+        if self.pending is not None and trigram not in self.pending['copied']:
+            self.pending['copied'].add(trigram)
+            postings = self.postings[trigram] = array('I', postings or ())
+        elif postings is None:
+            postings = self.postings[trigram] = array('I')
+        return postings
+
+    def add_term(self, value):
+        """Count one more document for ``value``. Returns (id, whether the term is new)."""
+        term = normalize(value)
+        term_id = self.ids.get(term)
+        if term_id is not None:
+            self.counts[term_id] += 1
+            return term_id, False
+        term = sys.intern(term)
+        display = value.strip()[:MAX_TERM_LENGTH]
+        if self.free_ids:
+            term_id = self.free_ids.pop()
+            self.terms[term_id] = term
+            self.displays[term_id] = term if display == term else display
+            self.counts[term_id] = 1
+        else:
+            term_id = len(self.terms)
+            self.terms.append(term)
+            self.displays.append(term if display == term else display)
+            self.counts.append(1)
+        self.ids[term] = term_id
+        for trigram in term_trigrams(term):
+            self.posting_list(trigram).append(term_id)
+        return term_id, True
+
+    def remove_document(self, doc_id):
+        for term_id in self.documents.pop(doc_id, ()):
+            self.counts[term_id] -= 1
+            if self.counts[term_id] == 0:
+                self.remove_term(term_id)
+
+    def remove_term(self, term_id):
+        """Unindex a term; its entries are dropped by merge_pending(). Only within updated()."""
+        term = self.terms[term_id]
+        for entry in self.term_entries(term_id):
+            i = bisect.bisect_left(self.entries, self.entry_key(entry), key=self.entry_key)
+            while self.entries[i] != entry:
+                i += 1
+            self.pending['removed'].append(i)
+        for trigram in term_trigrams(term):
+            postings = self.posting_list(trigram)
+            postings.remove(term_id)
+            if not postings:
+                del self.postings[trigram]
+        del self.ids[term]
+        self.pending['freed'].append(term_id)
+
+    def prefix_matches(self, query):
+        """{id: offset of the matching word} for terms with a word starting with ``query``.
+
+        Only the first PREFIX_SCAN_LIMIT entries are looked at, so suggestions
+        for very short queries are ranked among a sample.
+        """
+        matches = {}
+        start = bisect.bisect_left(self.entries, query, key=self.entry_key)
+        stop = bisect.bisect_left(self.entries, query + '\uffff', start, min(len(self.entries), start + PREFIX_SCAN_LIMIT),
+                                  key=self.entry_key)
+        for entry in self.entries[start:stop]:
+            matches.setdefault(entry >> OFFSET_BITS, entry & OFFSET_MASK)
+        return matches
+
+    def fuzzy_matches(self, query, limit):
+        """{id: (distance, offset)} for terms with a word prefix within ``limit`` edits of ``query``."""
+        words = WORD_PATTERN.findall(query)
+        if not words:
+            return {}
+        hits = Counter()
+        scanned = lists = 0
+        for postings in sorted((self.postings.get(trigram, ()) for trigram in word_trigrams(words[0])), key=len):
+            scanned += len(postings)
+            if scanned > FUZZY_SCAN_LIMIT:
+                break
+            hits.update(postings)
+            lists += 1
+        # Each edit changes at most four trigrams (three, or four for a swap)
+        needed = max(1, lists - 4 * limit)
+        matches = {}
+        for term_id, count in hits.most_common(FUZZY_CANDIDATES):
+            if count < needed:
+                break
+            term = self.terms[term_id]
+            best = min(((prefix_distance(query, term[start:], limit), start) for start in word_starts(term)),
+                       default=(limit + 1, 0))
+            if best[0] <= limit:
+                matches[term_id] = best
+        return matches
+
+    def suggest(self, query, limit=DEFAULT_LIMIT):
+        """Up to ``limit`` suggestions for ``query``, best first."""
+        query = normalize(query)
+        if not query:
+            return []
+        found = {term_id: (0, offset) for term_id, offset in self.prefix_matches(query).items()}
+        edits = max_edits(query)
+        if len(found) < limit and edits:
+            for term_id, match in self.fuzzy_matches(query, edits).items():
+                found.setdefault(term_id, match)
+        ranked = heapq.nsmallest(limit, found.items(), key=lambda item: (
+            item[1][0], item[1][1] > 0, -self.counts[item[0]], len(self.terms[item[0]]), self.terms[item[0]]))
+        return [{'value': self.displays[term_id], 'documents': self.counts[term_id], 'distance': distance}
+                for term_id, (distance, _) in ranked]
+
+
+def get_index(app):
+    """The app's current index; an unbuilt one until the first build is published."""
+    database = app.config.get('DATABASE') or DATABASE_NAME
+    index = app.extensions.get('suggest')
+    if index is None or index.database != database:
+        index = app.extensions['suggest'] = SuggestIndex(database)
+    return index
+
+
+_refresh_lock = threading.Lock()
+
+
+def refresh(app):
+    """Build the app's index, or apply the changes since it was built, and publish the result.
+
+    An index ahead of the database's change feed (a restored database) is
+    rebuilt, and so is one the changes cannot be applied to. Returns the
+    published index.
+    """
+    with _refresh_lock:
+        index = get_index(app)
+        conn = get_db_connection(index.database)
+        try:
+            if not index.built or index.seq > latest_change_seq(conn):
+                index = SuggestIndex(index.database).build(conn)
+            else:
+                seq, changed = index.seq, set()
+                while True:
+                    changes = get_changes(seq, CHANGES_BATCH, conn)
+                    if not changes:
+                        break
+                    changed.update(change['doc_id'] for change in changes)
+                    seq = changes[-1]['seq']
+                if changed:
+                    documents = dict.fromkeys(changed)
+                    for doc_id in changed:
+                        row = conn.execute('SELECT metadata FROM documents WHERE doc_id = ?', (doc_id,)).fetchone()
+                        if row is not None:
+                            documents[doc_id] = row[0] or '{}'
+                    try:
+                        index = index.updated(seq, documents)
+                    except Exception:
+                        # The published index is untouched; start over from the database
+                        logger.exception("Could not apply changes to the suggestion index, rebuilding it")
+                        index = SuggestIndex(index.database).build(conn)
+        finally:
+            conn.close()
+        if index.database == (app.config.get('DATABASE') or DATABASE_NAME):
+            app.extensions['suggest'] = index
+        return index
+
+
+def suggest_app(app, query, limit=DEFAULT_LIMIT):
+    """Suggestions from the app's current index. Raises IndexNotReady before the first build."""
+    index = get_index(app)
+    if not index.built:
+        raise IndexNotReady("The suggestion index is being built")
+    return index.suggest(query, limit)
+
+
+class SuggestUpdater:
+    """Background thread running refresh() every ``interval`` seconds and when woken."""
+
+    def __init__(self, refresh, interval=REFRESH_INTERVAL_SECONDS):
+        self.refresh = refresh
+        self.interval = interval
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='suggest-updater', daemon=True)
+        self._thread.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.clear()
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Could not update the suggestion index")
+            self._wake.wait(self.interval)
+
+
+_updater_lock = threading.Lock()
+
+
+def start_updater(app):
+    """Start the app's updater thread, which builds the index first; returns it."""
+    with _updater_lock:
+        updater = app.extensions.get('suggest_updater')
+        if updater is None:
+            updater = SuggestUpdater(lambda: refresh(app),
+                                     app.config.get('SUGGEST_REFRESH_SECONDS', REFRESH_INTERVAL_SECONDS))
+            updater.start()
+            app.extensions['suggest_updater'] = updater
+        return updater
+
+
+def init_suggest(app):
+    """Start the updater on the first request, and wake it after every successful write.
+
+    Not for testing apps, which call refresh() or start_updater() themselves.
+    """
+    def start_once():
+        if 'suggest_updater' not in app.extensions and not app.testing:
+            start_updater(app)
+
+    def wake_after_write(response):
+        updater = app.extensions.get('suggest_updater')
+        if updater is not None and request.method in ('POST', 'PUT', 'PATCH', 'DELETE') and response.status_code < 400:
+            updater.wake()
+        return response
+
+    app.before_request(start_once)
+    app.after_request(wake_after_write)
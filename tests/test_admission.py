@@ -0,0 +1,149 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import io
+import json
+import shutil
+import tempfile
+import threading
+import time
+from collections import namedtuple
+import pytest
+import requests
+import admission
+import metrics
+import upload_client
+from app import app
+from database import create_tables
+
+DiskUsage = namedtuple('DiskUsage', 'total used free')
+GB = 1024 ** 3
+
+
+@pytest.fixture
+def client(monkeypatch):
+    db_fd, database = tempfile.mkstemp()
+    upload_dir = tempfile.mkdtemp()
+    monkeypatch.setitem(app.config, 'DATABASE', database)
+    monkeypatch.setitem(app.config, 'UPLOAD_FOLDER', upload_dir)
+    monkeypatch.setitem(app.config, 'TESTING', True)
+    monkeypatch.setitem(app.extensions, 'admission', admission.AdmissionController())
+    metrics.reset_counters()
+    with app.app_context():
+        create_tables()
+    yield app.test_client()
+    os.close(db_fd)
+    os.unlink(database)
+    shutil.rmtree(upload_dir)
+
+def upload(client, doc_id='doc'):
+    return client.post('/upload', data={
+        'doc_id': doc_id, 'metadata': json.dumps({'name': doc_id}),
+        'file': (io.BytesIO(b'%PDF-1.4 test'), f'{doc_id}.pdf'),
+    }, content_type='multipart/form-data')
+
+def test_saturated_uploads_are_rejected_with_retry_after(client, monkeypatch):
+    monkeypatch.setitem(app.config, 'UPLOAD_MAX_CONCURRENT', 1)
+    monkeypatch.setitem(app.config, 'UPLOAD_QUEUE_TIMEOUT_SECONDS', 0.05)
+    controller = app.extensions['admission']
+    controller.acquire(0)
+    rv = upload(client)
+    assert rv.status_code == 503
+    assert rv.headers['Retry-After'] == str(admission.DEFAULT_RETRY_AFTER_SECONDS)
+    assert metrics.get_counters()['upload_admission_rejections_total{reason="concurrency"}'] == 1
+
+    monkeypatch.setitem(app.config, 'UPLOAD_MAX_QUEUE', 0)
+    assert upload(client).status_code == 503
+    assert metrics.get_counters()['upload_admission_rejections_total{reason="queue_full"}'] == 1
+
+    controller.release(0)
+    assert upload(client).status_code == 200
+    assert controller.inflight == 0 and controller.inflight_bytes == 0
+
+def test_queued_upload_is_admitted_when_a_slot_frees(client, monkeypatch):
+    monkeypatch.setitem(app.config, 'UPLOAD_MAX_CONCURRENT', 1)
+    controller = app.extensions['admission']
+    controller.acquire(0)
+    results = []
+    thread = threading.Thread(target=lambda: results.append(upload(client).status_code))
+    thread.start()
+    deadline = time.monotonic() + 5
+    while metrics.get_gauges().get('upload_admission_queue_depth') != 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert metrics.get_gauges()['upload_admission_queue_depth'] == 1
+    controller.release(0)
+    thread.join()
+    assert results == [200]
+    assert metrics.get_gauges()['upload_admission_queue_depth'] == 0
+
+def test_inflight_bytes_limit():
+    controller = admission.AdmissionController()
+    controller.acquire(600, max_bytes=1000)
+    with pytest.raises(admission.AdmissionRejected) as e:
+        controller.acquire(600, max_bytes=1000, queue_timeout=0)
+    assert e.value.reason == 'bytes'
+    controller.acquire(400, max_bytes=1000, queue_timeout=0)
+    controller.release(600)
+    controller.release(400)
+    # An upload over the limit on its own is admitted when nothing else is in flight
+    controller.acquire(5000, max_bytes=1000, queue_timeout=0)
+
+def test_disk_watermarks(client, monkeypatch):
+    monkeypatch.setitem(app.config, 'DISK_FREE_LOW_BYTES', 1 * GB)
+    monkeypatch.setitem(app.config, 'DISK_FREE_HIGH_BYTES', 2 * GB)
+    free = {'bytes': int(0.5 * GB)}
+    monkeypatch.setattr(admission.shutil, 'disk_usage', lambda path: DiskUsage(0, 0, free['bytes']))
+
+    rv = upload(client)
+    assert rv.status_code == 503
+    assert rv.headers['Retry-After'] == str(admission.DISK_RETRY_AFTER_SECONDS)
+    # Between the watermarks uploads stay refused until free space passes the high one
+    free['bytes'] = int(1.5 * GB)
+    assert upload(client).status_code == 503
+    free['bytes'] = 3 * GB
+    assert upload(client).status_code == 200
+    free['bytes'] = int(1.5 * GB)
+    assert upload(client, 'second').status_code == 200
+    assert metrics.get_counters()['upload_admission_rejections_total{reason="disk"}'] == 2
+    assert metrics.get_gauges()['disk_free_bytes'] == int(1.5 * GB)
+
+def test_unknown_lengths_and_finalize_are_charged_what_they_write(client, monkeypatch):
+    monkeypatch.setitem(app.config, 'UPLOAD_UNKNOWN_LENGTH_BYTES', 12345)
+    chunked = {'Transfer-Encoding': 'chunked'}
+    with app.test_request_context('/upload', method='POST', input_stream=io.BytesIO(b'x' * 10), headers=chunked):
+        assert admission.body_bytes() == 12345
+        assert admission.body_bytes(unknown=7) == 7
+    with app.test_request_context('/upload', method='POST'):
+        assert admission.body_bytes() == 0
+    with app.test_request_context('/upload', method='POST', data=b'x' * 10):
+        assert admission.body_bytes() == 10
+
+    charged = []
+    real_admit = admission.admit
+    monkeypatch.setattr(admission, 'admit', lambda nbytes: charged.append(nbytes) or real_admit(nbytes))
+    pdf = b'%PDF-1.4\n' + b'x' * 3000
+    url = client.post('/upload/sessions', json={'doc_id': 'big', 'metadata': {}, 'filename': 'big.pdf',
+                                                'size': len(pdf), 'chunk_size': len(pdf)}).headers['Location']
+    chunk_size = client.get(url).get_json()['chunk_size']
+    rv = client.patch(url, input_stream=io.BytesIO(pdf), headers={'Upload-Offset': '0', **chunked},
+                      environ_overrides={'wsgi.input_terminated': True},
+                      content_type='application/offset+octet-stream')
+    assert rv.status_code == 204
+    rv = client.post(url + '/finalize')
+    assert rv.status_code == 200
+    # A chunk of unknown length is charged a whole chunk, finalize the whole file on top of its body
+    assert charged == [chunk_size, len(pdf)]
+    assert app.extensions['admission'].inflight_bytes == 0
+
+def test_client_honors_retry_after(monkeypatch):
+    busy = requests.Response()
+    busy.status_code = 503
+    busy.headers['Retry-After'] = '3'
+    ok = requests.Response()
+    ok.status_code = 200
+    responses = [busy, ok]
+    sleeps = []
+    monkeypatch.setattr(upload_client.requests, 'request', lambda *args, **kwargs: responses.pop(0))
+    monkeypatch.setattr(upload_client.time, 'sleep', sleeps.append)
+    assert upload_client.request_with_retry('post', 'http://localhost/upload') is ok
+    assert len(sleeps) == 1 and 3 <= sleeps[0] <= 3 + upload_client.RETRY_BACKOFF_SECONDS
@@ -282,3 +282,225 @@ def test_uploaded_file(client):
     rv = client.get(f'/uploads/{filename}')
     assert rv.status_code == 200
     assert rv.data == b"download_content"
+
+def test_search_request_counter(client):
+    import metrics
+    metrics.reset_counters()
+
+    client.get('/search?q=first')
+    client.get('/search?q=first%20doc')
+    client.get('/documents')
+
+    rv = client.get('/stats')
+    assert rv.status_code == 200
+    stats = json.loads(rv.data)
+    assert stats['counters']['search_requests'] == 2
+    assert stats['timings']['serialization_seconds{route="get_documents"}']['count'] == 1
+
+def test_metadata_keys(client):
+    rv = client.get('/metadata_keys')
+    assert rv.status_code == 200
+    assert json.loads(rv.data) == []
+
+    data = {
+        'doc_id': 'doc1',
+        'metadata': json.dumps({'name': 'one', 'author': 'a'}),
+        'change_description': 'initial version',
+        'file': (io.BytesIO(b"abcdef"), 'test.pdf'),
+    }
+    client.post('/upload', content_type='multipart/form-data', data=data)
+    data = {
+        'doc_id': 'doc2',
+        'metadata': json.dumps({'name': 'two', 'year': 2024}),
+        'change_description': 'initial version',
+        'file': (io.BytesIO(b"ghijkl"), 'test.pdf'),
+    }
+    client.post('/upload', content_type='multipart/form-data', data=data)
+
+    rv = client.get('/metadata_keys')
+    keys = json.loads(rv.data)
+    assert [k['key'] for k in keys] == ['author', 'name', 'year']
+    assert next(k for k in keys if k['key'] == 'name')['doc_count'] == 2
+    assert next(k for k in keys if k['key'] == 'year')['value_type'] == 'integer'
+
+def test_documents_filter_and_sort(client):
+    for doc_id, author, year in [('doc1', 'alice', 2021), ('doc2', 'bob', 2023), ('doc3', 'alice', 2022)]:
+        data = {
+            'doc_id': doc_id,
+            'metadata': json.dumps({'author': author, 'year': year}),
+            'change_description': 'initial version',
+            'file': (io.BytesIO(b"abcdef"), 'test.pdf'),
+        }
+        client.post('/upload', content_type='multipart/form-data', data=data)
+
+    rv = client.get('/documents?filter[author]=alice&sort=year')
+    assert rv.status_code == 200
+    assert [d['doc_id'] for d in json.loads(rv.data)] == ['doc1', 'doc3']
+
+    rv = client.get('/documents?filter[year]=2023')
+    assert [d['doc_id'] for d in json.loads(rv.data)] == ['doc2']
+
+    rv = client.get('/documents?sort=-year')
+    assert [d['doc_id'] for d in json.loads(rv.data)] == ['doc2', 'doc3', 'doc1']
+
+    rv = client.get("/documents?filter[a')--]=x")
+    assert rv.status_code == 400
+
+def test_documents_range_and_in_filters(client):
+    for doc_id, status, year in [('doc1', 'draft', 2021), ('doc2', 'published', 2023),
+                                 ('doc3', 'archived', 2022), ('doc4', 'published', 2020)]:
+        data = {
+            'doc_id': doc_id,
+            'metadata': json.dumps({'status': status, 'year': year}),
+            'change_description': 'initial version',
+            'file': (io.BytesIO(b"abcdef"), 'test.pdf'),
+        }
+        client.post('/upload', content_type='multipart/form-data', data=data)
+
+    rv = client.get('/documents?filter[year][gte]=2021&filter[year][lt]=2023&sort=-year')
+    assert [d['doc_id'] for d in json.loads(rv.data)] == ['doc3', 'doc1']
+
+    rv = client.get('/documents?filter[status][in]=draft,archived&sort=year')
+    assert [d['doc_id'] for d in json.loads(rv.data)] == ['doc1', 'doc3']
+
+    rv = client.get('/documents?filter[status][ne]=published&filter[year][lte]=2021')
+    assert [d['doc_id'] for d in json.loads(rv.data)] == ['doc1']
+
+    rv = client.get('/documents?filter[year][between]=1')
+    assert rv.status_code == 400
+
+def test_metrics_endpoint(client):
+    import metrics
+    metrics.reset_counters()
+    data = {
+        'doc_id': 'doc1',
+        'metadata': json.dumps({'name': 'test_pdf'}),
+        'change_description': 'initial version',
+        'file': (io.BytesIO(b"abcdef"), 'test.pdf'),
+    }
+    client.post('/upload', content_type='multipart/form-data', data=data)
+    client.get('/documents')
+
+    rv = client.get('/metrics')
+    assert rv.status_code == 200
+    assert rv.mimetype == 'text/plain'
+    body = rv.data.decode()
+    assert '# TYPE pdf_browser_request_duration_seconds histogram' in body
+    assert 'pdf_browser_requests_total{method="GET",route="get_documents",status="200"} 1' in body
+    assert 'pdf_browser_request_duration_seconds_count{method="POST",route="upload_file"} 1' in body
+    assert 'pdf_browser_fs_checks_total{route="get_documents"} 1' in body
+    assert 'pdf_browser_upload_bytes_total' in body
+    sql_line = next(line for line in body.splitlines() if line.startswith('pdf_browser_sql_statements_total{route="get_documents"}'))
+    assert int(sql_line.split()[-1]) > 0
+
+def test_server_timing_header(client):
+    rv = client.get('/documents')
+    assert 'Server-Timing' not in rv.headers
+
+    app.config['SERVER_TIMING'] = True
+    try:
+        rv = client.get('/documents')
+    finally:
+        app.config['SERVER_TIMING'] = False
+    assert rv.headers['Server-Timing'].startswith('sql;dur=')
+    assert 'total;dur=' in rv.headers['Server-Timing']
+
+ADMIN_HEADERS = {'Authorization': 'Bearer secret'}
+
+def test_admin_routes_need_the_admin_token(client, monkeypatch):
+    assert client.get('/admin/slow_queries').status_code == 404
+    assert client.post('/admin/backups').status_code == 404
+    monkeypatch.setitem(app.config, 'ADMIN_TOKEN', 'secret')
+    assert client.get('/admin/slow_queries').status_code == 403
+    assert client.get('/admin/slow_queries', headers={'Authorization': 'Bearer wrong'}).status_code == 403
+    assert client.get('/admin/slow_queries', headers=ADMIN_HEADERS).status_code == 200
+    assert client.get('/admin/slow_queries', headers={'X-Admin-Token': 'secret'}).status_code == 200
+
+def test_admin_slow_queries(client, monkeypatch):
+    monkeypatch.setitem(app.config, 'ADMIN_TOKEN', 'secret')
+    from database import slow_query_log
+    slow_query_log.configure(None)
+    slow_query_log.clear()
+    app.config['SLOW_QUERY_THRESHOLD_MS'] = 0
+    try:
+        client.get('/documents')
+    finally:
+        app.config.pop('SLOW_QUERY_THRESHOLD_MS')
+
+    rv = client.get('/admin/slow_queries?limit=1', headers=ADMIN_HEADERS)
+    assert rv.status_code == 200
+    top = json.loads(rv.data)
+    assert len(top) == 1
+    assert {'fingerprint', 'count', 'max_ms', 'mean_ms', 'plan', 'parameter_shape'} <= set(top[0])
+    slow_query_log.clear()
+
+def test_upload_records_size_and_checksum(client):
+    import hashlib
+    data = {
+        'doc_id': 'doc_checksum',
+        'metadata': json.dumps({'name': 'checksum'}),
+        'change_description': 'initial version',
+        'file': (io.BytesIO(b"%PDF-1.4 checksum"), 'test.pdf'),
+        'html_files': [(io.BytesIO(b"<html></html>"), 'test.html')],
+    }
+    assert client.post('/upload', content_type='multipart/form-data', data=data).status_code == 200
+
+    with app.app_context():
+        from database import get_db_connection
+        conn = get_db_connection()
+        version = conn.execute('SELECT file_size, checksum FROM versions').fetchone()
+        html = conn.execute('SELECT file_size, checksum FROM html_documents').fetchone()
+    assert tuple(version) == (17, hashlib.sha256(b"%PDF-1.4 checksum").hexdigest())
+    assert tuple(html) == (13, hashlib.sha256(b"<html></html>").hexdigest())
+
+def test_admin_integrity(client, monkeypatch):
+    monkeypatch.setitem(app.config, 'ADMIN_TOKEN', 'secret')
+    data = {
+        'doc_id': 'doc_integrity',
+        'metadata': json.dumps({'name': 'integrity'}),
+        'change_description': 'initial version',
+        'file': (io.BytesIO(b"%PDF-1.4\n%%EOF\n"), 'test.pdf'),
+    }
+    client.post('/upload', content_type='multipart/form-data', data=data)
+    with open(os.path.join(app.config['UPLOAD_FOLDER'], 'stray.pdf'), 'wb') as f:
+        f.write(b'%PDF-1.4\n%%EOF\n')
+    app.config['INTEGRITY_WORKERS'] = 0
+    try:
+        rv = client.get('/admin/integrity', headers=ADMIN_HEADERS)
+    finally:
+        app.config.pop('INTEGRITY_WORKERS')
+    assert rv.status_code == 200
+    report = json.loads(rv.data)
+    assert report['complete']
+    assert report['missing'] == []
+    assert report['corrupt'] == []
+    assert [os.path.basename(p) for p in report['orphaned']] == ['stray.pdf']
+    assert report['hashed'] == 1
+
+def test_delete_document(client):
+    for description in ('v1', 'v2'):
+        client.post('/upload', content_type='multipart/form-data', data={
+            'doc_id': 'doc_delete_all',
+            'metadata': json.dumps({'name': 'delete all'}),
+            'change_description': description,
+            'file': (io.BytesIO(b"pdf"), 'test.pdf'),
+        })
+    upload_dir = app.config['UPLOAD_FOLDER']
+    def files_in(folder):
+        return [name for _, _, names in os.walk(folder) for name in names]
+    assert len(files_in(upload_dir)) == 2
+
+    rv = client.delete('/documents/doc_delete_all')
+    assert rv.status_code == 200
+    assert json.loads(rv.data) == {'success': True, 'message': 'Document deleted successfully.'}
+    assert json.loads(client.get('/documents').data) == []
+
+    from reaper import reap_tombstones
+    with app.app_context():
+        from database import get_db_connection
+        assert reap_tombstones(get_db_connection()) == (2, 0)
+    assert files_in(upload_dir) == []
+
+    rv = client.delete('/documents/doc_delete_all')
+    assert rv.status_code == 400
+    assert json.loads(rv.data) == {'success': False, 'error': 'Document not found.'}
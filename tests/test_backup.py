@@ -0,0 +1,119 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import sqlite3
+import tempfile
+import threading
+import time
+import pytest
+import backup
+from app import app
+from benchmarks.generator import generate_catalog
+from database import create_tables
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    database_path = str(tmp_path / 'catalog.db')
+    upload_folder = str(tmp_path / 'uploads')
+    generate_catalog(database_path, documents=30, versions_per_document=2, html_per_version=1, votes=20,
+                     upload_folder=upload_folder, write_files=True)
+    return database_path, str(tmp_path / 'backups')
+
+def test_backup_copies_database_and_writes_manifest(catalog):
+    database_path, backup_dir = catalog
+    os.remove(sqlite3.connect(database_path).execute('SELECT file_path FROM versions LIMIT 1').fetchone()[0])
+    manifest = backup.create_backup(database_path, backup_dir, pages=4, step_sleep=0)
+
+    snapshot = os.path.join(backup_dir, manifest['snapshot'])
+    conn = sqlite3.connect(snapshot)
+    assert conn.execute('SELECT COUNT(*) FROM versions').fetchone()[0] == 60
+    assert conn.execute('SELECT COUNT(*) FROM votes').fetchone()[0] == 20
+    conn.close()
+    assert manifest['file_count'] == 120
+    assert manifest['missing_files'] == 1
+    stored = backup.load_manifest(backup_dir, manifest['snapshot'])
+    assert len(stored['files']) == 120
+    assert set(stored['files'][0]) == {'path', 'size', 'checksum', 'exists'}
+    assert backup.verify_backup(backup_dir, manifest['snapshot'])
+
+    with open(snapshot, 'ab') as f:
+        f.write(b'tampered')
+    assert not backup.verify_backup(backup_dir, manifest['snapshot'])
+
+def test_backup_rotation_keeps_newest(catalog):
+    database_path, backup_dir = catalog
+    names = [backup.create_backup(database_path, backup_dir, keep=2, manifest_files=False)['snapshot'] for _ in range(4)]
+    assert [entry['snapshot'] for entry in backup.list_backups(backup_dir)] == names[:1:-1]
+    assert sorted(os.listdir(backup_dir)) == sorted(n for name in names[2:] for n in (name, name[:-3] + '.json'))
+
+def test_writers_keep_committing_during_backup(catalog):
+    database_path, backup_dir = catalog
+    stop = threading.Event()
+    committed = []
+
+    def write_votes():
+        conn = sqlite3.connect(database_path, timeout=1)
+        while not stop.is_set():
+            conn.execute("INSERT INTO votes (document_id, version_id, vote_type) VALUES (1, 1, 'good')")
+            conn.commit()
+            committed.append(1)
+            time.sleep(0.001)
+        conn.close()
+
+    writer = threading.Thread(target=write_votes)
+    writer.start()
+    try:
+        manifest = backup.create_backup(database_path, backup_dir, pages=1, step_sleep=0.001, manifest_files=False)
+    finally:
+        stop.set()
+        writer.join()
+    assert committed
+    conn = sqlite3.connect(os.path.join(backup_dir, manifest['snapshot']))
+    assert conn.execute('PRAGMA quick_check').fetchone()[0] == 'ok'
+    assert conn.execute('SELECT COUNT(*) FROM votes').fetchone()[0] >= 20
+
+def test_admin_backup_endpoints(tmp_path, monkeypatch):
+    monkeypatch.setitem(app.config, 'ADMIN_TOKEN', 'secret')
+    headers = {'Authorization': 'Bearer secret'}
+    db_fd, app.config['DATABASE'] = tempfile.mkstemp()
+    app.config['UPLOAD_FOLDER'] = str(tmp_path / 'uploads')
+    app.config['BACKUP_DIR'] = str(tmp_path / 'backups')
+    app.config['TESTING'] = True
+    try:
+        with app.app_context():
+            create_tables()
+        client = app.test_client()
+        assert client.post('/admin/backups').status_code == 403
+        rv = client.post('/admin/backups', headers=headers)
+        assert rv.status_code == 201
+        name = rv.get_json()['snapshot']
+        assert [entry['snapshot'] for entry in client.get('/admin/backups', headers=headers).get_json()] == [name]
+        rv = client.get(f'/admin/backups/{name}', headers=headers)
+        assert rv.status_code == 200 and rv.data.startswith(b'SQLite format 3')
+        rv.close()
+
+        with backup._backup_lock:
+            assert client.post('/admin/backups', headers=headers).status_code == 409
+    finally:
+        app.config.pop('BACKUP_DIR')
+        os.close(db_fd)
+        os.unlink(app.config['DATABASE'])
+
+def test_scheduler_survives_failed_backups():
+    calls = []
+
+    def flaky_backup():
+        calls.append(1)
+        if len(calls) == 1:
+            raise ValueError('unexpected')
+
+    scheduler = backup.BackupScheduler(flaky_backup, 0.01)
+    scheduler.start()
+    try:
+        deadline = time.time() + 5
+        while len(calls) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+    finally:
+        scheduler.stop(timeout=5)
+    assert len(calls) >= 2
@@ -0,0 +1,83 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import json
+import sqlite3
+import pytest
+from benchmarks.generator import generate_catalog
+from benchmarks.suite import compare_results, run_suite, summarize
+from benchmarks.__main__ import main
+
+
+def test_generate_catalog_counts(tmp_path):
+    database_path = str(tmp_path / 'catalog.db')
+    upload_folder = str(tmp_path / 'uploads')
+    summary = generate_catalog(database_path, documents=20, versions_per_document=3, html_per_version=2,
+                               metadata_keys=4, metadata_cardinality=5, votes=50,
+                               upload_folder=upload_folder, write_files=True)
+    assert summary['versions'] == 60
+    assert summary['html_documents'] == 120
+
+    conn = sqlite3.connect(database_path)
+    assert conn.execute('SELECT COUNT(*) FROM documents').fetchone()[0] == 20
+    assert conn.execute('SELECT COUNT(*) FROM versions').fetchone()[0] == 60
+    assert conn.execute('SELECT COUNT(*) FROM html_documents').fetchone()[0] == 120
+    assert conn.execute('SELECT COUNT(*) FROM votes').fetchone()[0] == 50
+    assert conn.execute('SELECT MAX(latest_version) FROM documents').fetchone()[0] == 3
+    # name, author, year, status plus field_0..field_3
+    assert conn.execute('SELECT COUNT(*) FROM metadata_keys').fetchone()[0] == 8
+    distinct = conn.execute("SELECT COUNT(DISTINCT json_extract(metadata, '$.field_0')) FROM documents").fetchone()[0]
+    assert distinct <= 5
+    file_path = conn.execute('SELECT file_path FROM versions LIMIT 1').fetchone()[0]
+    conn.close()
+    assert os.path.exists(file_path)
+    assert len(os.listdir(upload_folder)) == 180
+
+def test_generate_catalog_is_deterministic(tmp_path):
+    dumps = []
+    for name in ('a.db', 'b.db'):
+        path = str(tmp_path / name)
+        generate_catalog(path, documents=10, metadata_keys=2, votes=5, seed=7)
+        conn = sqlite3.connect(path)
+        dumps.append(conn.execute('SELECT metadata FROM documents ORDER BY id').fetchall())
+        conn.close()
+    assert dumps[0] == dumps[1]
+
+def test_summarize():
+    stats = summarize([0.1, 0.2, 0.3, 0.4])
+    assert stats['min'] == 0.1
+    assert stats['max'] == 0.4
+    assert stats['mean'] == pytest.approx(0.25)
+    assert stats['median'] == pytest.approx(0.25)
+    assert stats['ops'] == pytest.approx(4.0)
+    assert stats['rounds'] == 4
+    assert summarize([0.5])['stddev'] == 0.0
+
+def test_run_suite_produces_json_results():
+    results = run_suite(rounds=2, warmup=1, documents=30, versions_per_document=2, votes=10)
+    assert [b['name'] for b in results['benchmarks']] == [
+        'list_documents', 'filter_documents', 'search', 'vote',
+        'upload_new_document', 'upload_new_version', 'delete_version',
+    ]
+    assert all(b['stats']['rounds'] == 2 for b in results['benchmarks'])
+    assert results['catalog']['documents'] == 30
+    json.dumps(results)
+
+def test_run_suite_rejects_unknown_scenario():
+    with pytest.raises(ValueError):
+        run_suite(scenarios=['nope'], documents=1)
+
+def test_compare_results_flags_regressions(tmp_path):
+    def result(list_median, vote_median):
+        return {'benchmarks': [
+            {'name': 'list_documents', 'stats': {'median': list_median}},
+            {'name': 'vote', 'stats': {'median': vote_median}},
+        ]}
+    rows = compare_results(result(1.0, 1.0), result(1.05, 1.5), threshold=0.1)
+    assert [(r['name'], r['regression']) for r in rows] == [('list_documents', False), ('vote', True)]
+
+    baseline, current = tmp_path / 'baseline.json', tmp_path / 'current.json'
+    baseline.write_text(json.dumps(result(1.0, 1.0)))
+    current.write_text(json.dumps(result(1.05, 1.5)))
+    assert main(['compare', str(baseline), str(current)]) == 1
+    assert main(['compare', str(baseline), str(current), '--threshold', '0.6']) == 0
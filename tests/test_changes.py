@@ -0,0 +1,97 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import io
+import json
+import shutil
+import tempfile
+import pytest
+from app import app
+from database import create_tables
+
+
+@pytest.fixture
+def client():
+    db_fd, app.config['DATABASE'] = tempfile.mkstemp()
+    upload_dir = tempfile.mkdtemp()
+    app.config['UPLOAD_FOLDER'] = upload_dir
+    app.config['TESTING'] = True
+    with app.app_context():
+        create_tables()
+    yield app.test_client()
+    os.close(db_fd)
+    os.unlink(app.config['DATABASE'])
+    shutil.rmtree(upload_dir)
+
+def upload(client, doc_id, metadata):
+    rv = client.post('/upload', content_type='multipart/form-data', data={
+        'doc_id': doc_id,
+        'metadata': json.dumps(metadata),
+        'change_description': 'change',
+        'file': (io.BytesIO(b"%PDF-1.4\n%%EOF\n"), 'test.pdf'),
+    })
+    assert rv.status_code == 200
+
+def change_summary(changes):
+    return [(c['doc_id'], c['change_type'], c['version']) for c in changes]
+
+def test_changes_follow_uploads_and_deletes(client):
+    upload(client, 'a', {'name': 'A'})
+    upload(client, 'a', {'name': 'A'})  # same metadata: no metadata_updated
+    upload(client, 'a', {'year': 2024})
+    upload(client, 'b', {'name': 'B'})
+    client.delete('/documents/a/versions/3')
+    client.delete('/documents/b')
+
+    body = client.get('/changes').get_json()
+    assert change_summary(body['changes']) == [
+        ('a', 'document_created', None),
+        ('a', 'version_added', 1),
+        ('a', 'version_added', 2),
+        ('a', 'metadata_updated', None),
+        ('a', 'version_added', 3),
+        ('b', 'document_created', None),
+        ('b', 'version_added', 1),
+        ('a', 'version_deleted', 3),
+        ('b', 'document_deleted', None),
+    ]
+    assert [c['seq'] for c in body['changes']] == list(range(1, 10))
+    assert body['next_since'] == 9 and body['has_more'] is False
+
+def test_changes_paginate_with_since_and_limit(client):
+    for doc_id in ('a', 'b', 'c'):
+        upload(client, doc_id, {'name': doc_id})
+    page = client.get('/changes?since=0&limit=4').get_json()
+    assert len(page['changes']) == 4 and page['has_more'] is True
+    rest = client.get(f"/changes?since={page['next_since']}&limit=4").get_json()
+    assert [c['seq'] for c in rest['changes']] == [5, 6]
+    assert rest['has_more'] is False
+    assert client.get('/changes?since=6').get_json() == {'changes': [], 'next_since': 6, 'has_more': False}
+    assert client.get('/changes?limit=0').status_code == 400
+
+def test_documents_listing_reports_change_sequence(client):
+    assert client.get('/documents').headers['X-Catalog-Seq'] == '0'
+    upload(client, 'a', {'name': 'A'})
+    assert client.get('/documents').headers['X-Catalog-Seq'] == '2'
+
+def test_get_single_document(client):
+    upload(client, 'a', {'name': 'A'})
+    doc = client.get('/documents/a').get_json()
+    assert doc['doc_id'] == 'a' and doc['latest_version'] == 1
+    assert len(doc['versions']) == 1
+    assert client.get('/documents/missing').status_code == 404
+
+def test_change_stream_sends_events_after_last_event_id(client):
+    upload(client, 'a', {'name': 'A'})
+    upload(client, 'a', {'name': 'A2'})
+    app.config['CHANGE_STREAM_MAX_SECONDS'] = 0
+    try:
+        rv = client.get('/changes/stream', headers={'Last-Event-ID': '2'})
+        body = rv.get_data(as_text=True)
+    finally:
+        app.config.pop('CHANGE_STREAM_MAX_SECONDS')
+    assert rv.mimetype == 'text/event-stream'
+    events = [block for block in body.split('\n\n') if block.startswith('id:')]
+    assert [event.splitlines()[0] for event in events] == ['id: 3', 'id: 4']
+    data = json.loads(events[0].splitlines()[2][len('data: '):])
+    assert (data['doc_id'], data['change_type']) == ('a', 'metadata_updated')
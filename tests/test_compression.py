@@ -0,0 +1,106 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import gzip
+import io
+import json
+import shutil
+import tempfile
+import threading
+import zlib
+import pytest
+from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+from werkzeug.serving import make_server
+from werkzeug.test import encode_multipart
+import upload_client
+from app import app
+from compression import DecompressingStream
+from database import create_tables, get_db_connection
+
+PDF = b'%PDF-1.4\nbody\n%%EOF\n'
+HTML = b'<html><body>' + b'<p>repeated paragraph</p>' * 2000 + b'</body></html>'
+
+
+@pytest.fixture
+def client(monkeypatch):
+    db_fd, database = tempfile.mkstemp()
+    upload_dir = tempfile.mkdtemp()
+    monkeypatch.setitem(app.config, 'DATABASE', database)
+    monkeypatch.setitem(app.config, 'UPLOAD_FOLDER', upload_dir)
+    monkeypatch.setitem(app.config, 'TESTING', True)
+    with app.app_context():
+        create_tables()
+    yield app.test_client()
+    os.close(db_fd)
+    os.unlink(database)
+    shutil.rmtree(upload_dir)
+
+def stored_files():
+    with app.app_context():
+        conn = get_db_connection()
+        paths = [row[0] for row in conn.execute('SELECT file_path FROM versions UNION ALL SELECT file_path FROM html_documents')]
+    contents = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            contents.append(f.read())
+    return contents
+
+def post_gzipped(client, body, boundary):
+    return client.post('/upload', data=gzip.compress(body), headers={'Content-Encoding': 'gzip'},
+                       content_type=f'multipart/form-data; boundary={boundary}')
+
+def multipart():
+    return encode_multipart({
+        'doc_id': 'doc', 'metadata': json.dumps({'name': 'Doc'}),
+        'file': FileStorage(io.BytesIO(PDF), 'doc.pdf'), 'html_files': FileStorage(io.BytesIO(HTML), 'doc.html'),
+    })
+
+def test_gzipped_request_body_is_decoded(client):
+    boundary, body = multipart()
+    rv = post_gzipped(client, body, boundary)
+    assert rv.status_code == 200
+    assert stored_files() == [PDF, HTML]
+
+def test_decompressed_size_is_capped(client, monkeypatch):
+    monkeypatch.setitem(app.config, 'MAX_DECOMPRESSED_BODY_SIZE', 10000)
+    boundary, body = multipart()
+    assert post_gzipped(client, body, boundary).status_code == 413
+    assert stored_files() == []
+
+def test_bad_encodings_are_rejected(client):
+    boundary, body = multipart()
+    rv = client.post('/upload', data=body, headers={'Content-Encoding': 'br'},
+                     content_type=f'multipart/form-data; boundary={boundary}')
+    assert rv.status_code == 415
+    rv = client.post('/upload', data=gzip.compress(body)[:-20], headers={'Content-Encoding': 'gzip'},
+                     content_type=f'multipart/form-data; boundary={boundary}')
+    assert rv.status_code == 400
+
+def test_decompressing_stream_bounds_reads():
+    bomb = gzip.compress(b'\0' * 1000000)
+    stream = DecompressingStream(io.BytesIO(bomb), 'gzip', limit=None)
+    assert len(stream.read(4096)) <= 4096
+    assert len(stream.read()) == 1000000 - 4096
+    with pytest.raises(RequestEntityTooLarge):
+        DecompressingStream(io.BytesIO(bomb), 'gzip', limit=100000).read()
+    with pytest.raises(BadRequest):
+        DecompressingStream(io.BytesIO(b'not gzip at all'), 'gzip').read()
+    assert DecompressingStream(io.BytesIO(zlib.compress(HTML)), 'deflate').read() == HTML
+
+@pytest.mark.parametrize('compress', ['html', 'body'])
+def test_client_compression(client, tmp_path, compress):
+    for name, content in (('doc.pdf', PDF), ('doc.html', HTML)):
+        (tmp_path / name).write_bytes(content)
+    (tmp_path / 'metadata.json').write_text(json.dumps({'doc_id': 'doc'}))
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        assert upload_client.upload_document(str(tmp_path / 'doc.pdf'), str(tmp_path / 'metadata.json'),
+                                             [str(tmp_path / 'doc.html')], f'http://127.0.0.1:{server.server_port}',
+                                             compress=compress)
+    finally:
+        server.shutdown()
+        thread.join()
+    assert stored_files() == [PDF, HTML]
@@ -0,0 +1,84 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import io
+import json
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from app import app
+from database import DatabaseBusyError, allocate_version, begin_immediate, create_tables, get_db_connection
+
+UPLOADS = 200
+
+
+@pytest.fixture
+def client():
+    db_fd, app.config['DATABASE'] = tempfile.mkstemp()
+    upload_dir = tempfile.mkdtemp()
+    app.config['UPLOAD_FOLDER'] = upload_dir
+    app.config['TESTING'] = True
+    with app.app_context():
+        create_tables()
+    yield app.test_client()
+    os.close(db_fd)
+    os.unlink(app.config['DATABASE'])
+    shutil.rmtree(upload_dir)
+
+def test_parallel_uploads_get_unique_gap_free_versions(client, monkeypatch):
+    # Admit every upload at once so they all contend for the database
+    monkeypatch.setitem(app.config, 'UPLOAD_MAX_CONCURRENT', UPLOADS)
+    start = threading.Barrier(UPLOADS)
+
+    def upload(i):
+        start.wait()
+        rv = app.test_client().post('/upload', content_type='multipart/form-data', data={
+            'doc_id': 'contended',
+            'metadata': json.dumps({'name': 'contended', f'key_{i % 5}': i}),
+            'change_description': f'upload {i}',
+            'file': (io.BytesIO(b"%PDF-1.4\n%%EOF\n"), 'test.pdf'),
+        })
+        return rv.status_code
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=UPLOADS) as pool:
+        statuses = list(pool.map(upload, range(UPLOADS)))
+    elapsed = time.perf_counter() - started
+    assert statuses == [200] * UPLOADS
+    assert UPLOADS / elapsed > 10  # uploads per second
+
+    with app.app_context():
+        conn = get_db_connection()
+        versions = [row[0] for row in conn.execute(
+            'SELECT version FROM versions JOIN documents ON documents.id = versions.document_id '
+            "WHERE doc_id = 'contended' ORDER BY version")]
+        assert versions == list(range(1, UPLOADS + 1))
+        assert conn.execute("SELECT latest_version FROM documents WHERE doc_id = 'contended'").fetchone()[0] == UPLOADS
+        assert conn.execute('SELECT COUNT(*) FROM documents').fetchone()[0] == 1
+        keys = {row[0]: row[1] for row in conn.execute('SELECT key, doc_count FROM metadata_keys')}
+        assert keys == {'name': 1, 'key_0': 1, 'key_1': 1, 'key_2': 1, 'key_3': 1, 'key_4': 1}
+
+def test_allocate_version_upserts_document(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / 'test.db'))
+    create_tables(conn)
+    cursor = conn.cursor()
+    assert allocate_version(cursor, 'doc', {'a': 1})[1:] == (1, None)
+    assert allocate_version(cursor, 'doc', {'b': 2})[1:] == (2, {'a': 1})
+    with pytest.raises(sqlite3.IntegrityError):
+        conn.execute('INSERT INTO versions (document_id, version, file_path) VALUES (1, 1, ?), (1, 1, ?)', ('a', 'b'))
+
+def test_begin_immediate_gives_up_while_locked(tmp_path):
+    path = str(tmp_path / 'test.db')
+    holder = sqlite3.connect(path)
+    create_tables(holder)
+    holder.execute('BEGIN IMMEDIATE')
+    waiter = sqlite3.connect(path, timeout=0)
+    with pytest.raises(DatabaseBusyError):
+        begin_immediate(waiter, retries=2, backoff=0.001)
+    holder.rollback()
+    begin_immediate(waiter)
+    assert waiter.in_transaction
@@ -3,8 +3,10 @@ import tempfile
 import pytest
 from flask import Flask
 from app import app
-from database import get_db_connection, create_tables, close_db, init_app, delete_document_version, insert_vote, get_vote_counts, get_all_individual_votes
+from database import get_db_connection, create_tables, close_db, init_app, delete_document_version, insert_vote, get_vote_counts, get_all_individual_votes, get_metadata_keys, update_metadata_keys, rebuild_metadata_keys, query_documents_json, compile_metadata_query, slow_query_log, fingerprint_sql
+from reaper import reap_tombstones
 import json
+import re
 from unittest.mock import patch, MagicMock
 
 @pytest.fixture
@@ -127,6 +129,10 @@ def test_delete_document_version_specific_version(mock_exists, mock_remove, popu
         cursor.execute('SELECT * FROM html_documents WHERE file_path = ?', ('uploads/doc1_v1.html',))
         assert cursor.fetchone() is None
 
+        # Files are only unlinked by the reaper, after the delete has committed
+        mock_remove.assert_not_called()
+        assert reap_tombstones(conn) == (2, 0)
+
         # Verify os.remove was called for the PDF and HTML file
         mock_remove.assert_any_call('uploads/doc1_v1.pdf')
         mock_remove.assert_any_call('uploads/doc1_v1.html')
@@ -161,6 +167,10 @@ def test_delete_document_version_only_version(mock_exists, mock_remove, populate
         cursor.execute('SELECT * FROM documents WHERE doc_id = ?', ('doc2',))
         assert cursor.fetchone() is None
 
+        # Files are only unlinked by the reaper, after the delete has committed
+        mock_remove.assert_not_called()
+        assert reap_tombstones(conn) == (2, 0)
+
         # Verify os.remove was called for the PDF and HTML file
         mock_remove.assert_any_call('uploads/doc2_v1.pdf')
         mock_remove.assert_any_call('uploads/doc2_v1.html')
@@ -272,15 +282,18 @@ def test_delete_document_cascades_votes(mock_exists, mock_remove, populated_data
         remaining_votes = cursor.fetchone()[0]
         assert remaining_votes == 0
 
-@patch('os.remove')
-@patch('os.path.exists', return_value=False) # Files do not exist
-def test_delete_document_version_files_not_exist(mock_exists, mock_remove, populated_database):
+@patch('os.remove', side_effect=FileNotFoundError) # Files do not exist
+def test_delete_document_version_files_not_exist(mock_remove, populated_database):
     with app.app_context():
         # Delete version 1 of doc1
         success, message = delete_document_version('doc1', 1)
         assert success is True
         assert "Version deleted successfully." in message
-        mock_remove.assert_not_called() # os.remove should not be called if files don't exist
+
+        # Missing files are treated as already removed
+        conn = get_db_connection()
+        assert reap_tombstones(conn) == (2, 0)
+        assert conn.execute('SELECT COUNT(*) FROM file_tombstones').fetchone()[0] == 0
 
 @patch('database.get_db_connection')
 def test_insert_vote_exception_handling(mock_get_db_connection, populated_database):
@@ -350,6 +363,146 @@ def test_delete_document_version_deletes_document_if_no_versions_remain(mock_exi
         cursor.execute('SELECT * FROM documents WHERE doc_id = ?', ('doc2',))
         assert cursor.fetchone() is None
 
+        # Files are only unlinked by the reaper, after the delete has committed
+        mock_remove.assert_not_called()
+        assert reap_tombstones(conn) == (2, 0)
+
         # Verify os.remove was called for the PDF and HTML file
         mock_remove.assert_any_call('uploads/doc2_v1.pdf')
         mock_remove.assert_any_call('uploads/doc2_v1.html')
+
+def test_update_metadata_keys_tracks_counts_and_types(database_client):
+    with app.app_context():
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        update_metadata_keys(cursor, {}, {'author': 'a', 'year': 2023})
+        update_metadata_keys(cursor, {}, {'author': 'b', 'year': 2023.5})
+        update_metadata_keys(cursor, {'author': 'b'}, {'author': 'c', 'status': 'draft'})
+        conn.commit()
+
+        catalog = {k['key']: k for k in get_metadata_keys()}
+        assert catalog['author']['doc_count'] == 2
+        assert catalog['year']['value_type'] == 'real'
+        assert catalog['status']['doc_count'] == 1
+
+        update_metadata_keys(cursor, {'author': 'c', 'status': 'draft'}, {})
+        conn.commit()
+        catalog = {k['key']: k for k in get_metadata_keys()}
+        assert catalog['author']['doc_count'] == 1
+        assert 'status' not in catalog
+
+def test_rebuild_metadata_keys_creates_expression_indexes(database_client):
+    with app.app_context():
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.executemany('INSERT INTO documents (doc_id, metadata) VALUES (?, ?)',
+                           [(f'doc{i}', json.dumps({'author': f'a{i % 3}', 'flag': True})) for i in range(5)])
+        conn.commit()
+
+        rebuild_metadata_keys(conn, index_min_docs=5)
+        catalog = {k['key']: k for k in get_metadata_keys()}
+        assert catalog['author']['doc_count'] == 5
+        assert catalog['author']['indexed'] is True
+        assert catalog['flag']['value_type'] == 'boolean'
+
+        cursor.execute("EXPLAIN QUERY PLAN SELECT * FROM documents WHERE json_extract(metadata, '$.author') = ?", ('a1',))
+        plan = ' '.join(row['detail'] for row in cursor.fetchall())
+        assert 'idx_documents_meta_author' in plan
+
+        docs = [json.loads(d) for d in query_documents_json([('author', 'eq', 'a1')])]
+        assert [d['doc_id'] for d in docs] == ['doc4', 'doc1']
+        assert len(query_documents_json([('flag', 'eq', 'true')])) == 5
+        assert len(query_documents_json([('flag', 'eq', '0')])) == 0
+        with pytest.raises(ValueError):
+            query_documents_json([('flag', 'eq', 'yes')])
+
+def test_compile_metadata_query_rejects_invalid_input(database_client):
+    with app.app_context():
+        with pytest.raises(ValueError):
+            compile_metadata_query([("author') OR 1=1 --", 'eq', 'x')])
+        with pytest.raises(ValueError):
+            compile_metadata_query(sort='-bad key')
+        with pytest.raises(ValueError):
+            compile_metadata_query([('author', 'like', 'x')])
+
+def test_compile_metadata_query_binds_values(database_client):
+    with app.app_context():
+        where, order_by, params = compile_metadata_query(
+            [('year', 'gte', '2020'), ('status', 'in', ['draft', 'published'])], sort='-year,author')
+        assert where == ("json_extract(d.metadata, '$.year') >= ? AND "
+                         "json_extract(d.metadata, '$.status') IN (?, ?)")
+        assert order_by == ("json_extract(d.metadata, '$.year') DESC, "
+                            "json_extract(d.metadata, '$.author') ASC, d.id DESC")
+        assert params == ['2020', 'draft', 'published']
+
+def test_query_documents_json_embeds_versions(populated_database):
+    with app.app_context():
+        docs = [json.loads(d) for d in query_documents_json(file_consistent=lambda path: path.endswith('v2.pdf'))]
+        assert [d['doc_id'] for d in docs] == ['doc_vote', 'doc2', 'doc1']
+        doc1 = docs[2]
+        assert doc1['metadata'] == {}
+        assert [v['version'] for v in doc1['versions']] == [2, 1]
+        assert re.fullmatch(r'[A-Z][a-z]{2}, \d{2} [A-Z][a-z]{2} \d{4} \d{2}:\d{2}:\d{2} GMT', doc1['versions'][0]['created_at'])
+        assert doc1['versions'][0]['file_consistent'] is True
+        assert doc1['versions'][1]['file_consistent'] is False
+        assert doc1['versions'][0]['html_paths'] == [{'path': 'uploads/doc1_v2.html', 'consistent': False}]
+
+@pytest.fixture
+def log_all_queries(database_client, tmp_path):
+    app.config['SLOW_QUERY_THRESHOLD_MS'] = 0
+    slow_query_log.configure(str(tmp_path / 'slow_queries.log'))
+    slow_query_log.clear()
+    yield tmp_path / 'slow_queries.log'
+    app.config.pop('SLOW_QUERY_THRESHOLD_MS')
+    slow_query_log.configure(None)
+    slow_query_log.clear()
+
+def test_fingerprint_sql():
+    assert fingerprint_sql("SELECT *  FROM documents\n WHERE doc_id = 'a' AND id > 10") == \
+        'SELECT * FROM documents WHERE doc_id = ? AND id > ?'
+
+def test_slow_query_log_records_plan_and_parameter_shape(log_all_queries):
+    with app.app_context():
+        cursor = get_db_connection().cursor()
+        cursor.execute('SELECT id FROM documents WHERE doc_id = ?', ('doc1',))
+        cursor.fetchall()
+
+    entry = slow_query_log.top(1000)
+    lookup = next(e for e in entry if e['fingerprint'] == 'SELECT id FROM documents WHERE doc_id = ?')
+    assert lookup['parameter_shape'] == ['str']
+    assert any('sqlite_autoindex_documents_1' in line for line in lookup['plan'])
+    assert 'SELECT id FROM documents WHERE doc_id = ?' in log_all_queries.read_text()
+
+def test_core_queries_never_scan_whole_tables(populated_database, log_all_queries):
+    with app.app_context():
+        insert_vote('doc_vote', 1, 'good', '127.0.0.1')
+        query_documents_json()
+        with patch('os.remove'):
+            delete_document_version('doc1', 1)
+
+    plans = [(e['sql'], e['plan']) for e in slow_query_log.entries if e['plan']]
+    assert plans
+    for sql, plan in plans:
+        scans = [line for line in plan if line.startswith('SCAN')]
+        # Listing documents is driven by one pass over documents; every
+        # other lookup must go through an index.
+        if 'FROM documents d' in sql:
+            assert scans == ['SCAN d', 'SCAN (subquery-2)'], plan
+        else:
+            assert all('USING' in line and 'INDEX' in line for line in scans), (sql, plan)
+
+def test_create_tables_adds_file_columns_to_old_schema(database_client):
+    import sqlite3
+    conn = sqlite3.connect(app.config['DATABASE'])
+    conn.execute('DROP TABLE html_documents')
+    conn.execute('DROP TABLE votes')
+    conn.execute('DROP TABLE versions')
+    conn.execute('CREATE TABLE versions (id INTEGER PRIMARY KEY AUTOINCREMENT, document_id INTEGER NOT NULL, version INTEGER NOT NULL, change_description TEXT, file_path TEXT NOT NULL, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)')
+    conn.execute("INSERT INTO versions (document_id, version, file_path) VALUES (1, 1, 'uploads/old.pdf')")
+    conn.commit()
+    create_tables(conn)
+    create_tables(conn)
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(versions)')]
+    assert columns[6:] == ['file_size', 'checksum', 'tier', 'archive_path', 'access_count', 'last_accessed_at']
+    assert conn.execute('SELECT file_path, file_size, checksum, tier, access_count FROM versions').fetchall() == [('uploads/old.pdf', None, None, 'hot', 0)]
+    conn.close()
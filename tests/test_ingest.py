@@ -0,0 +1,138 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import io
+import json
+import shutil
+import tempfile
+import time
+import pytest
+import ingest
+from app import app
+from database import create_tables, get_db_connection
+from storage import LocalStorage
+
+
+@pytest.fixture
+def client():
+    db_fd, app.config['DATABASE'] = tempfile.mkstemp()
+    upload_dir = tempfile.mkdtemp()
+    app.config['UPLOAD_FOLDER'] = upload_dir
+    app.config['TESTING'] = True
+    with app.app_context():
+        create_tables()
+    yield app.test_client()
+    os.close(db_fd)
+    os.unlink(app.config['DATABASE'])
+    shutil.rmtree(upload_dir)
+
+def upload_data(doc_id='doc1', metadata=None):
+    return {
+        'doc_id': doc_id,
+        'metadata': json.dumps(metadata or {'name': doc_id}) if metadata != 'invalid' else '{not json',
+        'change_description': 'initial version',
+        'file': (io.BytesIO(b"%PDF-1.4\n%%EOF\n"), 'test.pdf'),
+        'html_files': [(io.BytesIO(b"<html></html>"), 'test.html')],
+    }
+
+def files_in(folder):
+    return sorted(os.path.relpath(os.path.join(root, name), folder)
+                  for root, _, names in os.walk(folder) for name in names)
+
+def test_upload_publishes_files_and_clears_journal(client):
+    assert client.post('/upload', content_type='multipart/form-data', data=upload_data()).status_code == 200
+    upload_dir = app.config['UPLOAD_FOLDER']
+    assert len(files_in(upload_dir)) == 2
+    assert not any(name.startswith(ingest.STAGING_DIR) for name in files_in(upload_dir))
+    with app.app_context():
+        conn = get_db_connection()
+        assert conn.execute('SELECT COUNT(*) FROM upload_journal').fetchone()[0] == 0
+        path = conn.execute('SELECT file_path FROM versions').fetchone()[0]
+    assert os.path.exists(path)
+
+def test_invalid_metadata_writes_no_files(client):
+    rv = client.post('/upload', content_type='multipart/form-data', data=upload_data(metadata='invalid'))
+    assert rv.status_code == 400
+    assert files_in(app.config['UPLOAD_FOLDER']) == []
+
+def test_database_error_discards_staged_files(client, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError('boom')
+    monkeypatch.setattr('app.update_metadata_keys', fail)
+    app.config['PROPAGATE_EXCEPTIONS'] = False
+    try:
+        rv = client.post('/upload', content_type='multipart/form-data', data=upload_data())
+    finally:
+        app.config['PROPAGATE_EXCEPTIONS'] = None
+    assert rv.status_code == 500
+    assert files_in(app.config['UPLOAD_FOLDER']) == []
+    with app.app_context():
+        assert get_db_connection().execute('SELECT COUNT(*) FROM documents').fetchone()[0] == 0
+
+def test_recovery_completes_committed_upload(client, monkeypatch):
+    client.get('/documents')  # run the startup recovery for this database first
+    monkeypatch.setattr(ingest, 'MOVE_RETRY_SECONDS', 0)
+    with monkeypatch.context() as m:
+        m.setattr(ingest.os, 'replace', lambda src, dst: (_ for _ in ()).throw(OSError('crash')))
+        # The rows are committed, so the upload succeeds
+        assert client.post('/upload', content_type='multipart/form-data', data=upload_data()).status_code == 200
+
+    upload_dir = app.config['UPLOAD_FOLDER']
+    with app.app_context():
+        conn = get_db_connection()
+        paths = [row[0] for row in conn.execute('SELECT file_path FROM versions UNION ALL SELECT file_path FROM html_documents')]
+        assert len(paths) == 2
+        assert not any(os.path.exists(p) for p in paths)
+        assert conn.execute('SELECT COUNT(*) FROM upload_journal').fetchone()[0] == 2
+
+        assert ingest.recover_uploads(conn, LocalStorage(upload_dir)) == (2, 0)
+        assert all(os.path.exists(p) for p in paths)
+        assert conn.execute('SELECT COUNT(*) FROM upload_journal').fetchone()[0] == 0
+    assert files_in(os.path.join(upload_dir, ingest.STAGING_DIR)) == []
+
+def test_next_request_replays_unpublished_uploads(client, monkeypatch):
+    client.get('/documents')
+    monkeypatch.setattr(ingest, 'MOVE_RETRY_SECONDS', 0)
+    moves = []
+
+    def flaky_replace(src, dst, replace=os.replace):
+        moves.append(src)
+        if len(moves) <= ingest.MOVE_ATTEMPTS:
+            raise OSError('disk hiccup')
+        replace(src, dst)
+
+    monkeypatch.setattr(ingest.os, 'replace', flaky_replace)
+    assert client.post('/upload', content_type='multipart/form-data', data=upload_data()).status_code == 200
+    with app.app_context():
+        conn = get_db_connection()
+        pdf_path = conn.execute('SELECT file_path FROM versions').fetchone()[0]
+        html_path = conn.execute('SELECT file_path FROM html_documents').fetchone()[0]
+        # The PDF gave up after MOVE_ATTEMPTS, the HTML file went through
+        assert not os.path.exists(pdf_path) and os.path.exists(html_path)
+        assert conn.execute('SELECT COUNT(*) FROM upload_journal').fetchone()[0] == 1
+
+    client.get('/documents')
+    assert os.path.exists(pdf_path)
+    with app.app_context():
+        assert get_db_connection().execute('SELECT COUNT(*) FROM upload_journal').fetchone()[0] == 0
+
+def test_recovery_discards_old_uncommitted_files(client):
+    staging = ingest.staging_folder(app.config['UPLOAD_FOLDER'])
+    os.makedirs(staging)
+    old, fresh = os.path.join(staging, 'old.pdf'), os.path.join(staging, 'fresh.pdf')
+    for path in (old, fresh):
+        with open(path, 'wb') as f:
+            f.write(b'%PDF')
+    past = time.time() - ingest.STAGING_GRACE_SECONDS - 10
+    os.utime(old, (past, past))
+    with app.app_context():
+        assert ingest.recover_uploads(get_db_connection(), LocalStorage(app.config['UPLOAD_FOLDER'])) == (0, 1)
+    assert not os.path.exists(old)
+    assert os.path.exists(fresh)
+
+def test_recovery_runs_once_before_first_request(client, monkeypatch):
+    calls = []
+    monkeypatch.setattr(ingest, 'recover_uploads', lambda conn, storage: calls.append(storage.root) or (0, 0))
+    client.get('/documents')
+    client.get('/documents')
+    assert calls == [app.config['UPLOAD_FOLDER']]
@@ -0,0 +1,132 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import hashlib
+import json
+import sqlite3
+import pytest
+import integrity
+from database import create_tables
+
+PDF = b'%PDF-1.4\nbody\n%%EOF\n'
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    uploads = tmp_path / 'uploads'
+    (uploads / 'ab').mkdir(parents=True)
+    conn = sqlite3.connect(str(tmp_path / 'test.db'))
+    create_tables(conn)
+
+    def add_file(name, content, size=None, checksum=None, on_disk=True, table='versions'):
+        path = uploads / name
+        if on_disk:
+            path.write_bytes(content)
+        stored = os.path.join('uploads', name)
+        if table == 'versions':
+            conn.execute('INSERT INTO versions (document_id, version, file_path, file_size, checksum) '
+                         'VALUES (1, (SELECT COUNT(*) + 1 FROM versions), ?, ?, ?)',
+                         (stored, size, checksum))
+        else:
+            conn.execute('INSERT INTO html_documents (version_id, file_path, file_size, checksum) VALUES (1, ?, ?, ?)',
+                         (stored, size, checksum))
+        conn.commit()
+
+    conn.execute("INSERT INTO documents (id, doc_id, metadata) VALUES (1, 'doc', '{}')")
+    add_file('good.pdf', PDF, len(PDF), hashlib.sha256(PDF).hexdigest())
+    add_file('ab/nested.html', b'<html></html>', 13, hashlib.sha256(b'<html></html>').hexdigest(), table='html')
+    add_file('truncated.pdf', PDF[:-7])
+    add_file('tampered.pdf', PDF.replace(b'body', b'evil'), len(PDF), hashlib.sha256(PDF).hexdigest())
+    add_file('resized.pdf', PDF, 999)
+    add_file('gone.pdf', PDF, on_disk=False)
+    (uploads / 'orphan.pdf').write_bytes(PDF)
+    (uploads / 'ab' / 'orphan.html').write_bytes(b'<html></html>')
+    (uploads / '.staging').mkdir()
+    (uploads / '.staging' / 'partial.pdf').write_bytes(b'%PDF')
+    yield conn, str(uploads), str(tmp_path)
+    conn.close()
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_scan_reports_missing_orphaned_and_corrupt(catalog, workers):
+    conn, uploads, base_dir = catalog
+    report = integrity.scan(conn, uploads, base_dir=base_dir, workers=workers)
+    assert report['complete']
+    assert report['missing'] == [os.path.join('uploads', 'gone.pdf')]
+    assert report['orphaned'] == [os.path.join('uploads', 'ab', 'orphan.html'), os.path.join('uploads', 'orphan.pdf')]
+    corrupt = {c['path']: c['problems'] for c in report['corrupt']}
+    assert corrupt == {
+        os.path.join('uploads', 'resized.pdf'): [f'size {len(PDF)} != recorded 999'],
+        os.path.join('uploads', 'tampered.pdf'): ['checksum mismatch'],
+        os.path.join('uploads', 'truncated.pdf'): ['missing %%EOF marker (truncated?)'],
+    }
+    assert report['files_on_disk'] == 7
+    assert report['verified'] == 5
+    # Only rows with a recorded checksum are hashed unless backfilling
+    assert report['hashed'] == 3
+
+def test_scan_without_hashes_skips_checksum(catalog):
+    conn, uploads, base_dir = catalog
+    report = integrity.scan(conn, uploads, base_dir=base_dir, workers=0, verify_hashes=False)
+    assert report['hashed'] == 0
+    assert os.path.join('uploads', 'tampered.pdf') not in {c['path'] for c in report['corrupt']}
+
+def test_backfill_records_missing_checksums(catalog):
+    conn, uploads, base_dir = catalog
+    integrity.scan(conn, uploads, base_dir=base_dir, workers=0, backfill=True)
+    row = conn.execute("SELECT file_size, checksum FROM versions WHERE file_path = ?",
+                       (os.path.join('uploads', 'truncated.pdf'),)).fetchone()
+    assert row == (None, None)  # corrupt files are not backfilled
+    row = conn.execute("SELECT file_size, checksum FROM versions WHERE file_path = ?",
+                       (os.path.join('uploads', 'resized.pdf'),)).fetchone()
+    assert row == (999, None)
+    conn.execute("INSERT INTO versions (document_id, version, file_path) VALUES (1, 100, ?)",
+                 (os.path.join('uploads', 'orphan.pdf'),))
+    integrity.scan(conn, uploads, base_dir=base_dir, workers=0, backfill=True)
+    row = conn.execute("SELECT file_size, checksum FROM versions WHERE version = 100").fetchone()
+    assert row == (len(PDF), hashlib.sha256(PDF).hexdigest())
+
+def test_checkpoint_resumes_interrupted_scan(catalog, tmp_path, monkeypatch):
+    conn, uploads, base_dir = catalog
+    checkpoint = str(tmp_path / 'scan.ckpt')
+    report = integrity.scan(conn, uploads, base_dir=base_dir, workers=0, checkpoint_path=checkpoint, max_seconds=-1)
+    assert not report['complete']
+    assert report['verified'] == 0
+
+    calls = []
+    real_verify = integrity.verify_file
+    monkeypatch.setattr(integrity, 'verify_file', lambda task: calls.append(task[0]) or real_verify(task))
+    with open(checkpoint, 'w') as f:
+        path = os.path.join(uploads, 'good.pdf')
+        stat = os.stat(path)
+        f.write(json.dumps({'path': path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                            'problems': [], 'checksum': 'x'}) + '\n')
+    report = integrity.scan(conn, uploads, base_dir=base_dir, workers=0, checkpoint_path=checkpoint)
+    assert report['complete']
+    assert report['verified'] == 5
+    assert os.path.join(uploads, 'good.pdf') not in calls
+    assert len(calls) == 4
+    assert not os.path.exists(checkpoint)
+
+def test_deadline_stops_the_walk(catalog, monkeypatch):
+    conn, uploads, base_dir = catalog
+    listed = []
+    real_walk = integrity.walk_files
+
+    def walk(root):
+        for entry in real_walk(root):
+            listed.append(entry[0])
+            yield entry
+
+    monkeypatch.setattr(integrity, 'walk_files', walk)
+    report = integrity.scan(conn, uploads, base_dir=base_dir, workers=0, max_seconds=-1)
+    assert not report['complete']
+    assert len(listed) == 1
+    assert report['files_on_disk'] == 0
+    assert report['missing'] == []
+
+def test_main_exit_status(catalog, capsys):
+    conn, uploads, base_dir = catalog
+    conn.commit()
+    database = os.path.join(base_dir, 'test.db')
+    assert integrity.main(['--database', database, '--uploads', uploads, '--base-dir', base_dir, '--workers', '0']) == 1
+    assert json.loads(capsys.readouterr().out)['missing'] == [os.path.join('uploads', 'gone.pdf')]
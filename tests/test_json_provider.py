@@ -0,0 +1,50 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import datetime
+import json
+import pytest
+from flask import Flask
+import json_provider
+from json_provider import FastJSONProvider, RawJSON
+
+ENCODERS = ['stdlib', pytest.param('orjson', marks=pytest.mark.skipif(json_provider.orjson is None, reason='orjson not installed'))]
+
+@pytest.fixture(params=ENCODERS)
+def json_app(request):
+    app = Flask(__name__)
+    app.json = FastJSONProvider(app)
+    app.json.use_orjson = request.param == 'orjson'
+    return app
+
+@pytest.fixture
+def provider(json_app):
+    return json_app.json
+
+def test_dumps_matches_stdlib_output(provider):
+    obj = {'b': 1, 'a': [True, None, 1.5, 'ü'], 'when': datetime.datetime(2024, 1, 2, 3, 4, 5)}
+    assert json.loads(provider.dumps(obj)) == {
+        'a': [True, None, 1.5, 'ü'],
+        'b': 1,
+        'when': 'Tue, 02 Jan 2024 03:04:05 GMT',
+    }
+
+def test_raw_json_list_is_spliced(provider):
+    body = provider.dumps([RawJSON('{"id":1}'), RawJSON('{"id":2}')])
+    assert body == '[{"id":1},{"id":2}]'
+
+def test_nested_raw_json_is_spliced(provider):
+    body = provider.dumps({'doc_id': 'doc1', 'metadata': RawJSON('{"author": "a", "tags": ["x"]}')})
+    assert json.loads(body) == {'doc_id': 'doc1', 'metadata': {'author': 'a', 'tags': ['x']}}
+
+def test_raw_json_marker_does_not_match_user_strings(provider):
+    body = provider.dumps({'text': '\x00raw:0\x00', 'raw': RawJSON('[1]')})
+    assert json.loads(body) == {'text': '\x00raw:0\x00', 'raw': [1]}
+
+def test_response_records_serialization_time(json_app):
+    import metrics
+    metrics.reset_counters()
+    with json_app.test_request_context('/'):
+        rv = json_app.json.response({'ok': True})
+    assert json.loads(rv.data) == {'ok': True}
+    assert metrics.get_timings()['serialization_seconds{route="unmatched"}']['count'] == 1
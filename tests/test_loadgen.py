@@ -0,0 +1,65 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import pytest
+from benchmarks.loadgen import DEFAULT_MIX, check_slos, local_server, main, parse_mix, percentile, run_load, summarize_samples
+
+
+def test_percentile_nearest_rank():
+    ordered = list(range(1, 101))
+    assert percentile(ordered, 0.50) == 50
+    assert percentile(ordered, 0.95) == 95
+    assert percentile(ordered, 0.99) == 99
+    assert percentile([7], 0.99) == 7
+    assert percentile([], 0.5) is None
+
+def test_parse_mix():
+    assert parse_mix('list_documents=80, vote=20') == {'list_documents': 80.0, 'vote': 20.0}
+    with pytest.raises(ValueError):
+        parse_mix('bogus=1')
+
+def test_default_mix_proportions():
+    total = sum(DEFAULT_MIX.values())
+    assert (DEFAULT_MIX['list_documents'] + DEFAULT_MIX['search']) / total == pytest.approx(0.80)
+    assert DEFAULT_MIX['vote'] / total == pytest.approx(0.15)
+    assert (DEFAULT_MIX['upload'] + DEFAULT_MIX['delete_version']) / total == pytest.approx(0.05)
+
+def test_check_slos():
+    results = {
+        'overall': {'throughput': 50.0},
+        'routes': {
+            'search': {'p95_ms': 20.0, 'p99_ms': 40.0, 'error_rate': 0.0},
+            'vote': {'p95_ms': 120.0, 'p99_ms': 300.0, 'error_rate': 0.1},
+        },
+    }
+    assert check_slos(results, p95_ms=200, p99_ms=500, max_error_rate=0.2, min_throughput=10) == []
+    violations = check_slos(results, p95_ms=100, max_error_rate=0.05, min_throughput=100)
+    assert len(violations) == 3
+    assert any(v.startswith('vote: p95') for v in violations)
+    assert any(v.startswith('vote: error rate') for v in violations)
+    assert any(v.startswith('overall: throughput') for v in violations)
+
+def test_noop_samples_are_reported_apart():
+    samples = [('vote', 0.010, True), ('vote', 0.030, False), ('vote:noop', 0.0001, True)]
+    results = summarize_samples(samples, elapsed=1.0, concurrency=1)
+    assert results['routes']['vote']['requests'] == 2
+    assert results['routes']['vote']['error_rate'] == 0.5
+    assert results['routes']['vote:noop']['requests'] == 1
+    assert results['overall']['requests'] == 2
+
+def test_run_load_against_local_server():
+    with local_server(documents=20, versions_per_document=2) as base_url:
+        results = run_load(base_url, mix={'list_documents': 2, 'search': 2, 'vote': 2, 'upload': 1, 'delete_version': 1},
+                           concurrency=4, total_requests=60)
+    noops = sum(route['requests'] for name, route in results['routes'].items() if name.endswith(':noop'))
+    assert results['overall']['requests'] + noops == 60
+    assert results['overall']['errors'] == 0
+    assert set(results['routes']) <= {'list_documents', 'search', 'vote', 'upload', 'delete_version',
+                                      'vote:noop', 'delete_version:noop'}
+    for route in results['routes'].values():
+        assert route['p50_ms'] <= route['p95_ms'] <= route['p99_ms']
+        assert route['throughput'] > 0
+
+def test_main_fails_when_slo_breached(capsys):
+    assert main(['--serve', '--documents', '10', '--requests', '20', '--slo-p95-ms', '0.001']) == 1
+    assert 'SLO violated' in capsys.readouterr().out
@@ -0,0 +1,49 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import pytest
+import metrics
+
+@pytest.fixture(autouse=True)
+def clean_metrics():
+    metrics.reset_counters()
+    yield
+    metrics.reset_counters()
+
+def test_counters_with_labels():
+    metrics.increment('search_requests')
+    metrics.increment('search_requests')
+    metrics.increment('requests_total', route='index', method='GET')
+    assert metrics.get_counters() == {
+        'search_requests': 2,
+        'requests_total{method="GET",route="index"}': 1,
+    }
+
+def test_histogram_timings_summary():
+    metrics.observe('request_duration_seconds', 0.002, route='index')
+    metrics.observe('request_duration_seconds', 0.004, route='index')
+    timing = metrics.get_timings()['request_duration_seconds{route="index"}']
+    assert timing['count'] == 2
+    assert timing['max_seconds'] == 0.004
+    assert timing['mean_seconds'] == pytest.approx(0.003)
+
+def test_render_prometheus():
+    metrics.increment('search_requests', 3)
+    metrics.observe('request_duration_seconds', 0.003, buckets=(0.001, 0.01), route='a"b')
+    metrics.observe('request_duration_seconds', 0.5, buckets=(0.001, 0.01), route='a"b')
+    lines = metrics.render_prometheus().splitlines()
+    assert '# TYPE pdf_browser_search_requests_total counter' in lines
+    assert 'pdf_browser_search_requests_total 3' in lines
+    assert '# TYPE pdf_browser_request_duration_seconds histogram' in lines
+    assert 'pdf_browser_request_duration_seconds_bucket{route="a\\"b",le="0.001"} 0' in lines
+    assert 'pdf_browser_request_duration_seconds_bucket{route="a\\"b",le="0.01"} 1' in lines
+    assert 'pdf_browser_request_duration_seconds_bucket{route="a\\"b",le="+Inf"} 2' in lines
+    assert 'pdf_browser_request_duration_seconds_count{route="a\\"b"} 2' in lines
+
+def test_gauges_keep_the_last_value():
+    metrics.set_gauge('upload_admission_queue_depth', 3)
+    metrics.set_gauge('upload_admission_queue_depth', 1)
+    assert metrics.get_gauges() == {'upload_admission_queue_depth': 1}
+    lines = metrics.render_prometheus().splitlines()
+    assert '# TYPE pdf_browser_upload_admission_queue_depth gauge' in lines
+    assert 'pdf_browser_upload_admission_queue_depth 1' in lines
@@ -0,0 +1,81 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import pytest
+import migrate_layout
+from app import app
+from benchmarks.generator import generate_catalog
+from database import create_tables, get_db_connection
+from reaper import reap_tombstones
+from storage import LocalStorage, shard_key
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    database_path = str(tmp_path / 'catalog.db')
+    upload_folder = str(tmp_path / 'uploads')
+    generate_catalog(database_path, documents=5, versions_per_document=2, html_per_version=1,
+                     upload_folder=upload_folder, write_files=True)
+    conn = get_db_connection(database_path)
+    yield conn, upload_folder
+    conn.close()
+
+def file_paths(conn):
+    return [row[0] for row in conn.execute('SELECT file_path FROM versions UNION ALL SELECT file_path FROM html_documents')]
+
+def test_migrate_moves_files_and_rows(catalog):
+    conn, upload_folder = catalog
+    assert migrate_layout.migrate(conn, LocalStorage(upload_folder), upload_folder, batch_size=3) == {'moved': 20, 'missing': 0}
+    paths = file_paths(conn)
+    assert len(paths) == 20
+    for path in paths:
+        name = os.path.basename(path)
+        assert path == os.path.join(upload_folder, *shard_key(name).split('/'))
+        assert os.path.exists(path)
+        assert not os.path.exists(os.path.join(upload_folder, name))
+    # Nothing left to do on a second run
+    assert migrate_layout.migrate(conn, LocalStorage(upload_folder), upload_folder) == {'moved': 0, 'missing': 0}
+
+def test_migrate_finishes_after_crash_between_move_and_commit(catalog):
+    conn, upload_folder = catalog
+    storage = LocalStorage(upload_folder)
+    # The file was moved but the row update never committed
+    path = file_paths(conn)[0]
+    name = os.path.basename(path)
+    storage.move(name, shard_key(name))
+
+    assert migrate_layout.migrate(conn, storage, upload_folder) == {'moved': 20, 'missing': 0}
+    assert all(os.path.exists(p) for p in file_paths(conn))
+
+def test_migrate_tombstones_file_of_row_deleted_during_move(catalog):
+    conn, upload_folder = catalog
+    storage = LocalStorage(upload_folder)
+    row_id, path = conn.execute('SELECT id, file_path FROM html_documents ORDER BY id LIMIT 1').fetchone()
+    conn.execute('DELETE FROM html_documents WHERE id = ?', (row_id,))
+    conn.commit()
+    assert migrate_layout.migrate_batch(conn, storage, upload_folder, 'html_documents', [(row_id, path)]) == (0, 0)
+    assert reap_tombstones(conn) == (1, 0)
+    assert not storage.exists(shard_key(os.path.basename(path)))
+
+def test_migrate_counts_missing_files(catalog):
+    conn, upload_folder = catalog
+    os.remove(file_paths(conn)[0])
+    assert migrate_layout.migrate(conn, LocalStorage(upload_folder), upload_folder) == {'moved': 19, 'missing': 1}
+
+def test_uploads_route_resolves_both_layouts(tmp_path, monkeypatch):
+    upload_folder = str(tmp_path / 'uploads')
+    storage = LocalStorage(upload_folder)
+    for key in ('flat.pdf', shard_key('sharded.pdf')):
+        with open(__file__, 'rb') as f:
+            storage.put_stream(key, f)
+    monkeypatch.setitem(app.config, 'UPLOAD_FOLDER', upload_folder)
+    monkeypatch.setitem(app.config, 'DATABASE', str(tmp_path / 'app.db'))
+    monkeypatch.setitem(app.config, 'TESTING', True)
+    with app.app_context():
+        create_tables()
+    client = app.test_client()
+    for url in ('/uploads/flat.pdf', '/uploads/sharded.pdf', '/uploads/' + shard_key('sharded.pdf')):
+        rv = client.get(url)
+        assert rv.status_code == 200
+        rv.close()
+    assert client.get('/uploads/missing.pdf').status_code == 404
@@ -0,0 +1,96 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import pstats
+import time
+from flask import Flask
+from profiling import ProfilingMiddleware, init_profiling, list_profiles
+from app import app as pdf_app
+
+
+def make_app(**config):
+    app = Flask(__name__)
+    app.config.update(config)
+
+    @app.route('/slow')
+    def slow():
+        time.sleep(0.01)
+        return 'done'
+
+    return app
+
+def test_disabled_profiling_does_not_wrap_app():
+    app = make_app()
+    assert init_profiling(app) is None
+    assert 'wsgi_app' not in vars(app)
+    assert 'profiling' not in app.extensions
+
+def test_header_triggers_pstats_profile(tmp_path):
+    app = make_app(PROFILING=True, PROFILE_DIR=str(tmp_path), PROFILE_TOKEN='secret')
+    assert isinstance(init_profiling(app), ProfilingMiddleware)
+    client = app.test_client()
+
+    assert client.get('/slow').data == b'done'
+    assert list_profiles(str(tmp_path)) == []
+
+    assert client.get('/slow', headers={'X-Profile': 'secret'}).data == b'done'
+    profiles = list_profiles(str(tmp_path))
+    assert len(profiles) == 1
+    assert profiles[0]['format'] == 'pstats'
+    assert '-GET-slow-' in profiles[0]['name']
+    stats = pstats.Stats(str(tmp_path / profiles[0]['name']))
+    assert any(func[2] == 'slow' for func in stats.stats)
+
+def test_header_is_ignored_without_a_token(tmp_path):
+    app = make_app(PROFILING=True, PROFILE_DIR=str(tmp_path))
+    init_profiling(app)
+    app.test_client().get('/slow', headers={'X-Profile': '1'})
+    assert list_profiles(str(tmp_path)) == []
+
+def test_token_is_required_when_configured(tmp_path):
+    app = make_app(PROFILING=True, PROFILE_DIR=str(tmp_path), PROFILE_TOKEN='secret')
+    init_profiling(app)
+    client = app.test_client()
+    client.get('/slow', headers={'X-Profile': 'wrong'})
+    assert list_profiles(str(tmp_path)) == []
+    client.get('/slow', headers={'X-Profile': 'secret'})
+    assert len(list_profiles(str(tmp_path))) == 1
+
+def test_sample_rate_profiles_every_request(tmp_path):
+    app = make_app(PROFILING=True, PROFILE_DIR=str(tmp_path), PROFILE_SAMPLE_RATE=1.0)
+    init_profiling(app)
+    client = app.test_client()
+    for _ in range(3):
+        client.get('/slow')
+    assert len(list_profiles(str(tmp_path))) == 3
+
+def test_oldest_profiles_are_evicted(tmp_path):
+    app = make_app(PROFILING=True, PROFILE_DIR=str(tmp_path), PROFILE_SAMPLE_RATE=1.0, PROFILE_MAX_FILES=2)
+    init_profiling(app)
+    client = app.test_client()
+    names = []
+    for _ in range(4):
+        client.get('/slow')
+        names.append(list_profiles(str(tmp_path))[0]['name'])
+        time.sleep(0.01)
+    assert [p['name'] for p in list_profiles(str(tmp_path))] == names[:1:-1]
+
+def test_admin_profiles_endpoint(tmp_path, monkeypatch):
+    monkeypatch.setitem(pdf_app.config, 'ADMIN_TOKEN', 'secret')
+    headers = {'X-Admin-Token': 'secret'}
+    (tmp_path / '1700000000000-GET-documents-12ms.prof').write_bytes(b'x' * 10)
+    (tmp_path / 'notes.txt').write_text('ignored')
+    pdf_app.config['PROFILE_DIR'] = str(tmp_path)
+    try:
+        client = pdf_app.test_client()
+        rv = client.get('/admin/profiles', headers=headers)
+        assert rv.status_code == 200
+        assert [(p['name'], p['size'], p['format']) for p in rv.get_json()] == [
+            ('1700000000000-GET-documents-12ms.prof', 10, 'pstats')
+        ]
+        rv = client.get('/admin/profiles/1700000000000-GET-documents-12ms.prof', headers=headers)
+        assert rv.status_code == 200
+        assert rv.data == b'x' * 10
+        assert client.get('/admin/profiles/missing.prof', headers=headers).status_code == 404
+    finally:
+        pdf_app.config.pop('PROFILE_DIR')
@@ -0,0 +1,168 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import tempfile
+import time
+from unittest.mock import patch
+import pytest
+from app import app
+from database import create_tables, delete_document, delete_document_version, get_db_connection, get_metadata_keys, tombstone_files
+from reaper import TombstoneReaper, main, reap_tombstones
+from storage import StorageBackend
+
+
+@pytest.fixture
+def database(tmp_path):
+    db_fd, app.config['DATABASE'] = tempfile.mkstemp()
+    app.config['TESTING'] = True
+    with app.app_context():
+        create_tables()
+        conn = get_db_connection()
+        conn.execute('''INSERT INTO documents (id, doc_id, metadata, latest_version) VALUES (1, 'doc1', '{"author": "a"}', 2)''')
+        for version in (1, 2):
+            pdf = tmp_path / f'doc1_v{version}.pdf'
+            html = tmp_path / f'doc1_v{version}.html'
+            pdf.write_bytes(b'%PDF')
+            html.write_bytes(b'<html></html>')
+            conn.execute('INSERT INTO versions (id, document_id, version, file_path) VALUES (?, 1, ?, ?)', (version, version, str(pdf)))
+            conn.execute('INSERT INTO html_documents (version_id, file_path) VALUES (?, ?)', (version, str(html)))
+        conn.commit()
+        yield conn
+    os.close(db_fd)
+    os.unlink(app.config['DATABASE'])
+
+class MemoryStorage(StorageBackend):
+    def __init__(self, deleted):
+        self.deleted = deleted
+
+    def delete(self, key):
+        self.deleted.append(key)
+        return True
+
+def tombstones(conn):
+    return [row[0] for row in conn.execute('SELECT file_path FROM file_tombstones ORDER BY id')]
+
+def test_delete_keeps_files_until_reaped(database, tmp_path):
+    assert delete_document_version('doc1', 1) == (True, "Version deleted successfully.")
+    assert (tmp_path / 'doc1_v1.pdf').exists()
+    assert tombstones(database) == [str(tmp_path / 'doc1_v1.pdf'), str(tmp_path / 'doc1_v1.html')]
+
+    assert reap_tombstones(database) == (2, 0)
+    assert not (tmp_path / 'doc1_v1.pdf').exists()
+    assert not (tmp_path / 'doc1_v1.html').exists()
+    assert (tmp_path / 'doc1_v2.pdf').exists()
+    assert tombstones(database) == []
+
+def test_failed_delete_leaves_files_and_no_tombstones(database, tmp_path):
+    with patch('database.update_metadata_keys', side_effect=RuntimeError('boom')):
+        success, message = delete_document('doc1')
+    assert success is False
+    assert tombstones(database) == []
+    assert database.execute('SELECT COUNT(*) FROM versions').fetchone()[0] == 2
+    assert (tmp_path / 'doc1_v1.pdf').exists()
+
+def test_failed_unlink_is_retried_with_backoff(database, tmp_path):
+    tombstone_files(database.cursor(), [str(tmp_path / 'doc1_v1.pdf'), str(tmp_path / 'doc1_v2.pdf')])
+    database.commit()
+    real_remove = os.remove
+
+    def flaky_remove(path):
+        if path.endswith('doc1_v1.pdf'):
+            raise PermissionError(13, 'Permission denied')
+        real_remove(path)
+
+    with patch('os.remove', side_effect=flaky_remove):
+        assert reap_tombstones(database, now=1000.0) == (1, 1)
+    row = database.execute('SELECT file_path, attempts, next_attempt_at, last_error FROM file_tombstones').fetchone()
+    assert row[0] == str(tmp_path / 'doc1_v1.pdf')
+    assert row[1:3] == (1, 1001.0)
+    assert 'Permission denied' in row[3]
+
+    # Not due yet
+    assert reap_tombstones(database, now=1000.5) == (0, 0)
+    assert reap_tombstones(database, now=1001.0) == (1, 0)
+    assert tombstones(database) == []
+
+def test_backend_errors_are_retried(database, tmp_path):
+    tombstone_files(database.cursor(), [str(tmp_path / 'doc1_v1.pdf'), str(tmp_path / 'doc1_v2.pdf')])
+    database.commit()
+
+    def remove(path):
+        if path.endswith('doc1_v1.pdf'):
+            raise ValueError('endpoint unreachable')
+        os.remove(path)
+
+    assert reap_tombstones(database, now=1000.0, remove=remove) == (1, 1)
+    assert [tuple(row) for row in database.execute('SELECT file_path, last_error FROM file_tombstones')] == [
+        (str(tmp_path / 'doc1_v1.pdf'), 'endpoint unreachable')
+    ]
+
+def test_background_reaper_survives_failed_passes(database, tmp_path):
+    delete_document('doc1')
+    passes = []
+
+    def database_path():
+        passes.append(1)
+        if len(passes) == 1:
+            raise RuntimeError('config unavailable')
+        return app.config['DATABASE']
+
+    reaper = TombstoneReaper(database_path, interval=0.01)
+    reaper.start()
+    try:
+        deadline = time.time() + 5
+        while (tmp_path / 'doc1_v2.pdf').exists() and time.time() < deadline:
+            time.sleep(0.01)
+    finally:
+        reaper.stop(timeout=5)
+    assert not (tmp_path / 'doc1_v2.pdf').exists()
+
+def test_reaper_processes_every_batch(database, tmp_path):
+    paths = [str(tmp_path / f'extra{i}.pdf') for i in range(7)]
+    tombstone_files(database.cursor(), paths)
+    database.commit()
+    assert reap_tombstones(database, batch_size=3) == (7, 0)
+    assert tombstones(database) == []
+
+def test_delete_document_removes_all_versions(database, tmp_path):
+    assert delete_document('doc1') == (True, "Document deleted successfully.")
+    assert database.execute('SELECT COUNT(*) FROM documents').fetchone()[0] == 0
+    assert database.execute('SELECT COUNT(*) FROM versions').fetchone()[0] == 0
+    assert database.execute('SELECT COUNT(*) FROM html_documents').fetchone()[0] == 0
+    assert len(tombstones(database)) == 4
+    assert get_metadata_keys() == []
+    assert delete_document('doc1') == (False, "Document not found.")
+
+def test_background_reaper_wakes_up(database, tmp_path):
+    delete_document('doc1')
+    reaper = TombstoneReaper(lambda: app.config['DATABASE'], interval=60)
+    reaper.start()
+    try:
+        reaper.wake()
+        deadline = time.time() + 5
+        while (tmp_path / 'doc1_v2.pdf').exists() and time.time() < deadline:
+            time.sleep(0.01)
+    finally:
+        reaper.stop(timeout=5)
+    assert not any(p.suffix == '.pdf' for p in tmp_path.iterdir())
+
+def test_main_removes_through_storage(database, tmp_path, monkeypatch, capsys):
+    stored = tmp_path / 'uploads' / 'ab' / 'cd' / 'x.pdf'
+    stored.parent.mkdir(parents=True)
+    stored.write_bytes(b'%PDF')
+    tombstone_files(database.cursor(), [os.path.join('uploads', 'ab', 'cd', 'x.pdf')])
+    database.commit()
+    # Stored paths are relative to --base-dir, not the working directory
+    monkeypatch.chdir(tempfile.gettempdir())
+    assert main(['--database', app.config['DATABASE'], '--uploads', 'uploads', '--base-dir', str(tmp_path)]) == 0
+    assert not stored.exists()
+    assert 'Removed 1 files' in capsys.readouterr().out
+
+    deleted = []
+    monkeypatch.setitem(app.config, 'STORAGE_BACKEND', MemoryStorage(deleted))
+    monkeypatch.setitem(app.config, 'UPLOAD_FOLDER', 'uploads')
+    tombstone_files(database.cursor(), [os.path.join('uploads', 'ef', 'gh', 'y.pdf')])
+    database.commit()
+    assert main(['--database', app.config['DATABASE']]) == 0
+    assert deleted == ['ef/gh/y.pdf']
+    assert tombstones(database) == []
@@ -0,0 +1,189 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import base64
+import hashlib
+import io
+import json
+import shutil
+import tempfile
+import threading
+import pytest
+import requests
+from werkzeug.serving import make_server
+import ingest
+import resumable
+import upload_client
+from app import app
+from database import create_tables, get_db_connection
+from storage import LocalStorage
+
+PDF = b'%PDF-1.4\n' + os.urandom(5000) + b'\n%%EOF\n'
+CHUNK = 1024
+
+
+@pytest.fixture
+def client():
+    db_fd, app.config['DATABASE'] = tempfile.mkstemp()
+    upload_dir = tempfile.mkdtemp()
+    app.config['UPLOAD_FOLDER'] = upload_dir
+    app.config['TESTING'] = True
+    with app.app_context():
+        create_tables()
+    yield app.test_client()
+    os.close(db_fd)
+    os.unlink(app.config['DATABASE'])
+    shutil.rmtree(upload_dir)
+
+def create(client, **fields):
+    body = {'doc_id': 'big', 'metadata': {'name': 'Big scan'}, 'filename': 'scan.pdf',
+            'size': len(PDF), 'chunk_size': CHUNK, **fields}
+    return client.post('/upload/sessions', json=body)
+
+def send(client, url, offset, data=None, checksum=True):
+    data = PDF[offset:offset + CHUNK] if data is None else data
+    headers = {'Upload-Offset': str(offset)}
+    if checksum:
+        headers['Upload-Checksum'] = 'sha256 ' + base64.b64encode(hashlib.sha256(data).digest()).decode()
+    return client.patch(url, data=data, headers=headers, content_type='application/offset+octet-stream')
+
+def stored_file(doc_id='big'):
+    with app.app_context():
+        path = get_db_connection().execute(
+            'SELECT v.file_path FROM versions v JOIN documents d ON d.id = v.document_id WHERE d.doc_id = ?', (doc_id,)
+        ).fetchone()[0]
+    with open(path, 'rb') as f:
+        return f.read()
+
+def test_chunks_out_of_order_then_finalize(client):
+    rv = create(client, checksum=hashlib.sha256(PDF).hexdigest())
+    assert rv.status_code == 201
+    url = rv.headers['Location']
+    offsets = list(range(0, len(PDF), CHUNK))
+
+    for offset in reversed(offsets[1:]):
+        assert send(client, url, offset).status_code == 204
+    rv = client.head(url)
+    assert rv.headers['Upload-Offset'] == '0' and rv.headers['Upload-Length'] == str(len(PDF))
+    rv = client.post(url + '/finalize')
+    assert rv.status_code == 409 and rv.get_json()['missing'] == [0]
+
+    rv = send(client, url, 0)
+    assert rv.status_code == 204 and rv.headers['Upload-Offset'] == str(len(PDF))
+    rv = client.post(url + '/finalize', content_type='multipart/form-data',
+                     data={'html_files': (io.BytesIO(b'<html></html>'), 'scan.html')})
+    assert rv.status_code == 200 and rv.get_json() == {'success': True, 'version': 1}
+    assert stored_file() == PDF
+    assert client.get(url).status_code == 404
+    assert client.get('/documents').get_json()[0]['metadata'] == {'name': 'Big scan'}
+    assert not os.listdir(os.path.join(app.config['UPLOAD_FOLDER'], resumable.SESSIONS_DIR, url.rsplit('/', 1)[1]))
+
+def test_bad_chunks_are_rejected(client):
+    url = create(client).headers['Location']
+    assert send(client, url, 100).status_code == 409
+    assert send(client, url, 0, PDF[:CHUNK - 1]).status_code == 400
+    rv = client.patch(url, data=PDF[:CHUNK], headers={'Upload-Offset': '0', 'Upload-Checksum': 'sha256 ' + base64.b64encode(b'x' * 32).decode()})
+    assert rv.status_code == 460
+    assert client.get(url).get_json()['received'] == []
+    assert client.patch('/upload/sessions/unknown', data=b'x', headers={'Upload-Offset': '0'}).status_code == 404
+    assert create(client, filename='scan.exe').status_code == 400
+    assert create(client, size=0).status_code == 400
+
+def test_file_checksum_mismatch_reopens_session(client):
+    url = create(client, checksum='0' * 64).headers['Location']
+    for offset in range(0, len(PDF), CHUNK):
+        send(client, url, offset, checksum=False)
+    assert client.post(url + '/finalize').status_code == 460
+    session = client.get(url).get_json()
+    assert session['status'] == 'open' and len(session['received']) == -(-len(PDF) // CHUNK)
+    with app.app_context():
+        assert get_db_connection().execute('SELECT COUNT(*) FROM versions').fetchone()[0] == 0
+
+def test_failed_finalize_reopens_session(client, monkeypatch):
+    url = create(client).headers['Location']
+    for offset in range(0, len(PDF), CHUNK):
+        send(client, url, offset)
+
+    def fail(error):
+        def read(self, size=resumable.READ_SIZE):
+            raise error
+        return read
+
+    monkeypatch.setattr(resumable.ChunkReader, 'read', fail(OSError(5, 'Input/output error')))
+    rv = client.post(url + '/finalize')
+    assert rv.status_code == 500 and 'error' in rv.get_json()
+    assert client.get(url).get_json()['status'] == 'open'
+
+    monkeypatch.setattr(resumable.ChunkReader, 'read', fail(RuntimeError('boom')))
+    with pytest.raises(RuntimeError):
+        client.post(url + '/finalize')
+    assert client.get(url).get_json()['status'] == 'open'
+
+    monkeypatch.undo()
+    assert client.post(url + '/finalize').status_code == 200
+    assert stored_file() == PDF
+
+def test_finalize_succeeds_once_committed(client, monkeypatch):
+    url = create(client).headers['Location']
+    for offset in range(0, len(PDF), CHUNK):
+        send(client, url, offset)
+    storage = LocalStorage(app.config['UPLOAD_FOLDER'])
+    monkeypatch.setattr(ingest, 'MOVE_RETRY_SECONDS', 0)
+    with monkeypatch.context() as m:
+        m.setattr(LocalStorage, 'move', lambda self, source, destination: (_ for _ in ()).throw(OSError('crash')))
+        assert client.post(url + '/finalize').status_code == 200
+    # The session rows were committed away, and so are the chunks
+    assert client.get(url).status_code == 404
+    assert list(storage.list(resumable.SESSIONS_DIR + '/')) == []
+    client.get('/documents')  # replays the journal
+    assert stored_file() == PDF
+
+def test_abandoned_sessions_expire(client):
+    url = create(client).headers['Location']
+    send(client, url, 0)
+    storage = LocalStorage(app.config['UPLOAD_FOLDER'])
+    with app.app_context():
+        conn = get_db_connection()
+        assert resumable.expire_sessions(conn, storage) == 0
+        assert resumable.expire_sessions(conn, storage, now=2 ** 40) == 1
+        assert conn.execute('SELECT COUNT(*) FROM upload_chunks').fetchone()[0] == 0
+    assert client.get(url).status_code == 404
+    assert list(storage.list(resumable.SESSIONS_DIR + '/')) == []
+
+@pytest.fixture
+def server(client):
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+    thread.join()
+
+def test_client_resumes_interrupted_upload(server, tmp_path, monkeypatch):
+    pdf_path = str(tmp_path / 'scan.pdf')
+    metadata_path = str(tmp_path / 'metadata.json')
+    with open(pdf_path, 'wb') as f:
+        f.write(PDF)
+    with open(metadata_path, 'w') as f:
+        json.dump({'doc_id': 'big', 'name': 'Big scan'}, f)
+
+    real_request = requests.request
+    patched = []
+
+    def flaky_request(method, url, **kwargs):
+        if method == 'patch':
+            patched.append(kwargs['headers']['Upload-Offset'])
+            if patched.count(str(3 * CHUNK)) == 1 and patched[-1] == str(3 * CHUNK):
+                raise requests.exceptions.ConnectionError('connection reset')
+        return real_request(method, url, **kwargs)
+
+    monkeypatch.setattr(upload_client.requests, 'request', flaky_request)
+    monkeypatch.setattr(upload_client, 'RETRY_BACKOFF_SECONDS', 0)
+    assert not upload_client.upload_document(pdf_path, metadata_path, base_url=server, chunk_size=CHUNK, retries=0)
+    assert os.path.exists(pdf_path + upload_client.RESUME_SUFFIX)
+
+    sent_before = len(patched)
+    assert upload_client.upload_document(pdf_path, metadata_path, base_url=server, chunk_size=CHUNK, parallel=3)
+    assert patched[sent_before:] == [str(3 * CHUNK)]
+    assert not os.path.exists(pdf_path + upload_client.RESUME_SUFFIX)
+    assert stored_file() == PDF
@@ -0,0 +1,93 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import shutil
+import socket
+import tempfile
+import threading
+import pytest
+import requests
+from werkzeug.serving import make_server
+from app import app
+from benchmarks.serving import run
+from database import create_tables
+from storage import shard_key
+
+PDF = b'%PDF-1.4\n' + bytes(range(256)) * 4000 + b'\n%%EOF\n'
+KEY = shard_key('report.pdf')
+
+
+@pytest.fixture
+def client(monkeypatch):
+    db_fd, database = tempfile.mkstemp()
+    upload_dir = tempfile.mkdtemp()
+    os.makedirs(os.path.join(upload_dir, os.path.dirname(KEY)))
+    with open(os.path.join(upload_dir, KEY), 'wb') as f:
+        f.write(PDF)
+    monkeypatch.setitem(app.config, 'DATABASE', database)
+    monkeypatch.setitem(app.config, 'UPLOAD_FOLDER', upload_dir)
+    monkeypatch.setitem(app.config, 'TESTING', True)
+    monkeypatch.setitem(app.config, 'SERVE_MODE', 'sendfile')
+    with app.app_context():
+        create_tables()
+    yield app.test_client()
+    os.close(db_fd)
+    os.unlink(database)
+    shutil.rmtree(upload_dir)
+
+def test_sendfile_mode_serves_whole_files_and_ranges(client):
+    rv = client.get('/uploads/report.pdf')
+    assert rv.status_code == 200 and rv.data == PDF
+    assert rv.headers['Accept-Ranges'] == 'bytes' and rv.mimetype == 'application/pdf'
+
+    rv = client.get('/uploads/report.pdf', headers={'Range': 'bytes=100-199'})
+    assert rv.status_code == 206 and rv.data == PDF[100:200]
+    assert rv.headers['Content-Range'] == f'bytes 100-199/{len(PDF)}'
+    assert client.get('/uploads/report.pdf', headers={'Range': f'bytes={len(PDF) + 10}-'}).status_code == 416
+
+    etag = client.get('/uploads/report.pdf').headers['ETag']
+    assert client.get('/uploads/report.pdf', headers={'If-None-Match': etag}).status_code == 304
+    rv = client.get('/uploads/report.pdf', headers={'Range': 'bytes=0-9', 'If-Range': '"stale"'})
+    assert rv.status_code == 200 and rv.data == PDF
+    assert client.get('/uploads/missing.pdf').status_code == 404
+
+def test_sendfile_mode_uses_socket_sendfile_under_development_server(client, monkeypatch):
+    calls = []
+    real_sendfile = socket.socket.sendfile
+
+    def spy(self, file, offset=0, count=None):
+        calls.append((offset, count))
+        return real_sendfile(self, file, offset, count)
+
+    monkeypatch.setattr(socket.socket, 'sendfile', spy)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        url = f'http://127.0.0.1:{server.server_port}/uploads/report.pdf'
+        assert requests.get(url).content == PDF
+        rv = requests.get(url, headers={'Range': 'bytes=1000-'})
+        assert rv.status_code == 206 and rv.content == PDF[1000:]
+    finally:
+        server.shutdown()
+        thread.join()
+    assert calls == [(0, len(PDF)), (1000, len(PDF) - 1000)]
+
+@pytest.mark.parametrize('mode', ['x-accel', 'x-sendfile'])
+def test_offload_modes_only_send_headers(client, monkeypatch, mode):
+    monkeypatch.setitem(app.config, 'SERVE_MODE', mode)
+    rv = client.get('/uploads/report.pdf')
+    assert rv.status_code == 200 and rv.data == b''
+    assert rv.mimetype == 'application/pdf'
+    if mode == 'x-accel':
+        assert rv.headers['X-Accel-Redirect'] == f'/protected-uploads/{KEY}'
+        assert 'X-Sendfile' not in rv.headers
+    else:
+        assert rv.headers['X-Sendfile'] == os.path.abspath(os.path.join(app.config['UPLOAD_FOLDER'], KEY))
+
+def test_serving_benchmark_reports_cpu_per_gb():
+    results = run(modes=['sendfile', 'x-accel'], size_mb=1, requests_count=2, concurrency=2)
+    assert [r['mode'] for r in results] == ['sendfile', 'x-accel']
+    assert all(r['bytes_served'] == 2 * 1024 * 1024 for r in results)
+    assert results[0]['bytes_received'] == 2 * 1024 * 1024 and results[1]['bytes_received'] == 0
+    assert all(r['server_cpu_seconds'] >= 0 for r in results)
@@ -0,0 +1,164 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import io
+import json
+import shutil
+import tempfile
+import threading
+import time
+import pytest
+import similarity
+from app import app
+from database import create_tables
+
+pytest.importorskip('numpy')
+
+DOCUMENTS = {
+    'kafka-tuning': ('Kafka consumer tuning', 'Tune kafka consumer lag, partition rebalancing and broker throughput.'),
+    'kafka-ops': ('Operating Kafka brokers', 'Kafka broker throughput, consumer lag alerts and partition reassignment.'),
+    'pasta': ('Fresh pasta recipe', 'Knead flour and eggs, rest the dough, then roll thin sheets of pasta.'),
+    'bread': ('Sourdough bread', 'Feed the starter, knead the dough with flour and bake the loaf.'),
+}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    db_fd, database = tempfile.mkstemp()
+    upload_dir = tempfile.mkdtemp()
+    index_dir = tempfile.mkdtemp()
+    monkeypatch.setitem(app.config, 'DATABASE', database)
+    monkeypatch.setitem(app.config, 'UPLOAD_FOLDER', upload_dir)
+    monkeypatch.setitem(app.config, 'SIMILARITY_INDEX_DIR', index_dir)
+    monkeypatch.setitem(app.config, 'TESTING', True)
+    with app.app_context():
+        create_tables()
+    client = app.test_client()
+    for doc_id, (name, body) in DOCUMENTS.items():
+        upload(client, doc_id, name, body)
+    similarity.compact_app(app)
+    yield client
+    scheduler = app.extensions.pop('similarity_scheduler', None)
+    if scheduler is not None:
+        scheduler.stop(timeout=5)
+    os.close(db_fd)
+    os.unlink(database)
+    shutil.rmtree(upload_dir)
+    shutil.rmtree(index_dir)
+
+def upload(client, doc_id, name, body):
+    rv = client.post('/upload', data={
+        'doc_id': doc_id, 'metadata': json.dumps({'name': name}), 'change_description': 'initial import',
+        'file': (io.BytesIO(b'%PDF-1.4 test'), f'{doc_id}.pdf'),
+        'html_files': (io.BytesIO(f'<html><script>var x;</script><p>{body}</p></html>'.encode()), f'{doc_id}.html'),
+    }, content_type='multipart/form-data')
+    assert rv.status_code == 200
+
+def similar(client, doc_id, k=3):
+    rv = client.get(f'/documents/{doc_id}/similar?k={k}')
+    assert rv.status_code == 200, rv.data
+    return [entry['doc_id'] for entry in rv.get_json()['similar']]
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert condition()
+
+def test_similar_documents_ranks_by_cosine(client):
+    assert similar(client, 'kafka-tuning') == ['kafka-ops', 'bread', 'pasta']
+    assert similar(client, 'pasta')[0] == 'bread'
+    assert similar(client, 'pasta', k=1) == ['bread']
+    scores = client.get('/documents/pasta/similar').get_json()['similar']
+    assert all(0 < entry['score'] <= 1 for entry in scores)
+    assert client.get('/documents/missing/similar').status_code == 404
+    assert client.get('/documents/pasta/similar?k=0').status_code == 400
+
+def test_index_is_updated_incrementally_and_compacted(client):
+    assert similar(client, 'kafka-tuning', k=1) == ['kafka-ops']
+    index = app.extensions['similarity']
+    generation = index.generation
+
+    upload(client, 'kafka-lag', 'Kafka consumer lag', 'Consumer lag on a kafka partition and broker throughput tuning.')
+    client.delete('/documents/kafka-ops')
+    assert similar(client, 'kafka-tuning', k=1) == ['kafka-lag']
+    assert similar(client, 'kafka-lag', k=1) == ['kafka-tuning']
+    assert 'kafka-ops' not in similar(client, 'kafka-lag', k=10)
+    assert index.generation == generation and set(index.overlay) == {'kafka-lag'}
+
+    summary = similarity.compact_app(app)
+    assert summary['documents'] == 4 and summary['published']
+    assert similar(client, 'kafka-tuning', k=1) == ['kafka-lag']
+    assert index.generation != generation and index.overlay == {}
+    assert sorted(os.listdir(app.config['SIMILARITY_INDEX_DIR'])) == sorted(['CURRENT', 'LOCK', index.generation])
+
+def test_queries_never_build_the_index(client, monkeypatch, tmp_path):
+    monkeypatch.setitem(app.config, 'SIMILARITY_INDEX_DIR', str(tmp_path / 'index'))
+    rv = client.get('/documents/pasta/similar')
+    assert rv.status_code == 503 and rv.headers['Retry-After']
+    # The request asked the background thread for a build
+    wait_for(lambda: client.get('/documents/pasta/similar').status_code == 200)
+    assert similar(client, 'pasta')[0] == 'bread'
+
+def test_large_overlay_triggers_compaction(client, monkeypatch):
+    monkeypatch.setitem(app.config, 'SIMILARITY_MAX_OVERLAY', 1)
+    similar(client, 'pasta')
+    index = app.extensions['similarity']
+    generation = index.generation
+    upload(client, 'focaccia', 'Focaccia', 'Knead flour, olive oil and dough, then bake the bread.')
+    assert similar(client, 'focaccia', k=2) == ['bread', 'pasta']
+    upload(client, 'kafka-lag', 'Kafka consumer lag', 'Consumer lag on a kafka partition and broker throughput.')
+    # Too many changes to re-index on the request path
+    assert client.get('/documents/focaccia/similar').status_code == 503
+    assert set(index.overlay) == {'focaccia'}
+    wait_for(lambda: client.get('/documents/focaccia/similar').status_code == 200)
+    assert index.generation != generation and index.overlay == {}
+    assert similar(client, 'focaccia', k=2) == ['bread', 'pasta']
+
+def test_builds_only_delete_older_generations(client):
+    index_dir = app.config['SIMILARITY_INDEX_DIR']
+    os.makedirs(os.path.join(index_dir, 'gen-1-old'))
+    summary = similarity.compact_app(app)
+    assert summary['published'] and not os.path.exists(os.path.join(index_dir, 'gen-1-old'))
+
+    # A build that started later and published first wins
+    newer = f'gen-{int(time.time() * 1000) + 60000}-newer'
+    os.makedirs(os.path.join(index_dir, newer))
+    with open(os.path.join(index_dir, 'CURRENT'), 'w') as f:
+        f.write(newer)
+    summary = similarity.compact_app(app)
+    assert not summary['published']
+    assert similarity.current_generation(index_dir) == newer
+    assert sorted(os.listdir(index_dir)) == sorted(['CURRENT', 'LOCK', newer])
+
+@pytest.mark.skipif(similarity.fcntl is None, reason='needs fcntl')
+def test_builds_publish_one_at_a_time(client):
+    index_dir = app.config['SIMILARITY_INDEX_DIR']
+    before = similarity.current_generation(index_dir)
+    summaries = []
+    with similarity.publish_lock(index_dir):
+        build = threading.Thread(target=lambda: summaries.append(similarity.compact_app(app)))
+        build.start()
+        build.join(0.5)
+        # Written, but waiting for the lock to publish
+        assert build.is_alive() and similarity.current_generation(index_dir) == before
+    build.join(5)
+    assert similarity.current_generation(index_dir) == summaries[0]['generation']
+
+def test_scheduler_survives_failed_compactions():
+    calls = []
+
+    def flaky_compact():
+        calls.append(1)
+        if len(calls) == 1:
+            raise MemoryError
+
+    scheduler = similarity.CompactionScheduler(flaky_compact)
+    scheduler.start()
+    try:
+        scheduler.wake()
+        wait_for(lambda: calls and not scheduler.compacting)
+        scheduler.wake()
+        wait_for(lambda: len(calls) == 2)
+    finally:
+        scheduler.stop(timeout=5)
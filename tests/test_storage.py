@@ -0,0 +1,163 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import hashlib
+import io
+import json
+import shutil
+import tempfile
+import pytest
+import storage
+from app import app
+from database import create_tables
+from storage import LocalStorage, S3Storage, StorageBackend, storage_key
+
+PDF = b"%PDF-1.4\n" + b"x" * 100 + b"\n%%EOF\n"
+
+
+@pytest.fixture
+def local():
+    root = tempfile.mkdtemp()
+    yield LocalStorage(root)
+    shutil.rmtree(root)
+
+
+class ProxiedStorage(StorageBackend):
+    """A non-local backend without presigned URLs, backed by a directory."""
+
+    def __init__(self, root):
+        self.local = LocalStorage(root)
+
+    def put_stream(self, key, stream, content_type=None):
+        return self.local.put_stream(key, stream)
+
+    def get_stream(self, key):
+        return self.local.get_stream(key)
+
+    def get_range(self, key, start, length):
+        return self.local.get_range(key, start, length)
+
+    def stat(self, key):
+        return self.local.stat(key)
+
+    def delete(self, key):
+        return self.local.delete(key)
+
+    def list(self, prefix=''):
+        return self.local.list(prefix)
+
+    def move(self, source_key, destination_key):
+        self.local.move(source_key, destination_key)
+
+
+class PresignedStorage(ProxiedStorage):
+    def presigned_url(self, key, expires=None, filename=None):
+        return f'https://bucket.example/{key}?signature=abc'
+
+
+@pytest.fixture
+def client():
+    db_fd, app.config['DATABASE'] = tempfile.mkstemp()
+    upload_dir = tempfile.mkdtemp()
+    app.config['UPLOAD_FOLDER'] = upload_dir
+    app.config['TESTING'] = True
+    with app.app_context():
+        create_tables()
+    yield app.test_client()
+    app.config['STORAGE_BACKEND'] = 'local'
+    os.close(db_fd)
+    os.unlink(app.config['DATABASE'])
+    shutil.rmtree(upload_dir)
+
+def test_local_put_get_stat_and_range(local):
+    size, checksum = local.put_stream('a/b.pdf', io.BytesIO(PDF))
+    assert (size, checksum) == (len(PDF), hashlib.sha256(PDF).hexdigest())
+    with local.get_stream('a/b.pdf') as f:
+        assert f.read() == PDF
+    assert local.get_range('a/b.pdf', 0, 5) == b'%PDF-'
+    assert local.stat('a/b.pdf').size == len(PDF)
+    assert local.stat('missing.pdf') is None
+    assert local.exists('a/b.pdf') and not local.exists('a')
+
+def test_local_list_move_delete(local):
+    for key in ('x.pdf', 'sub/y.html', '.staging/z.pdf'):
+        local.put_stream(key, io.BytesIO(b'data'))
+    assert sorted(info.key for info in local.list()) == ['.staging/z.pdf', 'sub/y.html', 'x.pdf']
+    assert [info.key for info in local.list('.staging/')] == ['.staging/z.pdf']
+    local.move('.staging/z.pdf', 'z.pdf')
+    assert local.exists('z.pdf') and not local.exists('.staging/z.pdf')
+    assert local.delete('z.pdf') is True
+    assert local.delete('z.pdf') is False
+
+def test_local_rejects_keys_outside_root(local):
+    with pytest.raises(ValueError):
+        local.path('../escape.pdf')
+
+def test_storage_key_from_database_path():
+    assert storage_key(os.path.join('uploads', 'ab', 'c.pdf'), 'uploads') == 'ab/c.pdf'
+    assert storage_key('/elsewhere/c.pdf', 'uploads') == 'c.pdf'
+
+def test_upload_and_download_through_custom_backend(client):
+    app.config['STORAGE_BACKEND'] = ProxiedStorage(app.config['UPLOAD_FOLDER'])
+    rv = client.post('/upload', content_type='multipart/form-data', data={
+        'doc_id': 'doc1', 'metadata': json.dumps({'name': 'doc1'}), 'change_description': 'v1',
+        'file': (io.BytesIO(PDF), 'test.pdf'),
+    })
+    assert rv.status_code == 200
+    path = client.get('/documents').get_json()[0]['versions'][0]['file_path']
+    filename = os.path.basename(path)
+
+    rv = client.get(f'/uploads/{filename}')
+    assert rv.status_code == 200 and rv.data == PDF
+    assert rv.mimetype == 'application/pdf'
+    rv = client.get(f'/uploads/{filename}', headers={'Range': 'bytes=0-4'})
+    assert rv.status_code == 206 and rv.data == b'%PDF-'
+    assert rv.headers['Content-Range'] == f'bytes 0-4/{len(PDF)}'
+    assert client.get('/uploads/missing.pdf').status_code == 404
+
+def test_download_redirects_to_presigned_url(client):
+    app.config['STORAGE_BACKEND'] = PresignedStorage(app.config['UPLOAD_FOLDER'])
+    rv = client.get('/uploads/doc.pdf')
+    assert rv.status_code == 302
+    assert rv.headers['Location'] == 'https://bucket.example/doc.pdf?signature=abc'
+
+def test_integrity_scan_needs_local_storage(client, monkeypatch):
+    monkeypatch.setitem(app.config, 'ADMIN_TOKEN', 'secret')
+    app.config['STORAGE_BACKEND'] = ProxiedStorage(app.config['UPLOAD_FOLDER'])
+    assert client.get('/admin/integrity', headers={'X-Admin-Token': 'secret'}).status_code == 400
+
+def test_s3_backend_needs_boto3(monkeypatch):
+    monkeypatch.setattr(storage, 'boto3', None)
+    with pytest.raises(RuntimeError, match='boto3 is required'):
+        S3Storage('docs', client=object())
+
+def test_s3_backend_against_moto():
+    moto = pytest.importorskip('moto')
+    boto3 = pytest.importorskip('boto3')
+    with moto.mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket='docs')
+        # A low threshold so the 6 MB body goes through multipart upload
+        s3 = S3Storage('docs', prefix='pdfs', client=client,
+                       multipart_threshold=5 * 1024 * 1024, multipart_chunksize=5 * 1024 * 1024)
+        assert isinstance(s3, StorageBackend)
+        body = PDF + b'y' * (6 * 1024 * 1024)
+        size, checksum = s3.put_stream('.staging/a.pdf', io.BytesIO(body))
+        assert (size, checksum) == (len(body), hashlib.sha256(body).hexdigest())
+        s3.move('.staging/a.pdf', 'a.pdf')
+        assert s3.stat('.staging/a.pdf') is None
+        assert s3.stat('a.pdf').size == len(body)
+        assert s3.get_range('a.pdf', 0, 5) == b'%PDF-'
+        assert s3.get_stream('a.pdf').read() == body
+        assert [info.key for info in s3.list()] == ['a.pdf']
+        assert s3.exists_cached('a.pdf')
+        assert not s3.exists_cached('b.pdf')
+        client.put_object(Bucket='docs', Key='pdfs/b.pdf', Body=PDF)
+        assert not s3.exists_cached('b.pdf')  # cached for exists_ttl
+        s3.move('a.pdf', 'b.pdf')
+        assert s3.exists_cached('b.pdf') and not s3.exists_cached('a.pdf')
+        s3.move('b.pdf', 'a.pdf')
+        assert 'pdfs/a.pdf' in s3.presigned_url('a.pdf')
+        assert s3.delete('a.pdf') is True
+        with pytest.raises(FileNotFoundError):
+            s3.get_stream('a.pdf')
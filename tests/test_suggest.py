@@ -0,0 +1,150 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import io
+import json
+import shutil
+import tempfile
+import time
+import pytest
+import suggest
+from app import app
+from database import create_tables
+
+
+@pytest.fixture
+def client(monkeypatch):
+    db_fd, database = tempfile.mkstemp()
+    upload_dir = tempfile.mkdtemp()
+    monkeypatch.setitem(app.config, 'DATABASE', database)
+    monkeypatch.setitem(app.config, 'UPLOAD_FOLDER', upload_dir)
+    monkeypatch.setitem(app.config, 'TESTING', True)
+    with app.app_context():
+        create_tables()
+    client = app.test_client()
+    upload(client, 'kafka-tuning', {'name': 'Kafka consumer tuning', 'team': 'Platform'})
+    upload(client, 'kafka-ops', {'name': 'Operating Kafka brokers', 'team': 'Platform'})
+    upload(client, 'pasta', {'name': 'Fresh pasta recipe', 'tags': ['cooking', 'Italian']})
+    suggest.refresh(app)
+    yield client
+    updater = app.extensions.pop('suggest_updater', None)
+    if updater is not None:
+        updater.stop(timeout=5)
+    os.close(db_fd)
+    os.unlink(database)
+    shutil.rmtree(upload_dir)
+
+def upload(client, doc_id, metadata):
+    rv = client.post('/upload', data={
+        'doc_id': doc_id, 'metadata': json.dumps(metadata),
+        'file': (io.BytesIO(b'%PDF-1.4 test'), f'{doc_id}.pdf'),
+    }, content_type='multipart/form-data')
+    assert rv.status_code == 200
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+def values(client, query, limit=10):
+    rv = client.get('/suggest', query_string={'q': query, 'limit': limit})
+    assert rv.status_code == 200
+    return [s['value'] for s in rv.get_json()['suggestions']]
+
+def test_prefix_suggestions_are_ranked(client):
+    # Whole values first, then values with a later word matching
+    assert values(client, 'kaf') == ['kafka-ops', 'kafka-tuning', 'Kafka consumer tuning', 'Operating Kafka brokers']
+    rv = client.get('/suggest?q=plat').get_json()
+    assert rv['suggestions'] == [{'value': 'Platform', 'documents': 2, 'distance': 0}]
+    assert values(client, 'ital') == ['Italian']
+    assert values(client, 'consumer tu') == ['Kafka consumer tuning']
+    assert values(client, '') == []
+    assert client.get('/suggest?q=a&limit=0').status_code == 400
+
+def test_typos_within_the_edit_limit_are_suggested(client):
+    assert values(client, 'kafak') == ['kafka-ops', 'kafka-tuning', 'Kafka consumer tuning', 'Operating Kafka brokers']
+    assert values(client, 'recipie') == ['Fresh pasta recipe']
+    assert values(client, 'cokoing') == ['cooking']
+    # Short queries must match exactly
+    assert values(client, 'pzs') == []
+
+def test_index_follows_uploads_and_deletes(client):
+    assert values(client, 'brok') == ['Operating Kafka brokers']
+    upload(client, 'broker-faq', {'name': 'Broker FAQ'})
+    # Queries serve the published index until the next refresh
+    assert values(client, 'brok') == ['Operating Kafka brokers']
+    before = suggest.refresh(app)
+    assert values(client, 'brok') == ['Broker FAQ', 'broker-faq', 'Operating Kafka brokers']
+    client.delete('/documents/kafka-ops')
+    suggest.refresh(app)
+    assert values(client, 'brok') == ['Broker FAQ', 'broker-faq']
+    # Published indexes are never modified
+    assert before.suggest('brok') == suggest.refresh(app).suggest('brok') + [
+        {'value': 'Operating Kafka brokers', 'documents': 1, 'distance': 0}]
+    assert before.suggest('plat')[0]['documents'] == 2
+    assert values(client, 'plat') == ['Platform']
+    assert client.get('/suggest?q=plat').get_json()['suggestions'][0]['documents'] == 1
+
+    index = app.extensions['suggest']
+    rebuilt = suggest.SuggestIndex(index.database)
+    with app.app_context():
+        from database import get_db_connection
+        rebuilt.build(get_db_connection())
+    assert sorted(t for t in index.terms if t) == sorted(t for t in rebuilt.terms if t)
+    assert sorted(map(index.entry_key, index.entries)) == sorted(map(rebuilt.entry_key, rebuilt.entries))
+
+def test_queries_never_touch_the_database(client, monkeypatch):
+    def no_database(*args, **kwargs):
+        raise AssertionError("a query opened a connection")
+    monkeypatch.setattr(suggest, 'get_db_connection', no_database)
+    assert values(client, 'pasta') == ['pasta', 'Fresh pasta recipe']
+
+def test_unbuilt_index_is_unavailable(client):
+    app.extensions.pop('suggest')
+    rv = client.get('/suggest?q=kaf')
+    assert rv.status_code == 503
+    assert rv.headers['Retry-After'] == '1'
+    suggest.refresh(app)
+    assert values(client, 'kaf')
+
+def test_writes_wake_the_updater(client, monkeypatch):
+    app.extensions.pop('suggest')
+    monkeypatch.setitem(app.config, 'SUGGEST_REFRESH_SECONDS', 3600)
+    suggest.start_updater(app)
+    wait_for(lambda: app.extensions['suggest'].built)
+    upload(client, 'broker-faq', {'name': 'Broker FAQ'})
+    wait_for(lambda: 'Broker FAQ' in app.extensions['suggest'].displays)
+    assert values(client, 'brok') == ['Broker FAQ', 'broker-faq', 'Operating Kafka brokers']
+
+def test_updater_survives_failed_refreshes():
+    calls = []
+
+    def flaky_refresh():
+        calls.append(1)
+        if len(calls) == 1:
+            raise OverflowError('unsigned int is greater than maximum')
+
+    updater = suggest.SuggestUpdater(flaky_refresh, interval=3600)
+    updater.start()
+    try:
+        wait_for(lambda: calls)
+        updater.wake()
+        wait_for(lambda: len(calls) == 2)
+    finally:
+        updater.stop(timeout=5)
+
+def test_failed_updates_rebuild_the_index(client, monkeypatch):
+    upload(client, 'broker-faq', {'name': 'Broker FAQ'})
+    published = app.extensions['suggest']
+    monkeypatch.setattr(suggest.SuggestIndex, 'updated', lambda self, seq, documents: 1 / 0)
+    assert suggest.refresh(app) is not published
+    assert values(client, 'brok') == ['Broker FAQ', 'broker-faq', 'Operating Kafka brokers']
+
+def test_prefix_distance():
+    assert suggest.prefix_distance('kafak', 'kafka consumer', 1) == 1
+    assert suggest.prefix_distance('kafka', 'kafka consumer', 1) == 0
+    assert suggest.prefix_distance('kfk', 'kafka', 1) == 1
+    assert suggest.prefix_distance('xyz', 'kafka', 1) == 2
+    assert suggest.prefix_distance('cokoing', 'cooking', 1) == 1
+    assert suggest.prefix_distance('recipie', 'recipe', 2) == 1
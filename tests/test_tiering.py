@@ -0,0 +1,162 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import sqlite3
+import time
+import pytest
+import integrity
+import tiering
+from app import app
+from database import DatabaseBusyError, create_tables
+from reaper import reap_tombstones
+from storage import LocalStorage
+
+PDF = b'%PDF-1.4\n' + b'old version body\n' * 2000 + b'%%EOF\n'
+OLD = time.time() - 90 * 86400
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    uploads = tmp_path / 'uploads'
+    uploads.mkdir()
+    database_path = str(tmp_path / 'test.db')
+    conn = sqlite3.connect(database_path)
+    create_tables(conn)
+    conn.execute("INSERT INTO documents (id, doc_id, metadata, latest_version) VALUES (1, 'doc', '{}', 3)")
+    for version in (1, 2, 3):
+        name = f'doc_v{version}.pdf'
+        (uploads / name).write_bytes(PDF)
+        conn.execute("INSERT INTO versions (document_id, version, file_path, file_size, created_at) "
+                     "VALUES (1, ?, ?, ?, datetime(?, 'unixepoch'))",
+                     (version, os.path.join('uploads', name), len(PDF), OLD))
+    conn.execute("INSERT INTO html_documents (version_id, file_path) VALUES (1, ?)", (os.path.join('uploads', 'doc_v1.html'),))
+    (uploads / 'doc_v1.html').write_bytes(b'<html>old</html>')
+    conn.execute("UPDATE versions SET access_count = 5 WHERE version = 2")
+    conn.commit()
+    yield conn, database_path, tmp_path
+    conn.close()
+
+def tiers(conn):
+    return conn.execute("SELECT version, tier, archive_path FROM versions ORDER BY version").fetchall()
+
+def busy(conn):
+    raise DatabaseBusyError('database is locked')
+
+def make_client(monkeypatch, database_path, base_dir):
+    monkeypatch.setitem(app.config, 'DATABASE', database_path)
+    monkeypatch.setitem(app.config, 'UPLOAD_FOLDER', 'uploads')
+    monkeypatch.setitem(app.config, 'TESTING', True)
+    monkeypatch.setitem(app.config, 'TIERING_PROMOTE_AFTER', 3)
+    monkeypatch.setattr(app, 'root_path', str(base_dir))
+    monkeypatch.delitem(app.extensions, 'tiering_access_counter', raising=False)
+    return app.test_client()
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_archive_compresses_old_unpopular_versions(catalog, workers):
+    conn, _, base_dir = catalog
+    summary = tiering.archive_cold_files(conn, base_dir=str(base_dir), codec='xz', workers=workers)
+    assert summary['archived'] == 2 and summary['failed'] == 0
+    assert summary['bytes_after'] < summary['bytes_before']
+    archive = os.path.join('uploads', 'doc_v1.pdf.xz')
+    # v2 is downloaded too often and v3 is the latest version
+    assert tiers(conn) == [(1, 'cold', archive), (2, 'hot', None), (3, 'hot', None)]
+    assert conn.execute("SELECT tier FROM html_documents").fetchone()[0] == 'cold'
+
+    reap_tombstones(conn, remove=lambda path: os.remove(os.path.join(base_dir, path)))
+    assert not (base_dir / 'uploads' / 'doc_v1.pdf').exists()
+    report = integrity.scan(conn, str(base_dir / 'uploads'), base_dir=str(base_dir), workers=0)
+    assert report['orphaned'] == [] and report['missing'] == [] and report['corrupt'] == []
+
+def test_archive_skips_recent_versions(catalog):
+    conn, _, base_dir = catalog
+    summary = tiering.archive_cold_files(conn, base_dir=str(base_dir), codec='xz', workers=0, now=OLD + 86400)
+    assert summary['archived'] == 0
+    assert all(tier == 'hot' for _, tier, _ in tiers(conn))
+
+def test_cold_download_decompresses_and_promotes(catalog, monkeypatch):
+    conn, database_path, base_dir = catalog
+    tiering.archive_cold_files(conn, base_dir=str(base_dir), codec='xz', workers=0)
+    reap_tombstones(conn, remove=lambda path: os.remove(os.path.join(base_dir, path)))
+    client = make_client(monkeypatch, database_path, base_dir)
+
+    for _ in range(2):
+        rv = client.get('/uploads/doc_v1.pdf')
+        assert rv.status_code == 200 and rv.data == PDF
+        assert rv.headers['Content-Length'] == str(len(PDF))
+    assert tiers(conn)[0][1] == 'cold'
+
+    rv = client.get('/uploads/doc_v1.pdf')
+    assert rv.status_code == 200 and rv.data == PDF
+    rv.close()
+    assert tiers(conn)[0] == (1, 'hot', None)
+    assert (base_dir / 'uploads' / 'doc_v1.pdf').read_bytes() == PDF
+    assert conn.execute('SELECT file_path FROM file_tombstones').fetchall() == [(os.path.join('uploads', 'doc_v1.pdf.xz'),)]
+
+def test_recreated_paths_survive_pending_tombstones(catalog):
+    conn, _, base_dir = catalog
+    uploads = base_dir / 'uploads'
+    remove = lambda path: os.remove(os.path.join(base_dir, path))
+    tiering.archive_cold_files(conn, base_dir=str(base_dir), codec='xz', workers=0)
+    # Promoted before the reaper removed the hot file
+    entry = tiering.find_file(conn, [os.path.join('uploads', 'doc_v1.pdf')])
+    tiering.promote(conn, LocalStorage(str(uploads)), 'uploads', entry)
+    reap_tombstones(conn, remove=remove)
+    assert (uploads / 'doc_v1.pdf').read_bytes() == PDF
+    assert not (uploads / 'doc_v1.pdf.xz').exists()
+
+    tiering.archive_cold_files(conn, base_dir=str(base_dir), codec='xz', workers=0)
+    entry = tiering.find_file(conn, [os.path.join('uploads', 'doc_v1.pdf')])
+    tiering.promote(conn, LocalStorage(str(uploads)), 'uploads', entry)
+    # Archived again before the reaper removed the previous archive
+    tiering.archive_cold_files(conn, base_dir=str(base_dir), codec='xz', workers=0)
+    reap_tombstones(conn, remove=remove)
+    assert tiers(conn)[0] == (1, 'cold', os.path.join('uploads', 'doc_v1.pdf.xz'))
+    assert (uploads / 'doc_v1.pdf.xz').exists()
+    assert not (uploads / 'doc_v1.pdf').exists()
+
+def test_downloads_are_counted_in_memory_and_flushed(catalog, monkeypatch):
+    conn, database_path, base_dir = catalog
+    client = make_client(monkeypatch, database_path, base_dir)
+    for _ in range(2):
+        assert client.get('/uploads/doc_v2.pdf').status_code == 200
+    assert conn.execute("SELECT access_count FROM versions WHERE version = 2").fetchone()[0] == 5
+
+    with monkeypatch.context() as m:
+        m.setattr(tiering, 'begin_immediate', busy)
+        assert tiering.flush_access_counts(app) == 0
+    assert tiering.flush_access_counts(app) == 1
+    assert conn.execute("SELECT access_count, last_accessed_at IS NOT NULL FROM versions WHERE version = 2").fetchone() == (7, 1)
+    assert tiering.flush_access_counts(app) == 0
+
+def test_busy_promotion_still_serves_the_file(catalog, monkeypatch):
+    conn, database_path, base_dir = catalog
+    tiering.archive_cold_files(conn, base_dir=str(base_dir), codec='xz', workers=0)
+    reap_tombstones(conn, remove=lambda path: os.remove(os.path.join(base_dir, path)))
+    client = make_client(monkeypatch, database_path, base_dir)
+    monkeypatch.setitem(app.config, 'TIERING_PROMOTE_AFTER', 1)
+    monkeypatch.setattr(tiering, 'begin_immediate', busy)
+    rv = client.get('/uploads/doc_v1.pdf')
+    assert rv.status_code == 200 and rv.data == PDF
+    rv.close()
+    assert tiers(conn)[0][1] == 'cold'
+    # Nothing was left at the hot path, nor in staging
+    assert not (base_dir / 'uploads' / 'doc_v1.pdf').exists()
+    assert not any((base_dir / 'uploads' / tiering.STAGING_DIR).iterdir())
+
+def test_scheduler_survives_failed_passes():
+    calls = []
+
+    def flaky_task():
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError('broken pool')
+
+    scheduler = tiering.TieringScheduler(flaky_task, 0.01, 'test-tiering')
+    scheduler.start()
+    try:
+        deadline = time.time() + 5
+        while len(calls) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+    finally:
+        scheduler.stop(timeout=5)
+    assert len(calls) >= 2
@@ -191,6 +191,9 @@ def test_main_function(mock_upload_document, mock_argparse):
     mock_args.metadata_json_path = "test_metadata.json"
     mock_args.html_files = ["test.html"]
     mock_args.base_url = "http://test.com"
+    mock_args.chunk_size = None
+    mock_args.parallel = 1
+    mock_args.compress = None
     mock_argparse.return_value.parse_args.return_value = mock_args
 
     # Simulate running the script
@@ -203,7 +206,10 @@ def test_main_function(mock_upload_document, mock_argparse):
             "test.pdf",
             "test_metadata.json",
             ["test.html"],
-            "http://test.com"
+            "http://test.com",
+            chunk_size=None,
+            parallel=1,
+            compress=None
         )
         # Assert that the script exited with code 0 (success)
         assert pytest_wrapped_e.type == SystemExit
@@ -218,6 +224,9 @@ def test_main_function_upload_failure(mock_upload_document, mock_argparse):
     mock_args.metadata_json_path = "test_metadata.json"
     mock_args.html_files = None
     mock_args.base_url = "http://test.com"
+    mock_args.chunk_size = None
+    mock_args.parallel = 1
+    mock_args.compress = None
     mock_argparse.return_value.parse_args.return_value = mock_args
 
     # Simulate running the script
@@ -230,7 +239,10 @@ def test_main_function_upload_failure(mock_upload_document, mock_argparse):
             "test.pdf",
             "test_metadata.json",
             None,
-            "http://test.com"
+            "http://test.com",
+            chunk_size=None,
+            parallel=1,
+            compress=None
         )
         # Assert that the script exited with code 1 (failure)
         assert pytest_wrapped_e.type == SystemExit
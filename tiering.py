@@ -0,0 +1,449 @@
+"""Archival tier for cold files.
+
+Old versions are rarely opened, yet their files would otherwise stay
+uncompressed forever. archive_cold_files() picks rows matching the policy:
+
+* the version is not the document's latest,
+* it was uploaded at least ``min_age_days`` ago,
+* its files were downloaded at most ``max_access_count`` times,
+
+compresses their files with zstd (when the ``zstandard`` package is
+installed) or xz in a process pool, and marks the rows ``tier = 'cold'``
+with the compressed file in ``archive_path``. The uncompressed file is
+tombstoned in the same transaction, so the reaper only removes it once the
+row points at the archive.
+
+Downloads of cold files are decompressed while streaming. Every download
+increments ``access_count`` (reset when a file changes tier), and a cold
+file downloaded ``promote_after`` times is decompressed back to hot.
+Downloads are counted in memory by an AccessCounter and written in batches,
+so serving a file never waits for the database write lock.
+
+Usage::
+
+    python tiering.py --database pdf_browser.db --uploads uploads --min-age-days 30 --workers 4
+"""
+import argparse
+import json
+import logging
+import lzma
+import os
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+from database import DATABASE_NAME, begin_immediate, clear_tombstones, get_db_connection, tombstone_files
+from ingest import STAGING_DIR
+from storage import LocalStorage, get_storage, storage_key
+
+try:
+    import zstandard
+except ImportError: # zstandard is optional; xz is always available
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+CODEC_EXTENSIONS = {'xz': '.xz', 'zstd': '.zst'}
+MIN_AGE_DAYS = 30
+MAX_ACCESS_COUNT = 2
+PROMOTE_AFTER = 3
+ARCHIVE_LIMIT = 1000
+ACCESS_FLUSH_INTERVAL_SECONDS = 10.0
+CHUNK_SIZE = 1024 * 1024
+TABLES = ('versions', 'html_documents')
+
+_VERSION_POLICY = ("v.version < d.latest_version AND v.created_at <= datetime(:cutoff, 'unixepoch') "
+                   "AND v.access_count <= :max_access")
+CANDIDATES_SQL = f'''
+    SELECT 'versions', v.id, v.file_path
+    FROM versions v JOIN documents d ON d.id = v.document_id
+    WHERE v.tier = 'hot' AND {_VERSION_POLICY}
+    UNION ALL
+    SELECT 'html_documents', h.id, h.file_path
+    FROM html_documents h JOIN versions v ON v.id = h.version_id JOIN documents d ON d.id = v.document_id
+    WHERE h.tier = 'hot' AND h.access_count <= :max_access AND {_VERSION_POLICY}
+    LIMIT :limit
+'''
+
+
+def default_codec():
+    return 'zstd' if zstandard is not None else 'xz'
+
+
+def _compressor(codec, level=None):
+    if codec == 'xz':
+        return lzma.LZMACompressor(preset=6 if level is None else level)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("zstandard is required for zstd compression")
+        return zstandard.ZstdCompressor(level=19 if level is None else level).compressobj()
+    raise ValueError(f"Unknown codec: {codec!r}")
+
+
+def _decompressor(codec):
+    if codec == 'xz':
+        return lzma.LZMADecompressor()
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read zstd archives")
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError(f"Unknown codec: {codec!r}")
+
+
+def codec_for(archive_path):
+    for codec, extension in CODEC_EXTENSIONS.items():
+        if archive_path.endswith(extension):
+            return codec
+    raise ValueError(f"Not an archive: {archive_path!r}")
+
+
+class DecompressingReader:
+    """File-like ``read()`` over the decompressed contents of ``stream``."""
+
+    def __init__(self, stream, codec):
+        self.stream = stream
+        self.decompressor = _decompressor(codec)
+        self.buffer = b''
+        self.eof = False
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            chunk = self.stream.read(CHUNK_SIZE)
+            if not chunk:
+                self.eof = True
+                break
+            self.buffer += self.decompressor.decompress(chunk)
+        if size < 0:
+            data, self.buffer = self.buffer, b''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        self.stream.close()
+
+
+def compress_file(task):
+    """Compress one file. Runs in a worker process.
+
+    ``task`` is ``(source, destination, codec, level)``. Returns
+    ``(source, destination, original size, compressed size, error)``.
+    """
+    source, destination, codec, level = task
+    tmp_path = destination + '.tmp'
+    try:
+        compressor = _compressor(codec, level)
+        original = compressed = 0
+        with open(source, 'rb') as src, open(tmp_path, 'wb') as out:
+            for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                original += len(chunk)
+                data = compressor.compress(chunk)
+                compressed += len(data)
+                out.write(data)
+            data = compressor.flush()
+            compressed += len(data)
+            out.write(data)
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp_path, destination)
+        return source, destination, original, compressed, None
+    except OSError as e:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        return source, destination, 0, 0, str(e)
+
+
+def archive_cold_files(conn, base_dir='.', min_age_days=MIN_AGE_DAYS, max_access_count=MAX_ACCESS_COUNT,
+                       codec=None, level=None, workers=None, limit=ARCHIVE_LIMIT, now=None):
+    """Compress up to ``limit`` files matching the cold policy and mark them cold.
+
+    Stored file paths are resolved against ``base_dir``; the tier only
+    works with local storage. ``workers=0`` compresses in the calling
+    process. Returns counts of archived and failed files and bytes before
+    and after compression.
+    """
+    codec = codec or default_codec()
+    now = time.time() if now is None else now
+    extension = CODEC_EXTENSIONS[codec]
+    candidates = conn.execute(CANDIDATES_SQL, {
+        'cutoff': now - min_age_days * 86400, 'max_access': max_access_count, 'limit': limit,
+    }).fetchall()
+    tasks = [(os.path.join(base_dir, file_path), os.path.join(base_dir, file_path + extension), codec, level)
+             for _, _, file_path in candidates]
+
+    if workers == 0 or len(tasks) <= 1:
+        results = [compress_file(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(compress_file, tasks, chunksize=8))
+
+    summary = {'archived': 0, 'failed': 0, 'bytes_before': 0, 'bytes_after': 0}
+    if not candidates:
+        return summary
+    begin_immediate(conn)
+    cursor = conn.cursor()
+    for (table, row_id, file_path), (_, _, original, compressed, error) in zip(candidates, results):
+        if error is not None:
+            logger.warning("Could not archive %s: %s", file_path, error)
+            summary['failed'] += 1
+            continue
+        archive_path = file_path + extension
+        cursor.execute(
+            f"UPDATE {table} SET tier = 'cold', archive_path = ?, access_count = 0 "
+            "WHERE id = ? AND tier = 'hot' AND file_path = ?",
+            (archive_path, row_id, file_path)
+        )
+        if cursor.rowcount:
+            # An archive left by an earlier cold spell may still be queued for removal
+            clear_tombstones(cursor, [archive_path])
+            tombstone_files(cursor, [file_path])
+            summary['archived'] += 1
+            summary['bytes_before'] += original
+            summary['bytes_after'] += compressed
+        else:
+            tombstone_files(cursor, [archive_path])  # deleted while being compressed
+    conn.commit()
+    if summary['archived']:
+        logger.info("Archived %d files, %d -> %d bytes", summary['archived'], summary['bytes_before'], summary['bytes_after'])
+    return summary
+
+
+def find_file(conn, file_paths):
+    """The row storing the first of ``file_paths`` that a row references, or None."""
+    for path in file_paths:
+        for table in TABLES:
+            row = conn.execute(
+                f'SELECT id, file_path, tier, archive_path, file_size, access_count FROM {table} WHERE file_path = ?',
+                (path,)
+            ).fetchone()
+            if row is not None:
+                return dict(zip(('id', 'file_path', 'tier', 'archive_path', 'file_size', 'access_count'), row), table=table)
+    return None
+
+
+class AccessCounter:
+    """Download counts held in memory until flush() adds them to ``access_count`` in ``database``."""
+
+    def __init__(self, database):
+        self.database = database
+        self.lock = threading.Lock()
+        self.pending = {}  # (table, id) -> [downloads, last accessed at]
+
+    def record(self, entry, now=None):
+        """Count a download of ``entry``; returns its access_count including unflushed downloads."""
+        now = time.time() if now is None else now
+        with self.lock:
+            counts = self.pending.setdefault((entry['table'], entry['id']), [0, now])
+            counts[0] += 1
+            counts[1] = now
+            entry['access_count'] += counts[0]
+        return entry['access_count']
+
+    def discard(self, entry):
+        """Forget unflushed downloads of ``entry``, whose count was reset."""
+        with self.lock:
+            self.pending.pop((entry['table'], entry['id']), None)
+
+    def flush(self, conn):
+        """Write the pending counts in one transaction. Returns the rows updated.
+
+        While the database is busy the counts are kept for the next flush.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return 0
+        try:
+            begin_immediate(conn)
+            for table in TABLES:
+                conn.executemany(
+                    f'UPDATE {table} SET access_count = access_count + ?, last_accessed_at = ? WHERE id = ?',
+                    [(count, accessed_at, row_id) for (row_table, row_id), (count, accessed_at) in pending.items()
+                     if row_table == table]
+                )
+            conn.commit()
+        except sqlite3.OperationalError as e:
+            if conn.in_transaction:
+                conn.rollback()
+            with self.lock:
+                for key, (count, accessed_at) in pending.items():
+                    counts = self.pending.setdefault(key, [0, accessed_at])
+                    counts[0] += count
+            logger.warning("Could not write %d access counts, keeping them for the next flush: %s", len(pending), e)
+            return 0
+        return len(pending)
+
+
+def get_access_counter(app):
+    database = app.config.get('DATABASE') or DATABASE_NAME
+    counter = app.extensions.get('tiering_access_counter')
+    if counter is None or counter.database != database:
+        counter = app.extensions['tiering_access_counter'] = AccessCounter(database)
+    return counter
+
+
+def open_cold_file(storage, upload_folder, entry):
+    """Decompressing reader over a cold file's archive."""
+    stream = storage.get_stream(storage_key(entry['archive_path'], upload_folder))
+    return DecompressingReader(stream, codec_for(entry['archive_path']))
+
+
+def promote(conn, storage, upload_folder, entry):
+    """Decompress a cold file back to its hot path and mark its row hot.
+
+    The file is moved into place only once the write lock is held, so a
+    busy database (DatabaseBusyError) leaves nothing at the hot path.
+    """
+    staging_key = f'{STAGING_DIR}/{uuid.uuid4()}'
+    key = storage_key(entry['file_path'], upload_folder)
+    reader = open_cold_file(storage, upload_folder, entry)
+    try:
+        storage.put_stream(staging_key, reader)
+    finally:
+        reader.close()
+
+    moved = False
+    try:
+        begin_immediate(conn)
+        cursor = conn.cursor()
+        storage.move(staging_key, key)
+        moved = True
+        cursor.execute(
+            f"UPDATE {entry['table']} SET tier = 'hot', archive_path = NULL, access_count = 0 WHERE id = ? AND archive_path = ?",
+            (entry['id'], entry['archive_path'])
+        )
+        if cursor.rowcount:
+            # The hot file was tombstoned when it was archived; it is back now
+            clear_tombstones(cursor, [entry['file_path']])
+            tombstone_files(cursor, [entry['archive_path']])
+        elif cursor.execute(f"SELECT 1 FROM {entry['table']} WHERE id = ?", (entry['id'],)).fetchone() is None:
+            tombstone_files(cursor, [entry['file_path']])  # deleted while being promoted
+        conn.commit()
+    except Exception:
+        if conn.in_transaction:
+            conn.rollback()
+        storage.delete(key if moved else staging_key)
+        raise
+    entry.update(tier='hot', archive_path=None, access_count=0)
+    logger.info("Promoted %s back to the hot tier", entry['file_path'])
+
+
+def flush_access_counts(app):
+    counter = get_access_counter(app)
+    conn = get_db_connection(counter.database)
+    try:
+        return counter.flush(conn)
+    finally:
+        conn.close()
+
+
+def archive_app(app):
+    """archive_cold_files with the app's TIERING_* settings, after flushing access counts."""
+    conn = get_db_connection(app.config.get('DATABASE') or DATABASE_NAME)
+    try:
+        get_access_counter(app).flush(conn)
+        return archive_cold_files(
+            conn,
+            base_dir=app.root_path,
+            min_age_days=app.config.get('TIERING_MIN_AGE_DAYS', MIN_AGE_DAYS),
+            max_access_count=app.config.get('TIERING_MAX_ACCESS_COUNT', MAX_ACCESS_COUNT),
+            codec=app.config.get('TIERING_CODEC'),
+            workers=app.config.get('TIERING_WORKERS'),
+        )
+    finally:
+        conn.close()
+
+
+class TieringScheduler:
+    """Background thread that runs ``task`` (an archive pass by default) every ``interval`` seconds."""
+
+    def __init__(self, task, interval, name='tiering-scheduler'):
+        self.task = task
+        self.interval = interval
+        self.name = name
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.task()
+            except Exception:
+                logger.exception("%s pass failed", self.name)
+
+
+def init_tiering(app):
+    """Start writing access counts, and archive passes when TIERING_INTERVAL_SECONDS is set, on the first request.
+
+    Access counts are flushed every TIERING_ACCESS_FLUSH_SECONDS. Archive
+    passes only run with local storage. Neither runs for testing apps.
+    """
+    lock = threading.Lock()
+
+    def start_once():
+        if app.testing:
+            return
+        if 'tiering_access_flusher' not in app.extensions:
+            with lock:
+                if 'tiering_access_flusher' not in app.extensions:
+                    flusher = TieringScheduler(
+                        lambda: flush_access_counts(app),
+                        app.config.get('TIERING_ACCESS_FLUSH_SECONDS', ACCESS_FLUSH_INTERVAL_SECONDS),
+                        name='tiering-access-flusher',
+                    )
+                    flusher.start()
+                    app.extensions['tiering_access_flusher'] = flusher
+        if 'tiering_scheduler' in app.extensions or not app.config.get('TIERING_INTERVAL_SECONDS'):
+            return
+        with lock:
+            if 'tiering_scheduler' in app.extensions:
+                return
+            if not isinstance(get_storage(app), LocalStorage):
+                logger.warning("Tiering needs the local storage backend; archive passes are disabled")
+                app.extensions['tiering_scheduler'] = None
+                return
+            scheduler = TieringScheduler(lambda: archive_app(app), app.config['TIERING_INTERVAL_SECONDS'])
+            scheduler.start()
+            app.extensions['tiering_scheduler'] = scheduler
+
+    app.before_request(start_once)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compress cold versions into the archive tier.")
+    parser.add_argument("--database", default=DATABASE_NAME, help="SQLite database file.")
+    parser.add_argument("--base-dir", default='.', help="Directory the stored file paths are relative to.")
+    parser.add_argument("--min-age-days", type=float, default=MIN_AGE_DAYS, help="Only archive versions older than this.")
+    parser.add_argument("--max-access-count", type=int, default=MAX_ACCESS_COUNT, help="Only archive files downloaded at most this often.")
+    parser.add_argument("--codec", choices=sorted(CODEC_EXTENSIONS), default=default_codec(), help="Compression codec.")
+    parser.add_argument("--level", type=int, help="Compression level (default: xz 6, zstd 19).")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: CPU count, 0 = in-process).")
+    parser.add_argument("--limit", type=int, default=ARCHIVE_LIMIT, help="Maximum files archived in this run.")
+    args = parser.parse_args(argv)
+
+    conn = get_db_connection(args.database)
+    try:
+        summary = archive_cold_files(conn, args.base_dir, args.min_age_days, args.max_access_count,
+                                     args.codec, args.level, args.workers, args.limit)
+    finally:
+        conn.close()
+    print(json.dumps(summary))
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,24 @@
 import requests
 import json
 import argparse
+import base64
+import gzip
+import hashlib
 import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
 
-def upload_document(pdf_path, metadata_json_path, html_file_paths=None, base_url="http://127.0.0.1:5000"):
+RETRIES = 5
+RETRY_BACKOFF_SECONDS = 0.5
+RETRY_MAX_BACKOFF_SECONDS = 30
+RETRY_STATUSES = {502, 503, 504}
+RESUME_SUFFIX = '.upload.json'
+COMPRESS_MODES = ('html', 'body')
+
+def upload_document(pdf_path, metadata_json_path, html_file_paths=None, base_url="http://127.0.0.1:5000",
+                    chunk_size=None, parallel=1, retries=RETRIES, compress=None):
     """
     Uploads a document (PDF, metadata, and optional HTML files) to the PDF Browser application.
 
@@ -12,6 +27,13 @@ def upload_document(pdf_path, metadata_json_path, html_file_paths=None, base_url
         metadata_json_path (str): Path to the JSON file containing metadata.
         html_file_paths (list, optional): List of paths to HTML files. Defaults to None.
         base_url (str, optional): Base URL of the PDF Browser application. Defaults to "http://127.0.0.1:5000".
+        chunk_size (int, optional): Send the PDF through a resumable upload session in chunks of this
+            many bytes instead of a single request. Defaults to None.
+        parallel (int, optional): Number of chunks sent at once. Defaults to 1.
+        retries (int, optional): Retries of each request after a connection error or 502/503/504, waiting for the
+            server's Retry-After plus a jittered backoff. Defaults to 5.
+        compress (str, optional): 'html' gzips each HTML file, 'body' gzips the whole request
+            (only the HTML files with chunk_size). Defaults to None.
     """
     upload_url = f"{base_url}/upload"
 
@@ -57,8 +79,11 @@ def upload_document(pdf_path, metadata_json_path, html_file_paths=None, base_url
         if html_file_paths:
             for html_path in html_file_paths:
                 html_file_handle = open(html_path, 'rb')
-                files.append(('html_files', (os.path.basename(html_path), html_file_handle, 'text/html')))
                 html_file_handles.append(html_file_handle)
+                if compress == 'html':
+                    files.append(html_part(html_path, html_file_handle.read(), compress))
+                else:
+                    files.append(('html_files', (os.path.basename(html_path), html_file_handle, 'text/html')))
 
         print(f"Uploading to: {upload_url}")
         print(f"Doc ID: {doc_id}")
@@ -66,7 +91,18 @@ def upload_document(pdf_path, metadata_json_path, html_file_paths=None, base_url
         if html_file_paths:
             print(f"HTML Files: {[os.path.basename(p) for p in html_file_paths]}") # Print basenames
 
-        response = requests.post(upload_url, files=files, data=data)
+        if chunk_size:
+            response = upload_resumable(pdf_path, data, html_file_paths or [], base_url, chunk_size, parallel, retries,
+                                        compress)
+        else:
+            def send():
+                # A retry sends the files again from the start
+                for handle in [pdf_file_handle] + html_file_handles:
+                    handle.seek(0)
+                if compress == 'body':
+                    return post_compressed(upload_url, files=files, data=data)
+                return requests.post(upload_url, files=files, data=data)
+            response = send_with_retry(send, retries)
         response.raise_for_status() # Raise an exception for HTTP errors (4xx or 5xx)
 
         result = response.json()
@@ -94,17 +130,143 @@ def upload_document(pdf_path, metadata_json_path, html_file_paths=None, base_url
         for hf in html_file_handles:
             hf.close()
 
+def html_part(html_path, content, compress=None):
+    """Multipart ``html_files`` part for ``content``, gzipped with a part Content-Encoding if ``compress`` is set."""
+    if compress:
+        return ('html_files', (os.path.basename(html_path), gzip.compress(content), 'text/html',
+                               {'Content-Encoding': 'gzip'}))
+    return ('html_files', (os.path.basename(html_path), content, 'text/html'))
+
+def post_compressed(url, **kwargs):
+    """requests.post with the encoded request body gzipped and sent with Content-Encoding: gzip."""
+    prepared = requests.Request('POST', url, **kwargs).prepare()
+    body = gzip.compress(prepared.body)
+    prepared.headers['Content-Encoding'] = 'gzip'
+    prepared.headers['Content-Length'] = str(len(body))
+    prepared.body = body
+    with requests.Session() as session:
+        return session.send(prepared)
+
+def retry_delay(response, attempt):
+    """Seconds to wait before retry ``attempt``: the server's Retry-After, if any, plus jittered backoff.
+
+    The backoff is drawn uniformly from [0, RETRY_BACKOFF_SECONDS * 2 ** attempt] (capped at
+    RETRY_MAX_BACKOFF_SECONDS), so clients turned away together do not all come back at once.
+    """
+    backoff = random.uniform(0, min(RETRY_MAX_BACKOFF_SECONDS, RETRY_BACKOFF_SECONDS * 2 ** attempt))
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after and retry_after.strip().isdigit():
+        return int(retry_after) + backoff
+    return backoff
+
+def send_with_retry(send, retries=RETRIES):
+    """Call ``send()`` until it returns a response other than 502/503/504 or ``retries`` run out.
+
+    Connection errors and timeouts are retried as well.
+    """
+    for attempt in range(retries + 1):
+        response = None
+        try:
+            response = send()
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if attempt == retries:
+                raise
+        else:
+            if response.status_code not in RETRY_STATUSES or attempt == retries:
+                return response
+        time.sleep(retry_delay(response, attempt))
+
+def request_with_retry(method, url, retries=RETRIES, **kwargs):
+    """requests.request, retried with send_with_retry."""
+    return send_with_retry(lambda: requests.request(method, url, **kwargs), retries)
+
+def load_resume_state(state_path, pdf_path):
+    """The saved session URL for ``pdf_path``, or None if there is none or the file changed since."""
+    try:
+        with open(state_path, 'r') as f:
+            state = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    stat = os.stat(pdf_path)
+    if state.get('size') != stat.st_size or state.get('mtime') != stat.st_mtime:
+        return None
+    return state.get('url')
+
+def upload_resumable(pdf_path, data, html_file_paths, base_url, chunk_size, parallel=1, retries=RETRIES, compress=None):
+    """
+    Uploads ``pdf_path`` through a resumable upload session and finalizes it.
+
+    The session URL is saved next to the PDF (``<pdf_path>.upload.json``) until the
+    upload completes, so running the upload again after a failure only sends the
+    chunks the server has not received. Returns the response of the finalize request.
+    """
+    state_path = pdf_path + RESUME_SUFFIX
+    session = None
+    session_url = load_resume_state(state_path, pdf_path)
+    if session_url:
+        response = request_with_retry('get', session_url, retries)
+        if response.status_code == 200 and response.json().get('status') == 'open':
+            session = response.json()
+            print(f"Resuming upload session: {session_url}")
+    if session is None:
+        stat = os.stat(pdf_path)
+        response = request_with_retry('post', f"{base_url}/upload/sessions", retries, json={
+            'doc_id': data['doc_id'],
+            'metadata': json.loads(data['metadata']),
+            'change_description': data['change_description'],
+            'filename': os.path.basename(pdf_path),
+            'size': stat.st_size,
+            'chunk_size': chunk_size,
+        })
+        response.raise_for_status()
+        session = response.json()
+        session_url = urljoin(base_url, response.headers['Location'])
+        with open(state_path, 'w') as f:
+            json.dump({'url': session_url, 'size': stat.st_size, 'mtime': stat.st_mtime}, f)
+
+    chunk_size = session['chunk_size']
+    received = set(session['received'])
+    missing = [offset for offset in range(0, session['size'], chunk_size) if offset // chunk_size not in received]
+
+    def send_chunk(offset):
+        with open(pdf_path, 'rb') as f:
+            f.seek(offset)
+            chunk = f.read(chunk_size)
+        headers = {
+            'Content-Type': 'application/offset+octet-stream',
+            'Upload-Offset': str(offset),
+            'Upload-Checksum': 'sha256 ' + base64.b64encode(hashlib.sha256(chunk).digest()).decode('ascii'),
+        }
+        request_with_retry('patch', session_url, retries, data=chunk, headers=headers).raise_for_status()
+
+    print(f"Sending {len(missing)} of {-(-session['size'] // chunk_size)} chunks")
+    with ThreadPoolExecutor(max_workers=max(1, parallel)) as pool:
+        list(pool.map(send_chunk, missing))
+
+    html_files = []
+    for html_path in html_file_paths:
+        with open(html_path, 'rb') as f:
+            html_files.append(html_part(html_path, f.read(), compress))
+    response = request_with_retry('post', f"{session_url}/finalize", retries, files=html_files)
+    if response.ok:
+        os.remove(state_path)
+    return response
+
 def main():
     parser = argparse.ArgumentParser(description="Upload a document to the PDF Browser application.")
     parser.add_argument("pdf_path", help="Path to the PDF file.")
     parser.add_argument("metadata_json_path", help="Path to the JSON file containing metadata.")
     parser.add_argument("--html_files", nargs='*', help="List of paths to HTML files (optional).")
     parser.add_argument("--base_url", default="http://127.0.0.1:5000", help="Base URL of the PDF Browser application.")
+    parser.add_argument("--chunk_size", type=int, help="Upload the PDF resumably, in chunks of this many bytes.")
+    parser.add_argument("--parallel", type=int, default=1, help="Number of chunks sent at once (with --chunk_size).")
+    parser.add_argument("--compress", choices=COMPRESS_MODES, help="Gzip the HTML files ('html') or the whole request ('body').")
 
     args = parser.parse_args()
 
     # Call upload_document and exit based on its return value
-    if upload_document(args.pdf_path, args.metadata_json_path, args.html_files, args.base_url):
+    if upload_document(args.pdf_path, args.metadata_json_path, args.html_files, args.base_url,
+                       chunk_size=args.chunk_size, parallel=args.parallel, compress=args.compress):
         exit(0)
     else:
         exit(1)